@@ -4,8 +4,11 @@
 Custom recipe for Excel Multi Sheet Exporter
 """
 
+import cProfile
+import json
 import logging
-import tempfile
+
+from contextlib import ExitStack
 
 from pathvalidate import ValidationError, validate_filename
 
@@ -14,30 +17,38 @@ from dataiku.customrecipe import get_input_names_for_role
 from dataiku.customrecipe import get_output_names_for_role
 from dataiku.customrecipe import get_recipe_config
 from openpyxl import load_workbook, Workbook
-from xlsx_writer import datasets_to_xlsx, assert_valid_sheet_name
-from typing import Union
+from xlsx_writer import datasets_to_xlsx, datasets_to_xlsx_files, assert_valid_sheet_name, DatasetRows, WorkbookSheet, \
+    ENGINE_OPENPYXL, WIDTH_STRATEGY_EXACT, DEFAULT_WIDTH_SAMPLE_SIZE, get_sheet_titles
+from excel_stream_prefetcher import ExcelStreamPrefetcher
+from memory_budget import MemoryBudget, SPOOL_BUDGET_RATIO
+from export_report import ExportReport, measure_duration
+from dataset_sheets import DatasetSelection, DatasetSheet, PARTITIONS_NONE, SAMPLING_HEAD, get_dataset_sheets
+from sheet_cache import SheetCache
+from stream_upload import StreamUpload
+from temporary_storage import TemporaryStorage
+from typing import Dict, List, Union
 
 DEFAULT_DATAIKU_SHEET_NAME = "Sheet1"
-READ_CHUNK_SIZE = 1024 * 1024  # 1Mbytes
+COMPRESSION_LEVELS = {"STORED": 0, "FAST": 1, "DEFAULT": 6, "BEST": 9}
 
 
-def get_excel_worksheet(dataset: dataiku.Dataset, apply_conditional_formatting: bool) -> Union[Workbook, None]:
-    logger.info(f"Getting Excel workbook from DSS dataset '{dataset.short_name}'...")
+def get_excel_worksheet(dataset_name: str, prefetcher: ExcelStreamPrefetcher, report: ExportReport,
+                        memory_budget: MemoryBudget = None) -> Union[Workbook, None]:
+    logger.info(f"Getting Excel workbook from DSS dataset '{dataset_name}'...")
     workbook = None
-    with tempfile.NamedTemporaryFile(delete=True) as tmp_file:
-        with dataset.raw_formatted_data(format="excel", format_params={"applyColoring": apply_conditional_formatting}) as stream:
-            # read steam with chunks to save RAM
-            chunk_size = READ_CHUNK_SIZE
-            while True:
-                chunk = stream.read(chunk_size)
-                if not chunk:
-                    break
-                tmp_file.write(chunk)
-        tmp_file.flush()  # Make sure file is written on disk
-        tmp_file.seek(0)  # Read back from start of file to load it in the workbook
-
+    with prefetcher.get_excel_file(dataset_name) as tmp_file:
+        if memory_budget is not None:
+            memory_budget.check(f"downloading dataset '{dataset_name}'")
+            # A stream kept in memory is copied for openpyxl, a large one is read from disk instead
+            if tmp_file.in_memory and tmp_file.get_size() > memory_budget.get_available_bytes() * SPOOL_BUDGET_RATIO:
+                memory_budget.degrade(f"Excel stream of dataset '{dataset_name}' read from disk instead of memory")
+                tmp_file.rollover()
         # DEV WARNING : Excel exported file contains header row in Calibri and rest in Aptos Narrow font. But load_workbook converts everything into Calibri
-        workbook = load_workbook(tmp_file)
+        # Read-only mode parses the rows lazily so that the dataset is never fully loaded in memory.
+        # The workbook keeps its own handle on the file, or its own copy of a file kept in memory,
+        # still readable after the temporary file is deleted
+        with measure_duration(report.get_dataset_measures(dataset_name), "load"):
+            workbook = load_workbook(tmp_file.get_readable_source(), read_only=True)
 
     if workbook is not None:
         if DEFAULT_DATAIKU_SHEET_NAME in workbook:
@@ -46,10 +57,71 @@ def get_excel_worksheet(dataset: dataiku.Dataset, apply_conditional_formatting:
             logger.warning(f"Default DSS default sheet name has changed from '{DEFAULT_DATAIKU_SHEET_NAME}' to '{workbook.sheetnames[0]}'")
             return workbook[workbook.sheetnames[0]]
 
-    logger.error(f"Error getting Excel workbook from DSS dataset '{dataset.short_name}', this dataset will not be exported")
+    logger.error(f"Error getting Excel workbook from DSS dataset '{dataset_name}', this dataset will not be exported")
     return None
 
 
+def get_dataset_rows(sheet: DatasetSheet) -> DatasetRows:
+    logger.info(f"Reading rows of DSS dataset '{sheet.dataset_name}' for sheet '{sheet.name}'...")
+    dataset = get_sheet_dataset(sheet)
+    rows_arguments = sheet.selection.get_rows_arguments()
+    schema = dataset.read_schema()
+    if "columns" in rows_arguments:
+        columns_by_name = {column.get("name"): column for column in schema}
+        missing_columns = [name for name in rows_arguments["columns"] if name not in columns_by_name]
+        if missing_columns:
+            raise ValueError(f"Dataset '{sheet.dataset_name}' has no column {missing_columns}")
+        schema = [columns_by_name[name] for name in rows_arguments["columns"]]
+    return DatasetRows(schema, dataset.iter_tuples(**rows_arguments))
+
+
+def get_sheet_dataset(sheet: DatasetSheet) -> dataiku.Dataset:
+    """
+    :return: the dataset of a sheet, reading only the partition of the sheet if any
+    """
+    dataset = dataiku.Dataset(sheet.dataset_name)
+    if sheet.partition is not None:
+        dataset.add_read_partitions(sheet.partition)
+    return dataset
+
+
+def get_dataset_partitions(dataset_name: str) -> Union[List[str], None]:
+    """
+    :return: the partition ids of a dataset, None if it is not partitioned
+    """
+    dataset = dataiku.Dataset(dataset_name)
+    if not dataset.get_config().get("partitioning", {}).get("dimensions"):
+        return None
+    return dataset.list_partitions()
+
+
+def get_dataset_signature(dataset_id: str) -> Union[str, None]:
+    """
+    Signature of the content of a dataset: its last build, its schema and the version of its settings
+    :param dataset_id: the full id of the dataset (PROJECT_KEY.dataset_name)
+    :return: the signature, None if the dataset was never built (its content changes are then unknown)
+    """
+    project_key, dataset_name = dataset_id.split('.', 1) if '.' in dataset_id else (dataiku.default_project_key(), dataset_id)
+    try:
+        dataset = dataiku.api_client().get_project(project_key).get_dataset(dataset_name)
+        last_build = dataset.get_info().get_raw().get("lastBuild")
+        if not last_build:
+            return None
+        settings = dataset.get_settings().get_raw()
+        return json.dumps([last_build, settings.get("schema"), settings.get("versionTag")], sort_keys=True)
+    except Exception as error:
+        logger.warning(f"Could not get the signature of dataset '{dataset_id}', it will not be cached: {error}")
+        return None
+
+
+def get_sheet_signature(sheet: DatasetSheet, dataset_id: str) -> Union[str, None]:
+    signature = get_dataset_signature(dataset_id)
+    selection = sheet.selection.to_dict()
+    if signature is None or (sheet.partition is None and not selection):
+        return signature
+    return json.dumps([signature, sheet.partition, selection], sort_keys=True)
+
+
 def get_dataset_to_sheet_mapping(config):
     renaming_sheets = config.get("renaming_sheets", False)
     dataset_to_sheet_mapping = {}
@@ -58,12 +130,77 @@ def get_dataset_to_sheet_mapping(config):
         for mapping in dataset_to_sheet_mappings:
             dataset_name = mapping.get("dataset_name")
             sheet_name = mapping.get("sheet_name")
+            if not sheet_name:
+                continue
             assert_valid_sheet_name(sheet_name)
             dataset_to_sheet_mapping[dataset_name] = sheet_name
             logger.info("Renaming dataset '{}' into sheet '{}'".format(dataset_name, sheet_name))
     return dataset_to_sheet_mapping
 
 
+def get_dataset_selections(config):
+    """
+    :return: the selection (columns, rows, filter) of each dataset, from the same per-dataset settings as the sheet names
+    """
+    dataset_selections = {}
+    if config.get("renaming_sheets", False):
+        for mapping in config.get("dataset_to_sheet_mapping", {}):
+            columns = [column.strip() for column in (mapping.get("columns") or "").split(",") if column.strip()]
+            row_limit = mapping.get("row_limit")
+            selection = DatasetSelection(columns=columns,
+                                         row_limit=int(row_limit) if row_limit else None,
+                                         sampling=mapping.get("sampling") or SAMPLING_HEAD,
+                                         filter_expression=mapping.get("filter_expression"))
+            if selection.to_dict():
+                dataset_selections[mapping.get("dataset_name")] = selection
+                logger.info("Reading {} from dataset '{}'".format(selection.to_dict(), mapping.get("dataset_name")))
+    return dataset_selections
+
+
+def get_workbook_sheets(config, dataset_sheets: Dict[str, DatasetSheet], dataset_to_sheet_mapping) -> Dict[str, List[WorkbookSheet]]:
+    """
+    :return: the sheets of each output workbook, from the workbook settings (one line per dataset of a workbook)
+    """
+    workbook_sheets = {}
+    for setting in config.get("workbooks", []):
+        workbook_name = setting.get("workbook_name")
+        dataset_name = setting.get("dataset_name")
+        if not workbook_name or not dataset_name:
+            raise ValueError("Each line of the workbook settings needs a workbook name and a dataset")
+        sheets = [sheet for sheet in dataset_sheets.values() if sheet.dataset_name == dataset_name]
+        if not sheets:
+            logger.warning(f"No sheet to export for dataset '{dataset_name}' in workbook '{workbook_name}'")
+        # Partition sheets keep their names
+        sheet_name = setting.get("sheet_name") or dataset_to_sheet_mapping.get(dataset_name)
+        for sheet in sheets:
+            workbook_sheets.setdefault(workbook_name, []).append(
+                WorkbookSheet(sheet.name, sheet_name if sheet.partition is None else None, setting.get("split_by")))
+    for workbook_name, sheets in workbook_sheets.items():
+        logger.info("Exporting {} sheets into workbook '{}'".format(len(sheets), workbook_name))
+    return workbook_sheets
+
+
+def get_output_file_name(name: str) -> str:
+    output_file_name = '{}.xlsx'.format(name)
+    try:
+        validate_filename(output_file_name)
+    except ValidationError as e:
+        raise ValueError(f"{e}\n")
+    return output_file_name
+
+
+def get_upload(output_file_name: str):
+    return lambda stream: output_folder.upload_stream(output_file_name, stream)
+
+
+def abort_uploads(uploads: Dict[str, StreamUpload]):
+    """
+    Abort the uploads of the workbooks not completed, the export having failed before they were written
+    """
+    for upload in uploads.values():
+        upload.abort()
+
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='Multi-Sheet Excel Exporter | %(levelname)s - %(message)s')
 
@@ -86,33 +223,157 @@ output_folder = dataiku.Folder(output_folder_name)
 input_config = get_recipe_config()
 workbook_name = input_config.get('output_workbook_name', None)
 apply_conditional_formatting = input_config.get('export_conditional_formatting', False)
+fast_mode = input_config.get('fast_mode', False)
+compression = input_config.get('compression', "DEFAULT")
+compression_level = int(input_config.get('compression_level', 6)) if compression == "CUSTOM" else COMPRESSION_LEVELS[compression]
+max_workers = int(input_config.get('max_workers', 1))
+deflate_workers = int(input_config.get('deflate_workers', 1))
+engine = input_config.get('engine', ENGINE_OPENPYXL)
+width_strategy = input_config.get('width_strategy', WIDTH_STRATEGY_EXACT)
+width_sample_size = int(input_config.get('width_sample_size', DEFAULT_WIDTH_SAMPLE_SIZE))
+prefetched_datasets = int(input_config.get('prefetched_datasets', 1))
+prefetch_disk_budget_mb = input_config.get('prefetch_disk_budget_mb', None)
 dataset_to_sheet_mapping = get_dataset_to_sheet_mapping(input_config)
+dataset_selections = get_dataset_selections(input_config)
+write_run_report = input_config.get('write_run_report', False)
+sheet_cache_directory = input_config.get('sheet_cache_directory', None)
+sheet_cache_max_size_mb = input_config.get('sheet_cache_max_size_mb', None)
+profiling = input_config.get('profiling', False)
+partitions_mode = input_config.get('partitions_mode', PARTITIONS_NONE)
+selected_partitions = input_config.get('selected_partitions', [])
+multiple_workbooks = input_config.get('multiple_workbooks', False)
+temporary_directory = input_config.get('temporary_directory', None)
+spool_max_mb = input_config.get('spool_max_mb', None)
+memory_budget_mb = input_config.get('memory_budget_mb', None)
 
 if workbook_name is None:
     logger.warning("Received input received recipe config: {}".format(input_config))
     raise ValueError('Could not read the workbook name.')
 
-output_file_name = '{}.xlsx'.format(workbook_name)
+output_file_name = get_output_file_name(workbook_name)
 
-try:
-    validate_filename(output_file_name)
-except ValidationError as e:
-    raise ValueError(f"{e}\n")
 
+if max_workers > 1 or fast_mode:
+    # Worker processes are forked and cannot share the download threads: each one downloads its datasets
+    # Fast mode reads the dataset rows, without downloading excel streams
+    prefetched_datasets = 0
+max_disk_bytes = None if not prefetch_disk_budget_mb else int(prefetch_disk_budget_mb) * 1024 * 1024
+spool_max_bytes = 0 if not spool_max_mb else int(spool_max_mb) * 1024 * 1024
+memory_budget = None
+if memory_budget_mb:
+    # The settings using memory are reduced to fit the budget, the export fails with a clear error if it exceeds it anyway
+    memory_budget = MemoryBudget(int(memory_budget_mb) * 1024 * 1024)
+    max_workers, prefetched_datasets, spool_max_bytes = memory_budget.limit_settings(max_workers, prefetched_datasets,
+                                                                                      spool_max_bytes)
+# Temporary files smaller than the spool size stay in memory, the others are written in the temporary directory
+temporary_storage = TemporaryStorage(temporary_directory or None, spool_max_bytes, memory_budget)
 
-with tempfile.NamedTemporaryFile() as tmp_file:
-    tmp_file_path = tmp_file.name
-    logger.info("Intend to write the output xls file to the following location: {}".format(tmp_file_path))
+# One sheet per dataset, or per partition of the partitioned datasets
+dataset_sheets = get_dataset_sheets(input_datasets_names, get_dataset_partitions, partitions_mode, selected_partitions,
+                                    dataset_selections)
+sheet_names = list(dataset_sheets)
+workbook_sheets = None
+if multiple_workbooks:
+    # Several workbooks: the sheets shared by the workbooks are downloaded and converted once
+    workbook_sheets = get_workbook_sheets(input_config, dataset_sheets, dataset_to_sheet_mapping)
+    sheet_names = list(dict.fromkeys(sheet.dataset_name for sheets in workbook_sheets.values() for sheet in sheets))
+    output_file_names = {name: get_output_file_name(name) for name in workbook_sheets}
 
-    datasets_to_xlsx(
-        input_datasets_names,
-        tmp_file_path,
-        lambda name: get_excel_worksheet(dataiku.Dataset(name), apply_conditional_formatting),
-        dataset_to_sheet_mapping=dataset_to_sheet_mapping
+report = ExportReport()
+report.settings.update(datasets=len(input_datasets_names), sheets=len(sheet_names), partitions_mode=partitions_mode,
+                       fast_mode=fast_mode, export_conditional_formatting=apply_conditional_formatting,
+                       prefetched_datasets=prefetched_datasets, prefetch_disk_budget_bytes=max_disk_bytes)
+sheet_cache = None
+if sheet_cache_directory:
+    dataset_ids = dict(zip(input_datasets_names, input_datasets_ids))
+    sheet_cache = SheetCache(
+        sheet_cache_directory,
+        lambda name: get_sheet_signature(dataset_sheets[name], dataset_ids[dataset_sheets[name].dataset_name]),
+        settings={"export_conditional_formatting": apply_conditional_formatting, "fast_mode": fast_mode, "engine": engine,
+                  "width_strategy": width_strategy, "width_sample_size": width_sample_size},
+        max_bytes=None if not sheet_cache_max_size_mb else int(sheet_cache_max_size_mb) * 1024 * 1024
     )
+# The sheets found in the cache are not converted: only the other datasets are downloaded
+names_to_download = sheet_names
+if sheet_cache is not None:
+    sheet_titles = get_sheet_titles(sheet_names, dataset_to_sheet_mapping if workbook_sheets is None else {})
+    names_to_download = [name for name, title in zip(sheet_names, sheet_titles) if not sheet_cache.contains(sheet_cache.get_key(name, title))]
+# Only the main process is profiled, not the worker processes of the parallel conversion
+profiler = cProfile.Profile() if profiling else None
+
+# The workbooks are uploaded while they are written, without a full copy on disk
+with ExitStack() as output_streams, \
+        ExcelStreamPrefetcher(names_to_download, lambda name: get_sheet_dataset(dataset_sheets[name]), apply_conditional_formatting,
+                              max_prefetched_datasets=prefetched_datasets, max_disk_bytes=max_disk_bytes,
+                              report=report,
+                              read_arguments_provider=lambda name: dataset_sheets[name].selection.get_read_arguments(),
+                              temporary_storage=temporary_storage, memory_budget=memory_budget) as prefetcher:
+    worksheet_provider = (lambda name: get_dataset_rows(dataset_sheets[name])) if fast_mode \
+        else lambda name: get_excel_worksheet(name, prefetcher, report, memory_budget)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if workbook_sheets is None:
+            logger.info(f"Streaming the output excel file to '{output_file_name}' in the output folder...")
+            output_stream = output_streams.enter_context(StreamUpload(get_upload(output_file_name)))
+            datasets_to_xlsx(
+                sheet_names,
+                output_stream,
+                worksheet_provider,
+                dataset_to_sheet_mapping=dataset_to_sheet_mapping,
+                max_workers=max_workers,
+                compression_level=compression_level,
+                report=report,
+                sheet_cache=sheet_cache,
+                engine=engine,
+                width_strategy=width_strategy,
+                width_sample_size=width_sample_size,
+                temporary_storage=temporary_storage,
+                deflate_workers=deflate_workers,
+                memory_budget=memory_budget
+            )
+        else:
+            # Each upload starts with the first bytes of its workbook, the workbooks are uploaded one after another
+            logger.info(f"Streaming the output excel files {list(output_file_names.values())} to the output folder...")
+            output_streams_by_workbook = {name: StreamUpload(get_upload(file_name)) for name, file_name in output_file_names.items()}
+            # Each upload is completed as soon as its workbook is written, the uploads not completed are aborted on errors
+            pending_uploads = dict(output_streams_by_workbook)
+            output_streams.callback(abort_uploads, pending_uploads)
+            for upload in pending_uploads.values():
+                upload.start()
+            datasets_to_xlsx_files(
+                workbook_sheets,
+                output_streams_by_workbook,
+                worksheet_provider,
+                max_workers=max_workers,
+                compression_level=compression_level,
+                report=report,
+                sheet_cache=sheet_cache,
+                engine=engine,
+                width_strategy=width_strategy,
+                width_sample_size=width_sample_size,
+                temporary_storage=temporary_storage,
+                deflate_workers=deflate_workers,
+                memory_budget=memory_budget,
+                on_workbook_written=lambda name: pending_uploads.pop(name).finish()
+            )
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+if write_run_report:
+    # Including the prefetched files closed after the export
+    report.temporary_storage = temporary_storage.to_dict()
+    if memory_budget is not None:
+        report.memory_budget = memory_budget.to_dict()
+    logger.info(f"Writing run report '{workbook_name}.report.json'...")
+    output_folder.upload_data('{}.report.json'.format(workbook_name), report.to_json().encode())
 
-    with open(tmp_file_path, 'rb', encoding=None) as f:
-        output_folder.upload_stream(output_file_name, f)
+if profiler is not None:
+    logger.info(f"Writing profile '{workbook_name}.prof' (open it with pstats or snakeviz)...")
+    with temporary_storage.create_file(on_disk=True) as profile_file:
+        profiler.dump_stats(profile_file.name)
+        output_folder.upload_stream('{}.prof'.format(workbook_name), profile_file)
 
 
 logger.info("Ended recipe processing.")
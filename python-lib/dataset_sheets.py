@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Sheets of an export: one sheet per dataset, or one sheet per partition of the partitioned datasets.
+Each sheet can read only a selection of its dataset (columns, rows, filter), applied by DSS when fetching the dataset.
+"""
+
+import logging
+
+from typing import Dict, List
+from xlsx_writer import INVALID_SHEET_NAME_CHARACTERS_RE
+
+PARTITIONS_NONE = "NONE"  # One sheet per dataset, with all its partitions
+PARTITIONS_ALL = "ALL"  # One sheet per partition
+PARTITIONS_SELECTED = "SELECTED"  # One sheet per selected partition
+SAMPLING_HEAD = "head"  # First rows of the dataset
+SAMPLING_RANDOM = "random"  # Rows drawn at random in the dataset
+# DSS sampling methods of the sampling parameter of Dataset.raw_formatted_data
+DSS_SAMPLING_METHODS = {SAMPLING_HEAD: "HEAD_SEQUENTIAL", SAMPLING_RANDOM: "RANDOM_FIXED_NB"}
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetSelection:
+    """
+    The part of a dataset read in its sheet, fetched from DSS without the other columns and rows
+    """
+
+    def __init__(self, columns: List[str] = None, row_limit: int = None, sampling: str = SAMPLING_HEAD,
+                 filter_expression: str = None):
+        """
+        :param columns: the names of the columns to read, in this order, None to read all columns
+        :param row_limit: the maximum number of rows to read, None to read all rows
+        :param sampling: how the rows are chosen when they are limited, SAMPLING_HEAD for the first rows, SAMPLING_RANDOM for random rows
+        :param filter_expression: a DSS formula keeping only the rows where it is true, None to keep all rows
+        """
+        if sampling not in DSS_SAMPLING_METHODS:
+            raise ValueError("Invalid sampling {}, expecting '{}' or '{}'".format(sampling, SAMPLING_HEAD, SAMPLING_RANDOM))
+        if row_limit is not None and row_limit < 1:
+            raise ValueError("Invalid row limit {}, expecting at least 1 row".format(row_limit))
+        self.columns = columns or None
+        self.row_limit = row_limit
+        self.sampling = sampling
+        self.filter_expression = filter_expression or None
+
+    def to_dict(self) -> Dict:
+        """
+        :return: the settings of the selection which are set, empty when the whole dataset is read
+        """
+        settings = {"columns": self.columns, "row_limit": self.row_limit, "filter_expression": self.filter_expression}
+        if self.row_limit is not None:
+            settings["sampling"] = self.sampling
+        return {key: value for key, value in settings.items() if value is not None}
+
+    def get_read_arguments(self) -> Dict:
+        """
+        :return: the arguments of Dataset.raw_formatted_data reading the selection
+        """
+        arguments = {}
+        if self.columns is not None:
+            arguments["columns"] = self.columns
+        sampling = {}
+        if self.row_limit is not None:
+            sampling.update(samplingMethod=DSS_SAMPLING_METHODS[self.sampling], maxRecords=self.row_limit)
+        if self.filter_expression is not None:
+            sampling["filter"] = {"enabled": True, "expression": self.filter_expression}
+        if sampling:
+            sampling.setdefault("samplingMethod", "FULL")
+            arguments["sampling"] = sampling
+        return arguments
+
+    def get_rows_arguments(self) -> Dict:
+        """
+        :return: the arguments of Dataset.iter_tuples reading the selection
+        """
+        if self.filter_expression is not None:
+            raise ValueError("Filter expressions are not supported by the fast mode, which reads the dataset rows directly")
+        arguments = {}
+        if self.columns is not None:
+            arguments["columns"] = self.columns
+        if self.row_limit is not None:
+            arguments.update(sampling=self.sampling, limit=self.row_limit)
+        return arguments
+
+
+class DatasetSheet:
+    """
+    A sheet of the export, holding a dataset or one partition of a dataset
+    """
+
+    def __init__(self, dataset_name: str, partition: str = None, selection: DatasetSelection = None):
+        """
+        :param dataset_name: the name of the dataset
+        :param partition: the partition id of the dataset read in the sheet, None to read the whole dataset
+        :param selection: the columns and rows of the dataset read in the sheet, None to read them all
+        """
+        self.dataset_name = dataset_name
+        self.partition = partition
+        self.selection = selection or DatasetSelection()
+
+    @property
+    def name(self) -> str:
+        """
+        The name identifying the sheet in the export, also its sheet name before the renaming of the too long names
+        """
+        if self.partition is None:
+            return self.dataset_name
+        return get_partition_sheet_name(self.dataset_name, self.partition)
+
+
+def get_partition_sheet_name(dataset_name: str, partition: str) -> str:
+    return INVALID_SHEET_NAME_CHARACTERS_RE.sub("_", f"{dataset_name}_{partition}")
+
+
+def get_dataset_sheets(dataset_names: List[str], partitions_provider, partitions_mode: str = PARTITIONS_NONE,
+                       selected_partitions: List[str] = None,
+                       dataset_selections: Dict[str, DatasetSelection] = None) -> Dict[str, DatasetSheet]:
+    """
+    Get the sheets of the export, in the order of the datasets then of their partitions
+    :param dataset_names: the names of the input datasets
+    :param partitions_provider: a lambda used to get the partition ids of a dataset from its name, None if it is not partitioned
+    :param partitions_mode: PARTITIONS_NONE for one sheet per dataset,
+        PARTITIONS_ALL for one sheet per partition of the partitioned datasets,
+        PARTITIONS_SELECTED for one sheet per selected partition of the partitioned datasets
+    :param selected_partitions: the ids of the partitions to export with PARTITIONS_SELECTED
+    :param dataset_selections: the selection read in the sheets of each dataset, the whole dataset being read if it has none
+    :return: the sheets, by name
+    """
+    assert_valid_partitions_mode(partitions_mode)
+    selected_partitions = selected_partitions or []
+    dataset_selections = dataset_selections or {}
+    dataset_sheets = {}
+    for dataset_name in dataset_names:
+        partitions = None if partitions_mode == PARTITIONS_NONE else partitions_provider(dataset_name)
+        selection = dataset_selections.get(dataset_name)
+        if partitions is None:
+            sheets = [DatasetSheet(dataset_name, selection=selection)]
+        else:
+            if partitions_mode == PARTITIONS_SELECTED:
+                missing_partitions = [partition for partition in selected_partitions if partition not in partitions]
+                if missing_partitions:
+                    logger.warning(f"Dataset '{dataset_name}' has no partition {missing_partitions}, skipping them")
+                partitions = [partition for partition in partitions if partition in selected_partitions]
+            if not partitions:
+                logger.warning(f"No partition to export for dataset '{dataset_name}', this dataset will not be exported")
+            sheets = [DatasetSheet(dataset_name, partition, selection) for partition in partitions]
+        for sheet in sheets:
+            if sheet.name in dataset_sheets:
+                raise ValueError(f"Several sheets are named '{sheet.name}', rename the datasets or partitions")
+            dataset_sheets[sheet.name] = sheet
+    logger.info(f"Exporting {len(dataset_sheets)} sheets from {len(dataset_names)} datasets")
+    return dataset_sheets
+
+
+def assert_valid_partitions_mode(partitions_mode):
+    if partitions_mode not in (PARTITIONS_NONE, PARTITIONS_ALL, PARTITIONS_SELECTED):
+        raise ValueError("Invalid partitions mode {}, expecting '{}', '{}' or '{}'".format(
+            partitions_mode, PARTITIONS_NONE, PARTITIONS_ALL, PARTITIONS_SELECTED))
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Download of the DSS excel streams of the datasets into temporary files.
+Downloads can be prefetched on background threads while previous datasets are converted.
+"""
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from export_report import ExportReport, add_measure, measure_duration
+from memory_budget import MemoryBudget
+from temporary_storage import TemporaryStorage
+
+READ_CHUNK_SIZE = 1024 * 1024  # 1Mbytes
+
+logger = logging.getLogger(__name__)
+
+
+def download_excel_stream(dataset, apply_conditional_formatting: bool, file, read_arguments: Dict = None, on_chunk=None) -> int:
+    """
+    Download the DSS excel stream of a dataset into a file
+    :param dataset: the dataset to download, a dataiku.Dataset
+    :param apply_conditional_formatting: whether DSS colors the cells with the conditional formatting rules
+    :param file: the binary file object to write
+    :param read_arguments: other arguments of raw_formatted_data selecting the data downloaded (columns, sampling), None for none
+    :param on_chunk: a lambda called with the size of each chunk written, None if not needed
+    :return: the number of bytes downloaded
+    """
+    size = 0
+    with dataset.raw_formatted_data(format="excel", format_params={"applyColoring": apply_conditional_formatting},
+                                    **(read_arguments or {})) as stream:
+        # read steam with chunks to save RAM
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            file.write(chunk)
+            size += len(chunk)
+            if on_chunk is not None:
+                on_chunk(len(chunk))
+    file.flush()  # Make sure file is written on disk
+    return size
+
+
+class ExcelStreamPrefetcher:
+    """
+    Download the DSS excel streams of datasets into temporary files, in the order of the datasets.
+    The next datasets are downloaded on background threads while the current one is being converted, with:
+        - at most max_prefetched_datasets downloaded or being downloaded ahead of the current dataset
+        - no new prefetch started while the prefetched files use more than max_disk_bytes,
+          or while the memory budget is under pressure
+    """
+
+    def __init__(self, dataset_names, dataset_provider, apply_conditional_formatting: bool,
+                 max_prefetched_datasets: int = 1, max_disk_bytes: int = None, report: ExportReport = None,
+                 read_arguments_provider=None, temporary_storage: TemporaryStorage = None, memory_budget: MemoryBudget = None):
+        """
+        :param dataset_names: the names of the datasets, in the order they will be requested
+        :param dataset_provider: a lambda used to get a dataset (an object with a raw_formatted_data method) from its name
+        :param apply_conditional_formatting: whether DSS colors the cells with the conditional formatting rules
+        :param max_prefetched_datasets: maximum number of concurrent downloads, 0 to download each dataset only when requested
+        :param max_disk_bytes: budget of the prefetched files, on disk or kept in memory, None for no budget
+        :param report: the report to fill with the size and duration of each download, None if not needed
+        :param read_arguments_provider: a lambda used to get the other arguments of raw_formatted_data for a dataset
+            (columns, sampling... see download_excel_stream), None to download the whole datasets
+        :param temporary_storage: the storage of the downloaded files, kept in memory when small enough,
+            None to write them on disk in the default temporary directory
+        :param memory_budget: the memory budget of the export, None for no budget
+        """
+        self.dataset_names = list(dataset_names)
+        self.dataset_provider = dataset_provider
+        self.apply_conditional_formatting = apply_conditional_formatting
+        self.max_prefetched_datasets = max_prefetched_datasets
+        self.max_disk_bytes = max_disk_bytes
+        self.report = report
+        self.read_arguments_provider = read_arguments_provider
+        self.temporary_storage = temporary_storage or TemporaryStorage()
+        self.memory_budget = memory_budget
+        # Index in dataset_names of the next dataset to prefetch
+        self.next_index = 0
+        # Prefetched datasets: name -> (temporary file, future of the download)
+        self.prefetched = {}
+        # Bytes written so far by the download of each prefetched dataset, counted by the download threads:
+        # the position of a file being written by another thread cannot be read safely
+        self.lock = threading.Lock()
+        self.downloaded_bytes = {}
+        self.executor = None
+        if max_prefetched_datasets > 0:
+            self.executor = ThreadPoolExecutor(max_workers=max_prefetched_datasets, thread_name_prefix="excel-prefetch")
+        self.prefetch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def download(self, name, file) -> int:
+        logger.info(f"Downloading Excel stream of DSS dataset '{name}'...")
+        measures = None if self.report is None else self.report.get_dataset_measures(name)
+        with measure_duration(measures, "download"):
+            read_arguments = None if self.read_arguments_provider is None else self.read_arguments_provider(name)
+            size = download_excel_stream(self.dataset_provider(name), self.apply_conditional_formatting, file, read_arguments,
+                                         lambda chunk_size: self.add_downloaded_bytes(name, chunk_size))
+        if measures is not None:
+            add_measure(measures, "download_bytes", size)
+        logger.info(f"Downloaded Excel stream of DSS dataset '{name}' ({size} bytes).")
+        return size
+
+    def add_downloaded_bytes(self, name, size: int):
+        with self.lock:
+            self.downloaded_bytes[name] = self.downloaded_bytes.get(name, 0) + size
+
+    def get_prefetched_bytes(self) -> int:
+        with self.lock:
+            return sum(self.downloaded_bytes.get(name, 0) for name in self.prefetched)
+
+    def prefetch(self):
+        """
+        Start the downloads of the next datasets, within the limits of concurrent downloads and disk budget
+        """
+        if self.executor is None:
+            return
+        while self.next_index < len(self.dataset_names) and len(self.prefetched) < self.max_prefetched_datasets:
+            if self.max_disk_bytes is not None and self.get_prefetched_bytes() >= self.max_disk_bytes:
+                logger.info(f"Disk budget of {self.max_disk_bytes} bytes reached, prefetch of the next datasets postponed")
+                return
+            if self.memory_budget is not None and self.memory_budget.is_under_pressure():
+                self.memory_budget.degrade("prefetch of the next datasets postponed while the memory is under pressure")
+                return
+            name = self.dataset_names[self.next_index]
+            self.next_index += 1
+            if name not in self.prefetched:
+                file = self.temporary_storage.create_file()
+                self.prefetched[name] = (file, self.executor.submit(self.download, name, file))
+
+    def get_excel_file(self, name):
+        """
+        Get the excel stream of a dataset, waiting for its download if it was prefetched
+        :param name: the name of the dataset
+        :return: a temporary file (a SpooledFile) containing the excel stream, deleted when closed by the caller
+        """
+        if name in self.dataset_names:
+            # Datasets before the requested one will not be requested anymore
+            index = self.dataset_names.index(name)
+            for skipped_name in self.dataset_names[:index]:
+                if skipped_name in self.prefetched:
+                    self.discard(skipped_name)
+            self.next_index = max(self.next_index, index + 1)
+
+        if name in self.prefetched:
+            file, download = self.prefetched.pop(name)
+            try:
+                download.result()
+            except Exception:
+                file.close()
+                raise
+        else:
+            # Not prefetched: prefetch disabled or disk budget reached
+            file = self.temporary_storage.create_file()
+            try:
+                self.download(name, file)
+            except Exception:
+                file.close()
+                raise
+
+        with self.lock:
+            self.downloaded_bytes.pop(name, None)
+        self.prefetch()
+        file.seek(0)  # Read back from start of file
+        return file
+
+    def discard(self, name):
+        """
+        Stop prefetching a dataset that will not be requested, its file being closed once its download is cancelled or done
+        """
+        file, download = self.prefetched.pop(name)
+        download.cancel()
+        download.add_done_callback(lambda _: self.close_discarded(name, file))
+
+    def close_discarded(self, name, file):
+        logger.info(f"Deleting the Excel stream of DSS dataset '{name}', skipped")
+        file.close()
+        with self.lock:
+            self.downloaded_bytes.pop(name, None)
+
+    def close(self):
+        """
+        Stop the prefetch and delete the files prefetched but never requested
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for file, _ in self.prefetched.values():
+            file.close()
+        self.prefetched = {}
+        self.downloaded_bytes = {}
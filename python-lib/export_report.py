@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Measures of an export run (durations, sizes, counts, memory), written as a JSON run report.
+"""
+
+import datetime
+import json
+import resource
+import time
+
+from contextlib import contextmanager
+from typing import Dict
+
+
+def get_peak_rss_bytes(who: int = resource.RUSAGE_SELF) -> int:
+    """
+    :param who: resource.RUSAGE_SELF for the current process, resource.RUSAGE_CHILDREN for its terminated child processes
+    :return: the peak resident memory, in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def add_measure(measures: Dict, key: str, value):
+    """
+    Add a value to a measure, starting from 0 when the measure is not set
+    """
+    measures[key] = measures.get(key, 0) + value
+
+
+@contextmanager
+def measure_duration(measures: Dict, name: str):
+    """
+    Add the duration of the block to the measure '<name>_seconds'
+    :param measures: the measures to update, None to not measure anything
+    """
+    if measures is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_measure(measures, f"{name}_seconds", time.perf_counter() - start)
+
+
+class ExportReport:
+    """
+    Measures of an export run:
+        - the measures of each dataset (download, conversion, cells, style cache, temporary file...)
+        - the durations of the phases of the run building the final excel file
+        - the peak memory of the run and the size of the final excel file
+    """
+
+    def __init__(self):
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.start_time = time.perf_counter()
+        # Settings of the run, as given by the caller
+        self.settings = {}
+        # Measures of the run phases: name -> value
+        self.phases = {}
+        # Measures of each dataset, in the order they are first measured: dataset name -> (measure name -> value)
+        self.datasets = {}
+        self.output_bytes = None
+        # Files of the temporary storage kept in memory and spilled to disk (see TemporaryStorage.to_dict)
+        self.temporary_storage = None
+        # Memory budget and the degradations applied to fit it (see MemoryBudget.to_dict), None without budget
+        self.memory_budget = None
+
+    def get_dataset_measures(self, name: str) -> Dict:
+        """
+        :return: the measures of a dataset, to update in place
+        """
+        return self.datasets.setdefault(name, {})
+
+    def add_dataset_measures(self, name: str, measures: Dict):
+        """
+        Merge measures of a dataset taken elsewhere (in a worker process): numbers are added, other values replaced
+        """
+        dataset_measures = self.get_dataset_measures(name)
+        for key, value in measures.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key in dataset_measures:
+                value = max(dataset_measures[key], value) if key == "peak_rss_bytes" else dataset_measures[key] + value
+            dataset_measures[key] = value
+
+    def to_dict(self) -> Dict:
+        return {
+            "started_at": self.started_at.isoformat(),
+            "total_seconds": round(time.perf_counter() - self.start_time, 3),
+            "settings": self.settings,
+            "phases": self.phases,
+            "datasets": [dict(dataset=name, **measures) for name, measures in self.datasets.items()],
+            "output_bytes": self.output_bytes,
+            "temporary_storage": self.temporary_storage,
+            "memory_budget": self.memory_budget,
+            "peak_rss_bytes": get_peak_rss_bytes(),
+            # Worker processes of the parallel conversion
+            "peak_rss_children_bytes": get_peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2, default=str)
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Memory budget of an export, for the containers with a hard memory limit.
+The settings using memory are reduced up front to fit the budget, the export then degrades to slower low-memory modes
+while the memory used approaches the budget, and fails with a clear error once it exceeds it, before the container is killed.
+"""
+
+import logging
+import os
+import threading
+
+from typing import Dict, List, Tuple
+from export_report import get_peak_rss_bytes
+
+# Share of the budget above which the export is under pressure: no more prefetch, no more temporary file in memory
+PRESSURE_RATIO = 0.75
+# Share of the available memory given to the temporary files kept in memory
+SPOOL_BUDGET_RATIO = 0.25
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """
+    Raised when the memory used by the export exceeds its budget
+    """
+
+
+def get_process_rss_bytes(pid) -> int:
+    with open(f"/proc/{pid}/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_child_pids() -> List[str]:
+    child_pids = []
+    for task in os.listdir("/proc/self/task"):
+        with open(f"/proc/self/task/{task}/children") as children:
+            child_pids += children.read().split()
+    return child_pids
+
+
+def get_rss_bytes() -> int:
+    """
+    :return: the resident memory of the current process and of its child processes (the worker processes of the parallel
+        conversion), in bytes, or the peak resident memory of the current process where /proc cannot be read
+    """
+    try:
+        rss_bytes = get_process_rss_bytes("self")
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss_bytes()
+    try:
+        child_pids = get_child_pids()
+    except OSError:
+        return rss_bytes
+    for pid in child_pids:
+        try:
+            rss_bytes += get_process_rss_bytes(pid)
+        except (OSError, ValueError, IndexError):
+            pass  # Child process ended meanwhile
+    return rss_bytes
+
+
+class MemoryBudget:
+    """
+    Maximum resident memory of the processes of an export: the recipe process and the worker processes of the parallel conversion,
+    each worker process checking its own memory only. The degradations applied to fit the budget are logged and kept for the run report
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: the maximum resident memory, below the memory limit of the container
+        """
+        if max_bytes <= 0:
+            raise ValueError("Invalid memory budget {}, expecting a positive number of bytes".format(max_bytes))
+        self.max_bytes = max_bytes
+        # Degradations are logged from the download threads as well
+        self.lock = threading.Lock()
+        self.degradations = []
+
+    def get_available_bytes(self) -> int:
+        return max(0, self.max_bytes - get_rss_bytes())
+
+    def is_under_pressure(self) -> bool:
+        return get_rss_bytes() >= PRESSURE_RATIO * self.max_bytes
+
+    def check(self, step: str):
+        """
+        :param step: what the export is doing, for the error message
+        :raise MemoryBudgetExceeded: if the memory used by the processes exceeds the budget
+        """
+        rss_bytes = get_rss_bytes()
+        if rss_bytes > self.max_bytes:
+            raise MemoryBudgetExceeded(
+                f"Memory budget of {self.max_bytes // (1024 * 1024)} MB exceeded while {step} "
+                f"({rss_bytes // (1024 * 1024)} MB used): reduce the parallel conversion, the prefetched datasets "
+                f"or the in-memory temporary files, select fewer columns or rows, or raise the memory budget")
+
+    def degrade(self, message: str):
+        """
+        Log a degradation to a slower low-memory mode, only once per message
+        """
+        with self.lock:
+            if message in self.degradations:
+                return
+            self.degradations.append(message)
+        logger.warning(f"Memory budget: {message}")
+
+    def limit_settings(self, max_workers: int, prefetched_datasets: int, spool_max_bytes: int) -> Tuple[int, int, int]:
+        """
+        Reduce the settings using memory so that the export fits the budget, from the memory already used by the process
+        :param max_workers: the number of worker processes converting the datasets
+        :param prefetched_datasets: the number of datasets downloaded ahead of the converted one
+        :param spool_max_bytes: the maximum size of a temporary file kept in memory
+        :return: the settings within the budget, in the same order
+        :raise MemoryBudgetExceeded: if the process already uses more than the budget
+        """
+        self.check("starting the export")
+        rss_bytes = get_rss_bytes()
+        available_bytes = self.get_available_bytes()
+
+        # A forked worker is counted as a full copy of the recipe process, its pages shared copy-on-write being written sooner or later
+        if max_workers > 1:
+            workers_within_budget = max(1, available_bytes // max(rss_bytes, 1))
+            if workers_within_budget < max_workers:
+                self.degrade(f"parallel conversion reduced from {max_workers} to {workers_within_budget} processes")
+                max_workers = workers_within_budget
+
+        # The prefetched files, the converted file and the copy read by openpyxl can all be in memory at once
+        if spool_max_bytes > 0:
+            spool_within_budget = int(available_bytes * SPOOL_BUDGET_RATIO) // (prefetched_datasets + 2)
+            if spool_within_budget < spool_max_bytes:
+                self.degrade(f"in-memory temporary files reduced from {spool_max_bytes} to {spool_within_budget} bytes")
+                spool_max_bytes = spool_within_budget
+
+        if prefetched_datasets > 0 and available_bytes < (1 - PRESSURE_RATIO) * self.max_bytes:
+            self.degrade(f"prefetch of the next datasets disabled, only {available_bytes} bytes available")
+            prefetched_datasets = 0
+
+        return max_workers, prefetched_datasets, spool_max_bytes
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "degradations": list(self.degradations)
+            }
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of the converted sheets, to skip the conversion of the datasets unchanged since a previous export.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from typing import Dict, List, Union
+
+logger = logging.getLogger(__name__)
+
+# Version of the format of the cached sheets, to change whenever the temporary workbooks are written differently
+CACHE_FORMAT_VERSION = 4
+SHEET_FILE_EXTENSION = ".xlsx"
+METADATA_FILE_EXTENSION = ".json"
+TEMPORARY_FILE_EXTENSION = ".tmp"
+# Metadata of the sheets cached before CACHE_FORMAT_VERSION 4, never read again
+PREVIOUS_METADATA_FILE_EXTENSIONS = [".pickle"]
+# Files left by an interrupted export are deleted once older than this, younger ones may belong to a running export
+ORPHAN_MIN_AGE_SECONDS = 3600
+
+
+class CachedSheet:
+    """
+    A converted sheet found in the cache
+    """
+    def __init__(self, workbook_path: str, column_widths: List[float], local_style_ids: Dict, nb_sheets: int):
+        """
+        :param workbook_path: the path of the temporary workbook of the sheet, inside the cache directory
+        :param column_widths: the column widths of the sheet
+        :param local_style_ids: the cached style of each style id of the sheet, serialized as stored (see xlsx_writer.StyleCached.to_dict)
+        :param nb_sheets: the number of sheets of the dataset, continuation sheets included
+        """
+        self.workbook_path = workbook_path
+        self.column_widths = column_widths
+        self.local_style_ids = local_style_ids
+        self.nb_sheets = nb_sheets
+
+
+class SheetCache:
+    """
+    Directory storing the temporary workbook of each converted sheet, with its column widths and its style table.
+    A sheet is identified by the signature of its dataset, the settings of the export and the sheet name:
+    a dataset whose signature is unchanged since a previous export is not converted again.
+    Sheets are stored as soon as they are converted, so that an export failing partway resumes from them.
+    The least recently used sheets are deleted once the cache exceeds its maximum size,
+    and the files left by interrupted exports are deleted when the cache is opened.
+    The metadata of a sheet (column widths, style table) is stored as JSON: the style table must be serialized by the caller.
+    """
+
+    def __init__(self, directory: str, signature_provider, settings: Dict = None, max_bytes: int = None):
+        """
+        :param directory: the cache directory, created if it does not exist
+        :param signature_provider: a lambda used to get the signature of a dataset from its name,
+            a string changing whenever the dataset content changes, None if unknown (the dataset is then never cached)
+        :param settings: the export settings changing the converted sheets (conditional formatting...)
+        :param max_bytes: the maximum size of the cache, None for no limit
+        """
+        self.directory = directory
+        self.signature_provider = signature_provider
+        self.settings = settings or {}
+        self.max_bytes = max_bytes
+        # Keys of the sheets used by the current export, never evicted as they are read while assembling the final excel file
+        self.used_keys = set()
+        os.makedirs(directory, exist_ok=True)
+        self.sweep_orphans()
+
+    def get_key(self, dataset_name: str, sheet_name: str) -> Union[str, None]:
+        """
+        :return: the key of the sheet of a dataset, None if the dataset has no signature
+        """
+        signature = self.signature_provider(dataset_name)
+        if signature is None:
+            return None
+        key = json.dumps([CACHE_FORMAT_VERSION, signature, self.settings, sheet_name], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, key + extension)
+
+    def contains(self, key: str) -> bool:
+        """
+        :param key: the key of the sheet (see get_key), None if its dataset has no signature
+        :return: whether the sheet is in the cache, without marking it as used
+        """
+        if key is None:
+            return False
+        # The metadata file is written last: its presence means the sheet is complete
+        return os.path.exists(self.get_path(key, METADATA_FILE_EXTENSION)) and os.path.exists(self.get_path(key, SHEET_FILE_EXTENSION))
+
+    def load(self, key: str) -> Union[CachedSheet, None]:
+        """
+        :param key: the key of the sheet (see get_key)
+        :return: the cached sheet, None if it is not in the cache
+        """
+        if not self.contains(key):
+            return None
+        workbook_path = self.get_path(key, SHEET_FILE_EXTENSION)
+        metadata_path = self.get_path(key, METADATA_FILE_EXTENSION)
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as metadata_file:
+                metadata = json.load(metadata_file)
+            column_widths = metadata["column_widths"]
+            local_style_ids = {int(style_id): style for style_id, style in metadata["local_style_ids"].items()}
+            nb_sheets = metadata["nb_sheets"]
+        except Exception as error:
+            logger.warning(f"Ignoring the unreadable cached sheet '{key}': {error}")
+            return None
+        self.used_keys.add(key)
+        # Modification times order the sheets for the eviction
+        os.utime(workbook_path)
+        os.utime(metadata_path)
+        return CachedSheet(workbook_path, column_widths, local_style_ids, nb_sheets)
+
+    def store(self, key: str, temporary_workbook, column_widths: List[float], local_style_ids: Dict, nb_sheets: int = 1):
+        """
+        Copy a converted sheet into the cache, then evict the least recently used sheets
+        :param key: the key of the sheet (see get_key)
+        :param temporary_workbook: the path or the binary file of the temporary workbook of the sheet
+        :param column_widths: the column widths of the sheet
+        :param local_style_ids: the cached style of each style id of the sheet, serializable to JSON
+        :param nb_sheets: the number of sheets of the dataset, continuation sheets included
+        """
+        metadata = {"column_widths": column_widths, "local_style_ids": local_style_ids, "nb_sheets": nb_sheets}
+        # Written under unique temporary names then renamed, so that an interrupted export never leaves a partial sheet
+        # and exports storing the same sheet concurrently do not write the same file
+        if isinstance(temporary_workbook, (str, os.PathLike)):
+            def write_workbook(workbook_file):
+                with open(temporary_workbook, "rb") as source:
+                    shutil.copyfileobj(source, workbook_file)
+        else:
+            def write_workbook(workbook_file):
+                temporary_workbook.seek(0)
+                shutil.copyfileobj(temporary_workbook, workbook_file)
+        self.write_file(key, SHEET_FILE_EXTENSION, write_workbook)
+        # The metadata file is written last: its presence means the sheet is complete
+        self.write_file(key, METADATA_FILE_EXTENSION, lambda metadata_file: metadata_file.write(json.dumps(metadata).encode("utf-8")))
+        self.used_keys.add(key)
+        self.evict()
+
+    def write_file(self, key: str, extension: str, write):
+        """
+        Write a file of the cache under a unique temporary name, then rename it
+        :param key: the key of the sheet
+        :param extension: the extension of the file
+        :param write: a lambda writing the content of the file into a binary file
+        """
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix=TEMPORARY_FILE_EXTENSION, prefix=key + ".", dir=self.directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                write(file)
+            os.replace(temporary_path, self.get_path(key, extension))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def sweep_orphans(self):
+        """
+        Delete the files left by interrupted exports: temporary files, sheets without metadata
+        and sheets of a previous cache format
+        """
+        now = time.time()
+        for file_name in os.listdir(self.directory):
+            key, extension = os.path.splitext(file_name)
+            path = os.path.join(self.directory, file_name)
+            if extension == SHEET_FILE_EXTENSION:
+                orphan = not os.path.exists(self.get_path(key, METADATA_FILE_EXTENSION))
+            else:
+                orphan = extension == TEMPORARY_FILE_EXTENSION or extension in PREVIOUS_METADATA_FILE_EXTENSIONS
+            try:
+                if orphan and now - os.path.getmtime(path) >= ORPHAN_MIN_AGE_SECONDS:
+                    logger.info(f"Deleting orphan cache file '{file_name}'")
+                    os.remove(path)
+            except FileNotFoundError:
+                pass  # Renamed or deleted meanwhile by another export
+
+    def evict(self):
+        """
+        Delete the least recently used sheets until the cache fits in its maximum size
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.directory):
+            key, extension = os.path.splitext(file_name)
+            if extension != METADATA_FILE_EXTENSION:
+                continue
+            paths = [self.get_path(key, SHEET_FILE_EXTENSION), self.get_path(key, METADATA_FILE_EXTENSION)]
+            size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+            entries.append((os.path.getmtime(paths[1]), key, paths, size))
+            total_size += size
+
+        for _, key, paths, size in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if key in self.used_keys:
+                continue
+            logger.info(f"Evicting cached sheet '{key}' ({size} bytes)")
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            total_size -= size
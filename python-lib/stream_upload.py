@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Upload of a file while it is being written, without storing it on disk.
+The written bytes go through a bounded buffer to an upload running on a background thread.
+"""
+
+import io
+import logging
+import queue
+
+from concurrent.futures import ThreadPoolExecutor
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1Mbytes
+DEFAULT_MAX_BUFFERED_CHUNKS = 16
+# Delay between the checks of the upload state while the buffer is full or empty
+WAIT_TIMEOUT_SECONDS = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class UploadAborted(IOError):
+    """
+    Raised to the upload when the writer of the uploaded file failed
+    """
+
+
+class UploadStreamReader(io.RawIOBase):
+    """
+    Read side of a StreamUpload, given to the upload function
+    """
+
+    def __init__(self, stream_upload):
+        self.stream_upload = stream_upload
+        self.chunk = b""
+        self.position = 0
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.position == len(self.chunk):
+            if self.finished:
+                return 0
+            self.chunk = self.stream_upload.get_chunk()
+            self.position = 0
+            if self.chunk is None:
+                self.finished = True
+                self.chunk = b""
+                return 0
+        size = min(len(buffer), len(self.chunk) - self.position)
+        buffer[:size] = self.chunk[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+class StreamUpload(io.RawIOBase):
+    """
+    Writable, non seekable binary stream uploading its content on a background thread while it is written.
+    The upload function reads the content from a readable stream, for instance:
+        StreamUpload(lambda stream: folder.upload_stream("output.xlsx", stream))
+    The upload starts with the first chunk written, so that it does not wait idle while the writer prepares its content.
+    At most max_buffered_chunks chunks of UPLOAD_CHUNK_SIZE bytes are waiting for the upload: writes block while the upload lags.
+    Used as a context manager, the upload is completed when leaving the block, or aborted if the block raised an exception.
+    """
+
+    def __init__(self, upload, max_buffered_chunks: int = DEFAULT_MAX_BUFFERED_CHUNKS):
+        """
+        :param upload: a lambda uploading the content read from the stream it is given
+        :param max_buffered_chunks: maximum number of chunks written and not yet uploaded
+        """
+        self.upload_function = upload
+        self.chunks = queue.Queue(maxsize=max_buffered_chunks)
+        self.pending = bytearray()
+        self.bytes_written = 0
+        self.aborted = False
+        self.executor = None
+        self.upload = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream-upload")
+
+    def writable(self):
+        return True
+
+    def tell(self) -> int:
+        # Needed by ZipFile to write the offsets of the entries, the stream itself cannot seek
+        return self.bytes_written
+
+    def write(self, data) -> int:
+        self.pending += data
+        self.bytes_written += len(data)
+        while len(self.pending) >= UPLOAD_CHUNK_SIZE:
+            self.put_chunk(bytes(self.pending[:UPLOAD_CHUNK_SIZE]))
+            del self.pending[:UPLOAD_CHUNK_SIZE]
+        return len(data)
+
+    def put_chunk(self, chunk):
+        """
+        Queue a chunk for the upload (None to end it), waiting while the buffer is full
+        """
+        if self.upload is None:
+            self.upload = self.executor.submit(self.upload_function, UploadStreamReader(self))
+        while True:
+            if self.upload.done():
+                # The upload stopped before reading everything: raise its error
+                self.upload.result()
+                raise IOError("The upload ended before the end of the stream")
+            try:
+                self.chunks.put(chunk, timeout=WAIT_TIMEOUT_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    def get_chunk(self):
+        """
+        Get the next chunk to upload, None once the stream is finished
+        """
+        while True:
+            if self.aborted:
+                raise UploadAborted("The writer of the uploaded stream failed")
+            try:
+                return self.chunks.get(timeout=WAIT_TIMEOUT_SECONDS)
+            except queue.Empty:
+                pass
+
+    def finish(self):
+        """
+        Upload the remaining bytes and wait for the end of the upload, raising its error if it failed
+        """
+        try:
+            if self.pending:
+                self.put_chunk(bytes(self.pending))
+                self.pending = bytearray()
+            self.put_chunk(None)
+            self.upload.result()
+            logger.info(f"Uploaded {self.bytes_written} bytes.")
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        """
+        Stop the upload, which fails with UploadAborted
+        """
+        self.aborted = True
+        self.executor.shutdown(wait=True)
+        logger.warning(f"Upload aborted after {self.bytes_written} bytes written.")
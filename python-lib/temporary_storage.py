@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Storage of the temporary files of an export (downloaded excel streams, temporary workbooks, template workbook...).
+Files smaller than a threshold are kept in memory, larger ones spill to disk in a chosen directory.
+"""
+
+import io
+import logging
+import os
+import tempfile
+import threading
+
+from typing import Dict
+from memory_budget import MemoryBudget
+
+DEFAULT_SPOOL_MAX_BYTES = 0  # No file kept in memory
+
+logger = logging.getLogger(__name__)
+
+
+class SpooledFile(tempfile.SpooledTemporaryFile):
+    """
+    Binary temporary file kept in memory until it exceeds its maximum size, then moved to a named file on disk.
+    Its name is None while it is in memory. It is deleted when closed, its size being then accounted by its storage
+    """
+
+    def __init__(self, storage, max_size: int, directory: str = None):
+        super().__init__(max_size=max_size, mode="w+b", dir=directory)
+        self.storage = storage
+        self.directory = directory
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # Used by zipfile, only defined by SpooledTemporaryFile from python 3.11
+    def seekable(self) -> bool:
+        return self._file.seekable()
+
+    def readable(self) -> bool:
+        return self._file.readable()
+
+    def writable(self) -> bool:
+        return self._file.writable()
+
+    @property
+    def in_memory(self) -> bool:
+        return not self._rolled
+
+    def rollover(self):
+        """
+        Move the file to disk, into a named file so that it can also be used by its path (worker processes, profiles...)
+        """
+        if self._rolled:
+            return
+        memory_file = self._file
+        disk_file = tempfile.NamedTemporaryFile(dir=self.directory)
+        disk_file.write(memory_file.getbuffer())
+        disk_file.seek(memory_file.tell())
+        self._file = disk_file
+        self._rolled = True
+        memory_file.close()
+
+    def get_readable_source(self):
+        """
+        :return: the path of the file on disk, or a copy of the file kept in memory,
+            for a reader opening it now and reading it after the file is closed
+        """
+        if self._rolled:
+            return self.name
+        return io.BytesIO(self._file.getvalue())
+
+    def get_size(self) -> int:
+        if self._rolled:
+            return os.fstat(self._file.fileno()).st_size
+        return self._file.getbuffer().nbytes
+
+    def close(self):
+        if not self.closed:
+            self.storage.add_closed_file(self.get_size(), self.in_memory)
+        super().close()
+
+
+class TemporaryStorage:
+    """
+    Create the temporary files of an export, and account the bytes kept in memory and the bytes spilled to disk
+    """
+
+    def __init__(self, directory: str = None, spool_max_bytes: int = DEFAULT_SPOOL_MAX_BYTES, memory_budget: MemoryBudget = None):
+        """
+        :param directory: the directory of the files on disk (for instance a fast scratch volume), None for the default temporary directory
+        :param spool_max_bytes: the maximum size of a file kept in memory, 0 to write all files on disk
+        :param memory_budget: the memory budget of the export: new files are written on disk while it is under pressure,
+            None for no budget
+        """
+        if directory is not None and not os.path.isdir(directory):
+            raise ValueError(f"Temporary directory '{directory}' does not exist")
+        if spool_max_bytes < 0:
+            raise ValueError("Invalid spool size {}, expecting 0 (no file in memory) or more bytes".format(spool_max_bytes))
+        self.directory = directory
+        self.spool_max_bytes = spool_max_bytes
+        self.memory_budget = memory_budget
+        # Files are closed by the download threads as well
+        self.lock = threading.Lock()
+        self.spooled_files = 0
+        self.spooled_bytes = 0
+        self.spilled_files = 0
+        self.spilled_bytes = 0
+
+    def create_file(self, on_disk: bool = False) -> SpooledFile:
+        """
+        :param on_disk: whether the file is written on disk from the start, to use it by its path
+        :return: a binary temporary file, kept in memory up to spool_max_bytes, deleted when closed
+        """
+        file = SpooledFile(self, self.spool_max_bytes, self.directory)
+        if not on_disk and self.spool_max_bytes > 0 and self.memory_budget is not None and self.memory_budget.is_under_pressure():
+            self.memory_budget.degrade("temporary files written on disk instead of memory")
+            on_disk = True
+        if on_disk or self.spool_max_bytes == 0:
+            file.rollover()
+        return file
+
+    def add_closed_file(self, size: int, in_memory: bool):
+        with self.lock:
+            if in_memory:
+                self.spooled_files += 1
+                self.spooled_bytes += size
+            else:
+                self.spilled_files += 1
+                self.spilled_bytes += size
+
+    def to_dict(self) -> Dict:
+        """
+        :return: the settings of the storage and the files closed so far, kept in memory (spooled) or written on disk (spilled)
+        """
+        with self.lock:
+            return {
+                "directory": self.directory or tempfile.gettempdir(),
+                "spool_max_bytes": self.spool_max_bytes,
+                "spooled_files": self.spooled_files,
+                "spooled_bytes": self.spooled_bytes,
+                "spilled_files": self.spilled_files,
+                "spilled_bytes": self.spilled_bytes
+            }
+
@@ -6,52 +6,104 @@ Utility functions for conversion to Excel.
 Conversion is based on Pandas feature conversion to xlsx.
 """
 
+import datetime
+import io
 import logging
 import math
+import multiprocessing
 import os
-import tempfile
+import random
+import re
+import shutil
+import struct
 import zipfile
+import zlib
 
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Union
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bisect import bisect_right
 from copy import copy
+from xml.sax.saxutils import escape
 
 from openpyxl.cell import Cell, WriteOnlyCell
-from openpyxl.styles import Alignment, Border, Fill, Font
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.cell.read_only import ReadOnlyCell
+from openpyxl.cell.text import Text
+from openpyxl.styles import Alignment, Border, Fill, Font, PatternFill
+from openpyxl.styles.borders import DEFAULT_BORDER
+from openpyxl.styles.fills import DEFAULT_EMPTY_FILL
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE
 from openpyxl.utils import get_column_letter
+from openpyxl.utils.cell import coordinate_to_tuple
+from openpyxl.utils.datetime import from_excel, from_ISO8601, to_excel
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
+from openpyxl.worksheet._reader import _cast_number
 from openpyxl.worksheet.dimensions import ColumnDimension, DimensionHolder
 from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.xml.constants import SHEET_MAIN_NS
+from openpyxl.xml.functions import fromstring, iterparse, tostring
 from openpyxl import Workbook
-from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+from export_report import ExportReport, add_measure, get_peak_rss_bytes, measure_duration
+from memory_budget import MemoryBudget
+from sheet_cache import SheetCache
+from temporary_storage import TemporaryStorage
 
 DATAIKU_TEAL = "FF2AB1AC"
 LETTER_WIDTH = 1.20  # Approximative letter width to scale column width
 MAX_LENGTH_TO_SHOW = 45  # Limit copied from DSS native excel exporter
+EMPTY_VALUE_LENGTH = len(str(None))
+# Lengths of the integers below MAX_INTEGER_LENGTH_BOUND are found by bisection, without building their string
+MAX_INTEGER_LENGTH_BOUND = 10 ** 16
+POWERS_OF_TEN = [10 ** exponent for exponent in range(1, 17)]
+# Strategies of the column width computation: all rows, the first rows or a sample of the rows
+WIDTH_STRATEGY_EXACT = "exact"
+WIDTH_STRATEGY_FIRST_ROWS = "first_rows"
+WIDTH_STRATEGY_SAMPLE = "sample"
+DEFAULT_WIDTH_SAMPLE_SIZE = 10000
 EXCEL_MAX_LEN_SHEET_NAME = 31
+EXCEL_MAX_ROWS = 1048576  # Datasets with more rows (header included) are split into continuation sheets
+# Characters not allowed in the excel sheet names
+INVALID_SHEET_NAME_CHARACTERS_RE = re.compile(r"[\\/?*\[\]:]")
+MAX_SPLIT_SHEETS = 500  # Maximum number of values of a column splitting a dataset into sheets
+SPLIT_BUFFER_SIZE = 64 * 1024  # Rows of each split sheet buffered in memory before being appended to the spill file
+EMPTY_SPLIT_VALUE = "(empty)"  # Sheet name suffix of the rows without value in the split column
+COPY_CHUNK_SIZE = 1024 * 1024  # 1Mbytes
+CELL_STYLE_ID_PATTERN = re.compile(rb'(<c\b[^>]*? s=")(\d+)"')
+# Entry of the dataset sheet in the temporary workbooks, continuation sheets of the dataset follow: sheet2.xml, sheet3.xml...
+TEMPORARY_SHEET_ENTRY_NAME = "xl/worksheets/sheet1.xml"
+DATETIME_NUMBER_FORMAT = "yyyy-mm-dd hh:mm:ss"
+DATE_NUMBER_FORMAT = "yyyy-mm-dd"
+DEFAULT_COMPRESSION_LEVEL = 6  # zlib default
+MEMORY_CHECK_ROWS = 10000  # Rows converted between two checks of the memory budget
+# Sheets deflated by several threads are cut into blocks deflated independently, each block being primed with
+# the end of the previous one (the deflate window) so that the compression ratio stays close to a single-threaded deflate
+DEFLATE_BLOCK_SIZE = 1024 * 1024  # 1Mbytes
+DEFLATE_WINDOW_SIZE = 32 * 1024
+# Engines converting the DSS excel sheets: copy of openpyxl cells, or transcoding of the sheet xml
+ENGINE_OPENPYXL = "openpyxl"
+ENGINE_XML = "xml"
+SHEET_DATA_TAG = f"{{{SHEET_MAIN_NS}}}sheetData"
+ROW_TAG = f"{{{SHEET_MAIN_NS}}}row"
+VALUE_TAG = f"{{{SHEET_MAIN_NS}}}v"
+INLINE_STRING_TAG = f"{{{SHEET_MAIN_NS}}}is"
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='Multi-Sheet Excel Exporter | %(levelname)s - %(message)s')
 
-style_cache = []
-
 
-def get_column_width(column: Tuple):
+def get_column_width(length_header: int, sum_length_cells: int, max_length_cells: int, nb_cells: int):
     """
     Find optimum column width based on content and header length
     Based on the computations of DSS native excel output formatter
     """
 
-    header = column[0]
-    length_header = len(str(header.value))
-
-    sum_length_cells = 0
-    max_length_cells = 0
-    for cell in column:
-        length_cell = len(str(cell.value))
-        max_length_cells = max(max_length_cells, length_cell)
-        sum_length_cells += length_cell
-
     # Computations from ExcelOutputFormatter.java ExcelOutputFormatter.footer
-    average_length_cell = math.ceil(sum_length_cells / (len(column) + 1))
+    average_length_cell = math.ceil(sum_length_cells / (nb_cells + 1))
     max_length_cells = min(max_length_cells, MAX_LENGTH_TO_SHOW)
 
     if max_length_cells > 2 * average_length_cell:  # if max length much bigger than average
@@ -64,25 +116,189 @@ def get_column_width(column: Tuple):
     return length_to_show * LETTER_WIDTH
 
 
-def auto_size_column_width(source_worksheet: Worksheet, target_worksheet: Worksheet):
+def get_value_length(value) -> int:
     """
-    Resize columns based on the length of the header text
+    Get the length of a cell value as displayed, len(str(value)),
+    without building the string of the integers, booleans, dates and most floats
     """
-    if source_worksheet.min_column < 1:
-        logger.warning(f"No header row for worksheet '{source_worksheet}'. Column auto-size skipped.")
-        return
-
-    dimension_holder = DimensionHolder(worksheet=source_worksheet)
-
-    column_indexes = range(source_worksheet.min_column, source_worksheet.max_column + 1)
-    for index_column, column in zip(column_indexes, source_worksheet.iter_cols()):
+    value_type = type(value)
+    if value_type is str:
+        return len(value)
+    if value is None:
+        return EMPTY_VALUE_LENGTH
+    if value_type is bool:
+        return 4 if value else 5
+    if value_type is int:
+        if -MAX_INTEGER_LENGTH_BOUND < value < MAX_INTEGER_LENGTH_BOUND:
+            return bisect_right(POWERS_OF_TEN, abs(value)) + 1 + (value < 0)
+    elif value_type is float:
+        # Integral floats are displayed with a trailing '.0' below 1e16, in exponent notation above
+        if value.is_integer() and -MAX_INTEGER_LENGTH_BOUND < value < MAX_INTEGER_LENGTH_BOUND:
+            return get_value_length(int(value)) + 2 + (value == 0 and math.copysign(1, value) < 0)
+    elif value_type is datetime.datetime:
+        if value.tzinfo is None:
+            return 26 if value.microsecond else 19
+    elif value_type is datetime.date:
+        return 10
+    elif value_type is datetime.time:
+        if value.tzinfo is None:
+            return 15 if value.microsecond else 8
+    return len(str(value))
+
+
+class ColumnWidthAccumulator:
+    """
+    Accumulate the header, sum and max lengths of each column of a sheet read row by row,
+    so that column widths can be computed without random access to the sheet
+    The header row is always measured, the other rows depend on the strategy:
+        - WIDTH_STRATEGY_EXACT: all rows
+        - WIDTH_STRATEGY_FIRST_ROWS: the first sample_size rows
+        - WIDTH_STRATEGY_SAMPLE: sample_size rows sampled uniformly (reservoir sampling), the same rows for the same sheet
+    """
+    # Missing cells are counted as empty cells, whose value is displayed as "None"
+    EMPTY_CELL_LENGTH = EMPTY_VALUE_LENGTH
+
+    def __init__(self, strategy: str = WIDTH_STRATEGY_EXACT, sample_size: int = DEFAULT_WIDTH_SAMPLE_SIZE):
+        assert_valid_width_strategy(strategy, sample_size)
+        self.strategy = strategy
+        self.sample_size = sample_size
+        # All rows and cells of the sheet
+        self.nb_rows = 0
+        self.nb_cells = 0
+        self.header_lengths = []
+        # Lengths of the measured rows, aggregated by column
+        self.nb_measured_rows = 0
+        self.sum_lengths = []
+        self.max_lengths = []
+        self.nb_measured_cells = []
+        # Cell lengths of the rows sampled so far (WIDTH_STRATEGY_SAMPLE), sampled rows being replaced by later rows
+        self.sampled_rows = []
+        self.random = random.Random(0)
+        self.reservoir_weight = 1.0
+        self.next_sampled_row = None
+
+    def measures_next_row(self) -> bool:
+        """
+        :return: True if the next added row is measured, False if only its cells are counted
+        """
+        index_data_row = self.nb_rows - 1
+        if index_data_row < 0 or self.strategy == WIDTH_STRATEGY_EXACT:
+            return True
+        if index_data_row < self.sample_size:
+            return True
+        return self.strategy == WIDTH_STRATEGY_SAMPLE and index_data_row == self.next_sampled_row
+
+    def add_row(self, row):
+        if self.measures_next_row():
+            self.add_values([cell.value for cell in row])
+        else:
+            self.add_row_size(len(row))
+
+    def add_values(self, values: List):
+        """
+        Add a measured row (see measures_next_row)
+        """
+        lengths = [get_value_length(value) for value in values]
+        self.add_columns(len(lengths))
+        if self.nb_rows == 0:
+            self.header_lengths[:] = lengths
+        if self.strategy == WIDTH_STRATEGY_SAMPLE and self.nb_rows > 0:
+            self.sample_row(lengths)
+        else:
+            self.measure_row(lengths)
+        self.nb_rows += 1
+        self.nb_cells += len(lengths)
 
-        column_width = get_column_width(column)
-        dimension_holder[get_column_letter(index_column)] = ColumnDimension(source_worksheet,
+    def add_empty_row(self, nb_cells: int):
+        if self.measures_next_row():
+            self.add_values([None] * nb_cells)
+        else:
+            self.add_row_size(nb_cells)
+
+    def add_row_size(self, nb_cells: int):
+        """
+        Add a row not measured (see measures_next_row), from its number of cells
+        """
+        self.add_columns(nb_cells)
+        self.nb_rows += 1
+        self.nb_cells += nb_cells
+
+    def add_columns(self, nb_columns: int):
+        for _ in range(len(self.header_lengths), nb_columns):
+            # The header lengths of the first row are set once it is measured
+            # A column not in the first row(s) of the sheet has an empty header
+            self.header_lengths.append(self.EMPTY_CELL_LENGTH)
+            self.sum_lengths.append(0)
+            self.max_lengths.append(0)
+            self.nb_measured_cells.append(0)
+
+    def measure_row(self, lengths: List[int]):
+        for index_column, length_cell in enumerate(lengths):
+            self.sum_lengths[index_column] += length_cell
+            self.nb_measured_cells[index_column] += 1
+            if length_cell > self.max_lengths[index_column]:
+                self.max_lengths[index_column] = length_cell
+        self.nb_measured_rows += 1
+
+    def sample_row(self, lengths: List[int]):
+        # Reservoir sampling, algorithm L: the random gap to the next sampled row is drawn once the reservoir is full
+        if len(self.sampled_rows) < self.sample_size:
+            self.sampled_rows.append(lengths)
+        else:
+            self.sampled_rows[self.random.randrange(self.sample_size)] = lengths
+        if len(self.sampled_rows) == self.sample_size:
+            self.reservoir_weight *= math.exp(math.log(self.get_random_uniform()) / self.sample_size)
+            gap = math.floor(math.log(self.get_random_uniform()) / math.log(1 - self.reservoir_weight))
+            self.next_sampled_row = self.nb_rows + gap
+
+    def get_random_uniform(self) -> float:
+        # Random number in ]0, 1[, as logarithms are taken
+        value = 0.0
+        while value == 0.0:
+            value = self.random.random()
+        return value
+
+    def get_column_widths(self) -> List[float]:
+        sum_lengths = list(self.sum_lengths)
+        max_lengths = list(self.max_lengths)
+        nb_measured_cells = list(self.nb_measured_cells)
+        for lengths in self.sampled_rows:
+            for index_column, length_cell in enumerate(lengths):
+                sum_lengths[index_column] += length_cell
+                nb_measured_cells[index_column] += 1
+                if length_cell > max_lengths[index_column]:
+                    max_lengths[index_column] = length_cell
+        nb_measured_rows = self.nb_measured_rows + len(self.sampled_rows)
+
+        column_widths = []
+        for length_header, sum_length_cells, max_length_cells, nb_cells in zip(self.header_lengths,
+                                                                                sum_lengths,
+                                                                                max_lengths,
+                                                                                nb_measured_cells):
+            nb_missing_cells = nb_measured_rows - nb_cells
+            if nb_missing_cells > 0:
+                sum_length_cells += nb_missing_cells * self.EMPTY_CELL_LENGTH
+                max_length_cells = max(max_length_cells, self.EMPTY_CELL_LENGTH)
+            column_widths.append(get_column_width(length_header, sum_length_cells, max_length_cells, nb_measured_rows))
+        return column_widths
+
+
+def get_column_dimensions(worksheet: Union[Worksheet, None], column_widths: List[float]) -> DimensionHolder:
+    dimension_holder = DimensionHolder(worksheet=worksheet)
+    for index_column, column_width in enumerate(column_widths, 1):
+        dimension_holder[get_column_letter(index_column)] = ColumnDimension(worksheet,
                                                                             min=index_column,
                                                                             max=index_column,
                                                                             width=column_width)
-    target_worksheet.column_dimensions = dimension_holder
+    return dimension_holder
+
+
+def get_style_key(font: Font, fill: Fill, number_format: str, alignment: Alignment) -> Tuple:
+    """
+    Build the hashable key identifying a cached style
+    The border is not part of the key: there is 1 border all the time (see StyleCached.__eq__)
+    """
+    return font, fill, number_format, alignment
 
 
 class StyleCached:
@@ -97,6 +313,7 @@ class StyleCached:
         self.fill = copy(fill)
         self.number_format = copy(number_format)
         self.alignment = copy(alignment)
+        self.key = get_style_key(self.font, self.fill, self.number_format, self.alignment)
 
     def __eq__(self, cell: Cell):
         return (cell.fill == self.fill
@@ -107,68 +324,914 @@ class StyleCached:
                 # and cell.border == self.border
                 )
 
-
-def get_style_cached(cell: Cell):
-    for cache in style_cache:
-        if cache == cell:
-            return cache
-    cache = StyleCached(cell.font, cell.border, cell.fill, cell.number_format, cell.alignment)
-    style_cache.append(cache)
-    return cache
-
-
-def add_styles_to_worksheet(worksheet: Worksheet):
-    logger.info(f"Adding {len(style_cache)} styles into '{worksheet.title}' worksheet...")
-    for id, cache in enumerate(style_cache, 1):
-        new_cell = worksheet.cell(row=id, column=1, value="style {}".format(id))
-        new_cell.font = cache.font
-        new_cell.border = cache.border
-        new_cell.fill = cache.fill
-        new_cell.number_format = cache.number_format
-        new_cell.alignment = cache.alignment
+    def __hash__(self):
+        return hash(self.key)
+
+    def to_dict(self) -> Dict:
+        """
+        :return: the style serializable to JSON, each style object being written as its xml element (see from_dict)
+        """
+        return {
+            "font": tostring(self.font.to_tree()).decode("utf-8"),
+            "border": tostring(self.border.to_tree()).decode("utf-8"),
+            "fill": tostring(self.fill.to_tree()).decode("utf-8"),
+            "number_format": self.number_format,
+            "alignment": tostring(self.alignment.to_tree()).decode("utf-8")
+        }
+
+    @staticmethod
+    def from_dict(style: Dict):
+        """
+        :param style: a style serialized by to_dict
+        :return: the cached style
+        """
+        return StyleCached(Font.from_tree(fromstring(style["font"])), Border.from_tree(fromstring(style["border"])),
+                           Fill.from_tree(fromstring(style["fill"])), style["number_format"],
+                           Alignment.from_tree(fromstring(style["alignment"])))
+
+
+class StyleRegistry:
+    """
+    The cached styles of an export, each distinct style being stored once whatever the number of cells and sheets using it.
+    Each export has its own registry, possibly warm-started with the styles of another registry (see copy).
+    A registry is not thread-safe: it is only used by the thread running its export
+    """
+    def __init__(self, styles: List[StyleCached] = ()):
+        """
+        :param styles: the styles the registry starts with
+        """
+        self.styles = []
+        # Index of the styles by style key (see get_style_key) to intern styles with a dict lookup
+        self.index = {}
+        for cache in styles:
+            self.add(cache)
+
+    def __len__(self):
+        return len(self.styles)
+
+    def __iter__(self):
+        return iter(self.styles)
+
+    def copy(self):
+        """
+        :return: a new registry starting with the styles of this one, the styles added to either registry not being shared
+        """
+        return StyleRegistry(self.styles)
+
+    def get_style_cached(self, cell: Cell) -> StyleCached:
+        # Cell styles are read through immutable proxies (not hashable), copy them to build the key
+        key = get_style_key(copy(cell.font), copy(cell.fill), cell.number_format, copy(cell.alignment))
+        cache = self.index.get(key)
+        if cache is None:
+            cache = self.add(StyleCached(cell.font, cell.border, cell.fill, cell.number_format, cell.alignment))
+        return cache
+
+    def add(self, cache: StyleCached) -> StyleCached:
+        """
+        Add a style to the registry if it is not already in it
+        :param cache: the style to add, possibly built by another process or another registry
+        :return: the style of the registry
+        """
+        cache_found = self.index.get(cache.key)
+        if cache_found is not None:
+            return cache_found
+        self.styles.append(cache)
+        self.index[cache.key] = cache
+        return cache
+
+
+def get_source_style_key(cell: Union[Cell, ReadOnlyCell]):
+    """
+    Key of the style of a source cell inside its own workbook: the ids of its style array
+    Cheaper than get_style_key because no style object is read
+    """
+    if isinstance(cell, ReadOnlyCell):
+        # Read-only cells directly reference the style array by its index in the source workbook
+        return cell._style_id
+    return tuple(cell._style)
 
 
-def add_styles_to_worksheet_write_only(worksheet: Worksheet):
-    logger.info(f"Adding {len(style_cache)} styles into worksheet...")
-    for id, cache in enumerate(style_cache, 1):
-        new_cell = WriteOnlyCell(worksheet, value="style {}".format(id))
-        new_cell.font = cache.font
-        new_cell.border = cache.border
-        new_cell.fill = cache.fill
-        new_cell.number_format = cache.number_format
-        new_cell.alignment = cache.alignment
-        worksheet.append([new_cell])
+def add_styles_to_workbook(workbook: Workbook, style_registry: StyleRegistry) -> Dict[StyleCached, int]:
+    """
+    Register the styles of a registry into the style tables of the workbook (fonts, fills, borders, number formats, cell formats),
+    written as its xl/styles.xml when it is saved. No cell is written: the sheets reference the styles by their style ids
+    :param workbook: the workbook to register the styles into, with at least one worksheet
+    :param style_registry: the styles to register
+    :return: the style id (index of the cell format) of each cached style in the workbook
+    """
+    logger.info(f"Adding {len(style_registry)} styles into workbook...")
+    # Cell only used to register the styles in the tables of the workbook, never appended to the worksheet
+    style_cell = WriteOnlyCell(workbook.worksheets[0])
+    style_ids = {}
+    for cache in style_registry:
+        style_cell._style = None
+        style_cell.font = cache.font
+        style_cell.border = cache.border
+        style_cell.fill = cache.fill
+        style_cell.number_format = cache.number_format
+        style_cell.alignment = cache.alignment
+        style_ids[cache] = style_cell.style_id
+    return style_ids
 
 
 # code inspired from https://openpyxl.readthedocs.io/en/stable/_modules/openpyxl/worksheet/copier.html
-def copy_sheet_to_workbook(source_sheet: Worksheet, target_workbook: Workbook) -> Worksheet:
+def copy_sheet_to_workbook(source_sheet: Worksheet, target_workbook: Workbook, measures: Dict = None,
+                           column_width_accumulator: ColumnWidthAccumulator = None,
+                           style_registry: StyleRegistry = None,
+                           memory_budget: MemoryBudget = None) -> Tuple[List[Worksheet], List[float], Dict[int, StyleCached]]:
     """
     Copy the source worksheet as a new worksheet in the target workbook
+    The source worksheet is only iterated once row by row, so it can be a read-only worksheet.
+    Column widths are computed during the same pass, so they are known only once all rows are written
+    Rows over the excel limit (EXCEL_MAX_ROWS) go into continuation sheets, starting with a copy of the header row
     :param source_sheet: the source sheet
     :param target_workbook: the workbook used to store the new sheet
-    :return: a reference to the created sheet inside the workbook
+    :param measures: the measures to update with the counts of rows, cells and style cache hits and misses, None to skip them
+    :param column_width_accumulator: the accumulator of the column widths, choosing the rows measured, None to measure all rows
+    :param style_registry: the registry of the styles of the export, None for a registry of this sheet only
+    :param memory_budget: the memory budget checked every MEMORY_CHECK_ROWS rows, None for no budget
+    :return: references to the created sheet and its continuation sheets inside the workbook
+    :return: the column widths of the created sheets
+    :return: the cached style of each style id used by the created sheets
     """
     logger.info(f"Copying sheet '{source_sheet.title}' to target workbook ({source_sheet.max_column} columns; {source_sheet.max_row} rows)...")
     target_sheet = target_workbook.create_sheet(source_sheet.title)
-
-    auto_size_column_width(source_sheet, target_sheet)
-
+    target_sheets = [target_sheet]
+    header_cells = None
+    nb_rows_in_sheet = 0
+
+    if column_width_accumulator is None:
+        column_width_accumulator = ColumnWidthAccumulator()
+    if style_registry is None:
+        style_registry = StyleRegistry()
+    # Target style arrays already computed for the source styles of this sheet
+    target_style_arrays = {}
+    style_ids = {}
+    style_cache_misses = 0
     for row in source_sheet:
+        if nb_rows_in_sheet == EXCEL_MAX_ROWS:
+            # Titles of the temporary sheets are not used, the final sheet titles are given by the template workbook
+            target_sheet = target_workbook.create_sheet(f"{source_sheet.title[:20]} {len(target_sheets) + 1}")
+            target_sheets.append(target_sheet)
+            logger.warning(f"Sheet '{source_sheet.title}' exceeds {EXCEL_MAX_ROWS} rows, continuing in sheet {len(target_sheets)}")
+            target_sheet.append([copy_write_only_cell(header_cell, target_sheet) for header_cell in header_cells])
+            nb_rows_in_sheet = 1
         cells = []
         for cell in row:
             new_cell = WriteOnlyCell(target_sheet, value=cell.value)
             new_cell.data_type = cell.data_type
-            if cell.has_style:
-                cache = get_style_cached(cell)
-                new_cell.font = cache.font
-                new_cell.border = cache.border
-                new_cell.fill = cache.fill
-                new_cell.number_format = cache.number_format
-                new_cell.alignment = cache.alignment
+            # Padding cells of read-only worksheets (EmptyCell) have no style
+            if getattr(cell, "has_style", False):
+                source_style_key = get_source_style_key(cell)
+                target_style_array = target_style_arrays.get(source_style_key)
+                if target_style_array is None:
+                    nb_cached_styles = len(style_registry)
+                    cache = style_registry.get_style_cached(cell)
+                    style_cache_misses += len(style_registry) - nb_cached_styles
+                    new_cell.font = cache.font
+                    new_cell.border = cache.border
+                    new_cell.fill = cache.fill
+                    new_cell.number_format = cache.number_format
+                    new_cell.alignment = cache.alignment
+                    target_style_arrays[source_style_key] = copy(new_cell._style)
+                    style_ids[new_cell.style_id] = cache
+                else:
+                    new_cell._style = copy(target_style_array)
             cells.append(new_cell)
+        if header_cells is None:
+            # Copied before being appended: the write-only sheet binds the next value of the row to an unstyled cell it wrote
+            header_cells = [copy_write_only_cell(cell, target_sheet) for cell in cells]
         target_sheet.append(cells)
+        nb_rows_in_sheet += 1
+        column_width_accumulator.add_row(row)
+        check_memory_budget(memory_budget, column_width_accumulator.nb_rows, source_sheet.title)
+
+    if column_width_accumulator.nb_rows == 0:
+        logger.warning(f"No header row for worksheet '{source_sheet.title}'. Column auto-size skipped.")
+
+    if measures is not None:
+        add_measure(measures, "rows", column_width_accumulator.nb_rows)
+        add_measure(measures, "cells", column_width_accumulator.nb_cells)
+        # The cache is only looked up once per distinct style of the source sheet
+        add_measure(measures, "style_cache_hits", len(target_style_arrays) - style_cache_misses)
+        add_measure(measures, "style_cache_misses", style_cache_misses)
+
+    return target_sheets, column_width_accumulator.get_column_widths(), style_ids
+
+
+def check_memory_budget(memory_budget: MemoryBudget, nb_rows: int, title: str):
+    """
+    Check the memory budget every MEMORY_CHECK_ROWS rows of a sheet, so that a single large sheet fails with a clear error
+    """
+    if memory_budget is not None and nb_rows % MEMORY_CHECK_ROWS == 0:
+        memory_budget.check(f"converting row {nb_rows} of sheet '{title}'")
+
 
-    return target_sheet
+def copy_write_only_cell(cell: WriteOnlyCell, target_sheet: Worksheet) -> WriteOnlyCell:
+    new_cell = WriteOnlyCell(target_sheet, value=cell.value)
+    new_cell.data_type = cell.data_type
+    new_cell._style = copy(cell._style)
+    return new_cell
+
+
+def get_temporary_sheet_entry_name(index_sheet: int) -> str:
+    """
+    :param index_sheet: 1 for the dataset sheet, 2 and more for its continuation sheets
+    :return: the entry of the sheet in its temporary workbook
+    """
+    return f"xl/worksheets/sheet{index_sheet}.xml"
+
+
+def get_continuation_sheet_title(title: str, index_sheet: int, used_titles) -> str:
+    """
+    Name a continuation sheet like rename_too_long_dataset_names: the title truncated, with a 2 digits index
+    :param title: the title of the first sheet of the dataset
+    :param index_sheet: 2 for the first continuation sheet
+    :param used_titles: the titles of the other sheets, the continuation sheet title being different from them
+    """
+    renaming_length = EXCEL_MAX_LEN_SHEET_NAME - 3
+    continuation_title = f"{title[0:renaming_length]}_{index_sheet:02d}"
+    while continuation_title in used_titles:
+        index_sheet += 1
+        continuation_title = f"{title[0:renaming_length]}_{index_sheet:02d}"
+    return continuation_title
+
+
+def copy_sheet_xml(source, target, column_widths: List[float], style_ids_mapping: Dict[int, int] = None):
+    """
+    Stream copy a sheet xml, inserting the column dimensions before the sheet data
+    Write only worksheets write their column dimensions before the first row, so the column widths
+    computed while copying the rows can only be added afterwards
+    :param source: binary file object of the sheet xml to read
+    :param target: binary file object to write
+    :param column_widths: the column widths to insert
+    :param style_ids_mapping: the new style id of each style id used in the sheet, None to keep them
+    """
+    cols = get_column_dimensions(None, column_widths).to_tree()
+    head = b""
+    if cols is not None:
+        index_sheet_data = -1
+        while index_sheet_data < 0:
+            chunk = source.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            head += chunk
+            index_sheet_data = head.find(b"<sheetData")
+        if index_sheet_data >= 0:
+            head = head[:index_sheet_data] + tostring(cols) + head[index_sheet_data:]
+
+    if style_ids_mapping is None:
+        target.write(head)
+        shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+        return
+
+    def replace_style_id(match):
+        return match.group(1) + str(style_ids_mapping[int(match.group(2))]).encode() + b'"'
+
+    pending = head
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        buffer = pending + chunk
+        # Only rewrite complete tags, the end of the buffer is kept for the next chunk
+        end = buffer.rfind(b">") + 1 if chunk else len(buffer)
+        target.write(CELL_STYLE_ID_PATTERN.sub(replace_style_id, buffer[:end]))
+        pending = buffer[end:]
+        if not chunk:
+            break
+
+
+class TemporarySheet:
+    """
+    A dataset sheet written into a temporary workbook stored on disk, waiting to be moved into the final workbook
+    """
+    def __init__(self, title: str, workbook_file, column_widths: List[float], local_style_ids: Dict[int, StyleCached],
+                 entry_name: str = TEMPORARY_SHEET_ENTRY_NAME):
+        """
+        :param local_style_ids: the cached style of each style id of the sheet, these ids being local to the temporary workbook
+        :param entry_name: the entry of the sheet in the temporary workbook, shared by the continuation sheets of a dataset
+        """
+        self.title = title
+        self.workbook_file = workbook_file
+        self.column_widths = column_widths
+        self.local_style_ids = local_style_ids
+        self.entry_name = entry_name
+
+
+class ConvertedDataset:
+    """
+    A dataset converted into a temporary workbook stored on disk, holding its sheet then its continuation sheets
+    """
+    def __init__(self, workbook_file, column_widths: List[float], local_style_ids: Dict[int, StyleCached], entry_names: List[str]):
+        """
+        :param local_style_ids: the cached style of each style id of the sheets, these ids being local to the temporary workbook
+        :param entry_names: the entries of the sheets in the temporary workbook, continuation sheets included
+        """
+        self.workbook_file = workbook_file
+        self.column_widths = column_widths
+        self.local_style_ids = local_style_ids
+        self.entry_names = entry_names
+
+    def get_temporary_sheets(self, name: str, title: str, used_titles) -> List[TemporarySheet]:
+        """
+        :param name: the name of the dataset, for the logs
+        :param title: the title of the first sheet
+        :param used_titles: the titles of the other sheets, updated with the titles of the continuation sheets
+        :return: the sheets of the dataset, the continuation sheets being titled after the first sheet
+        """
+        temporary_sheets = []
+        for index_sheet, entry_name in enumerate(self.entry_names, 1):
+            sheet_title = title
+            if index_sheet > 1:
+                sheet_title = get_continuation_sheet_title(title, index_sheet, used_titles)
+                used_titles.add(sheet_title)
+                logger.info(f"Rows of dataset '{name}' continue in sheet '{sheet_title}'")
+            temporary_sheets.append(TemporarySheet(sheet_title, self.workbook_file, self.column_widths, self.local_style_ids, entry_name))
+        return temporary_sheets
+
+
+class WorkbookSheet:
+    """
+    A sheet of one of the workbooks written by datasets_to_xlsx_files: a dataset, or one sheet per value of a column of a dataset
+    """
+    def __init__(self, dataset_name: str, sheet_name: str = None, split_by: str = None):
+        """
+        :param dataset_name: the name of the dataset, given to the worksheet provider
+        :param sheet_name: the title of the sheet, None to use the dataset name (renamed if too long).
+            The sheets of a split dataset are titled with it followed by the value of their rows
+        :param split_by: the header of the column splitting the rows into one sheet per value, None to write all rows in one sheet
+        """
+        assert_valid_sheet_name(sheet_name)
+        self.dataset_name = dataset_name
+        self.sheet_name = sheet_name or None
+        self.split_by = split_by or None
+
+
+class SplitSheet:
+    """
+    The rows of a dataset with one value in its split column, renumbered as in their sheet and its continuation sheets.
+    Rows are buffered in memory, then appended to a spill file shared by all the split sheets of the dataset
+    """
+    def __init__(self, spill_file):
+        self.spill_file = spill_file
+        # Chunks (offset, size) of the spill file holding the rows of each sheet, and rows not yet spilled
+        self.sheet_chunks = [[]]
+        self.buffer = bytearray()
+        # Rows of the current sheet, header row included
+        self.nb_rows = 1
+
+    def get_next_row_index(self) -> int:
+        """
+        :return: the index of the next row in its sheet, starting a continuation sheet when the current sheet is full
+        """
+        if self.nb_rows == EXCEL_MAX_ROWS:
+            self.spill()
+            self.sheet_chunks.append([])
+            self.nb_rows = 1
+        self.nb_rows += 1
+        return self.nb_rows
+
+    def add_row(self, row_xml: bytes):
+        self.buffer += row_xml
+        if len(self.buffer) >= SPLIT_BUFFER_SIZE:
+            self.spill()
+
+    def spill(self):
+        if self.buffer:
+            self.spill_file.seek(0, os.SEEK_END)
+            self.sheet_chunks[-1].append((self.spill_file.tell(), len(self.buffer)))
+            self.spill_file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def write_rows(self, index_sheet: int, target):
+        for offset, size in self.sheet_chunks[index_sheet]:
+            self.spill_file.seek(offset)
+            while size > 0:
+                chunk = self.spill_file.read(min(COPY_CHUNK_SIZE, size))
+                target.write(chunk)
+                size -= len(chunk)
+
+
+class DatasetRows:
+    """
+    Rows of a dataset typed by its schema, written directly as sheet xml without DSS styling (see write_dataset_rows)
+    """
+    def __init__(self, schema: List[Dict], rows):
+        """
+        :param schema: the columns of the dataset, list of {"name": ..., "type": ...} as in a DSS dataset schema
+        :param rows: iterable of row tuples, in the order of the schema columns (as returned by Dataset.iter_tuples)
+        """
+        self.schema = schema
+        self.rows = rows
+
+    @staticmethod
+    def from_dataframes(schema: List[Dict], dataframes):
+        """
+        :param schema: the columns of the dataset, list of {"name": ..., "type": ...} as in a DSS dataset schema
+        :param dataframes: iterable of pandas dataframe chunks (as returned by Dataset.iter_dataframes)
+        """
+        def iter_rows():
+            for dataframe in dataframes:
+                for row in dataframe.itertuples(index=False, name=None):
+                    # Missing values of pandas (NaN, NaT) are not equal to themselves
+                    yield tuple(None if value != value else value for value in row)
+        return DatasetRows(schema, iter_rows())
+
+
+def get_default_style_cached(font: Font = DEFAULT_FONT, fill: Fill = DEFAULT_EMPTY_FILL, number_format: str = "General") -> StyleCached:
+    return StyleCached(font, DEFAULT_BORDER, fill, number_format, Alignment())
+
+
+def get_header_style_cached() -> StyleCached:
+    font = copy(DEFAULT_FONT)
+    font.b = True
+    font.color = "FFFFFFFF"
+    return get_default_style_cached(font=font, fill=PatternFill(fill_type="solid", fgColor=DATAIKU_TEAL))
+
+
+def format_string_cell(reference: str, value, style_id: int = 0) -> str:
+    value = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+    style = f' s="{style_id}"' if style_id else ""
+    space = ' xml:space="preserve"' if value != value.strip() else ""
+    return f'<c r="{reference}"{style} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+
+def format_number_cell(reference: str, value) -> str:
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            value = float(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        # Excel has no NaN nor infinity
+        return ""
+    return f'<c r="{reference}"><v>{value}</v></c>'
+
+
+def format_boolean_cell(reference: str, value) -> str:
+    if isinstance(value, str):
+        value = value.lower() == "true"
+    return f'<c r="{reference}" t="b"><v>{int(bool(value))}</v></c>'
+
+
+def get_date_cell_formatter(style_id: int):
+    def format_date_cell(reference: str, value) -> str:
+        if isinstance(value, str):
+            value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            # Excel does not support timezones, DSS dates are in UTC
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return f'<c r="{reference}" s="{style_id}"><v>{to_excel(value)}</v></c>'
+    return format_date_cell
+
+
+def write_dataset_rows(dataset_rows: DatasetRows, temporary_workbook: Union[str, io.RawIOBase], measures: Dict = None,
+                       column_width_accumulator: ColumnWidthAccumulator = None, memory_budget: MemoryBudget = None,
+                       title: str = None) -> Tuple[List[float], Dict[int, StyleCached], int]:
+    """
+    Write the rows of a dataset directly as the sheet xml of a temporary workbook, without creating openpyxl cells:
+        - the header row gets the header style
+        - numbers, booleans and dates are typed from the dataset schema, other values are written as strings
+        - rows over the excel limit (EXCEL_MAX_ROWS) go into continuation sheets, starting with the header row
+    Only the sheet entries are written in the temporary workbook, as they are the only ones used in the final excel file
+    :param dataset_rows: the dataset rows to write
+    :param temporary_workbook: the path or the binary file where to save the temporary workbook
+    :param measures: the measures to update with the counts of rows and cells, None to skip them
+    :param column_width_accumulator: the accumulator of the column widths, choosing the rows measured, None to measure all rows
+    :param memory_budget: the memory budget checked every MEMORY_CHECK_ROWS rows, None for no budget
+    :param title: the title of the sheet, for the error messages
+    :return: the column widths of the sheets
+    :return: the cached style of each style id of the sheets (ids local to the sheets)
+    :return: the number of sheets written, continuation sheets included
+    """
+    style_ids = {1: get_header_style_cached(),
+                 2: get_default_style_cached(number_format=DATETIME_NUMBER_FORMAT),
+                 3: get_default_style_cached(number_format=DATE_NUMBER_FORMAT)}
+    formatters_by_type = {
+        "tinyint": format_number_cell, "smallint": format_number_cell, "int": format_number_cell,
+        "bigint": format_number_cell, "float": format_number_cell, "double": format_number_cell,
+        "boolean": format_boolean_cell,
+        "date": get_date_cell_formatter(2), "datetimenotz": get_date_cell_formatter(2), "dateonly": get_date_cell_formatter(3)
+    }
+    formatters = [formatters_by_type.get(column.get("type"), format_string_cell) for column in dataset_rows.schema]
+    column_letters = [get_column_letter(index_column) for index_column in range(1, len(formatters) + 1)]
+
+    if column_width_accumulator is None:
+        column_width_accumulator = ColumnWidthAccumulator()
+    header = [column.get("name") for column in dataset_rows.schema]
+    column_width_accumulator.add_values(header)
+
+    header_row = "".join(format_string_cell(f"{column_letter}1", name, style_id=1) for column_letter, name in zip(column_letters, header))
+    sheet_start = f'<worksheet xmlns="{SHEET_MAIN_NS}"><sheetData><row r="1">{header_row}</row>'.encode()
+    sheet_end = b'</sheetData></worksheet>'
+
+    nb_sheets = 1
+    with open_zip_file(temporary_workbook, 0) as archive:
+        sheet_writer = open_sheet_writer(archive, TEMPORARY_SHEET_ENTRY_NAME)
+        try:
+            sheet_writer.write(sheet_start)
+            index_row = 1
+            for row in dataset_rows.rows:
+                if index_row == EXCEL_MAX_ROWS:
+                    sheet_writer.write(sheet_end)
+                    sheet_writer.close()
+                    nb_sheets += 1
+                    logger.warning(f"Dataset exceeds {EXCEL_MAX_ROWS} rows, continuing in sheet {nb_sheets}")
+                    sheet_writer = open_sheet_writer(archive, get_temporary_sheet_entry_name(nb_sheets))
+                    sheet_writer.write(sheet_start)
+                    index_row = 1
+                index_row += 1
+                write_dataset_row(sheet_writer, row, index_row, formatters, column_letters)
+                column_width_accumulator.add_values(row)
+                check_memory_budget(memory_budget, column_width_accumulator.nb_rows, title)
+            sheet_writer.write(sheet_end)
+        finally:
+            sheet_writer.close()
+
+    if measures is not None:
+        add_measure(measures, "rows", column_width_accumulator.nb_rows)
+        add_measure(measures, "cells", column_width_accumulator.nb_cells)
+
+    return column_width_accumulator.get_column_widths(), style_ids, nb_sheets
+
+
+def open_sheet_writer(archive: zipfile.ZipFile, entry_name: str) -> io.BufferedWriter:
+    # The size of the sheet is not known in advance, it can exceed the ZIP64 limit
+    return io.BufferedWriter(archive.open(entry_name, 'w', force_zip64=True), COPY_CHUNK_SIZE)
+
+
+def write_dataset_row(sheet_writer, row, index_row: int, formatters: List, column_letters: List[str]):
+    """
+    Write a dataset row as sheet xml, the columns not in the schema being written as strings
+    """
+    cells = [f'<row r="{index_row}">']
+    for index_column, value in enumerate(row):
+        if value is None or value == "":
+            continue
+        if index_column >= len(formatters):
+            formatters.append(format_string_cell)
+            column_letters.append(get_column_letter(index_column + 1))
+        reference = f"{column_letters[index_column]}{index_row}"
+        try:
+            cells.append(formatters[index_column](reference, value))
+        except (ValueError, TypeError, OverflowError):
+            # Value not matching the type of its column
+            cells.append(format_string_cell(reference, value))
+    cells.append('</row>')
+    sheet_writer.write("".join(cells).encode())
+
+
+def get_workbook_style_cached(workbook: Workbook, style_id: int, style_registry: StyleRegistry) -> StyleCached:
+    """
+    Get the cached style of a style id of a workbook, adding it to the registry if needed
+    Same style as StyleRegistry.get_style_cached for a cell of this workbook with this style id
+    """
+    style_array = workbook._cell_styles[style_id]
+    if style_array.numFmtId < BUILTIN_FORMATS_MAX_SIZE:
+        number_format = BUILTIN_FORMATS.get(style_array.numFmtId, "General")
+    else:
+        number_format = workbook._number_formats[style_array.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+    return style_registry.add(StyleCached(workbook._fonts[style_array.fontId],
+                                          workbook._borders[style_array.borderId],
+                                          workbook._fills[style_array.fillId],
+                                          number_format,
+                                          workbook._alignments[style_array.alignmentId]))
+
+
+def get_date_cell_value(workbook: Workbook, style_id: int, value):
+    """
+    Convert a number with a date format into a date, as openpyxl reads it
+    openpyxl 3.1 reads the numbers with a time interval format as timedelta, openpyxl 3.0 reads all of them as datetime
+    """
+    timedelta_formats = getattr(workbook, "_timedelta_formats", None)
+    if timedelta_formats is None:
+        return from_excel(value, workbook.epoch)
+    return from_excel(value, workbook.epoch, timedelta=style_id in timedelta_formats)
+
+
+def transcode_sheet_xml(source_sheet: ReadOnlyWorksheet, temporary_workbook: Union[str, io.RawIOBase], measures: Dict = None,
+                        column_width_accumulator: ColumnWidthAccumulator = None,
+                        style_registry: StyleRegistry = None,
+                        memory_budget: MemoryBudget = None) -> Tuple[List[float], Dict[int, StyleCached], int]:
+    """
+    Write a read-only worksheet into a temporary workbook by transcoding its sheet xml, without creating openpyxl cells:
+        - the sheet xml is parsed row by row, only the current row being kept in memory
+        - the style id of each cell is remapped to a style id local to the temporary workbook
+        - shared strings are written as inline strings, other values are written as is
+        - rows over the excel limit (EXCEL_MAX_ROWS) go into continuation sheets, starting with the header row
+    Column widths are computed from the values openpyxl would read, missing cells counting as empty cells as in copy_sheet_to_workbook
+    :param source_sheet: the source sheet, from a workbook loaded in read-only mode
+    :param temporary_workbook: the path or the binary file where to save the temporary workbook
+    :param measures: the measures to update with the counts of rows, cells and style cache hits and misses, None to skip them
+    :param column_width_accumulator: the accumulator of the column widths, choosing the rows measured, None to measure all rows
+    :param style_registry: the registry of the styles of the export, None for a registry of this sheet only
+    :param memory_budget: the memory budget checked every MEMORY_CHECK_ROWS rows, None for no budget
+    :return: the column widths of the sheets
+    :return: the cached style of each style id of the sheets (ids local to the sheets)
+    :return: the number of sheets written, continuation sheets included
+    """
+    logger.info(f"Transcoding sheet '{source_sheet.title}' ({source_sheet.max_column} columns; {source_sheet.max_row} rows)...")
+    workbook = source_sheet.parent
+    if column_width_accumulator is None:
+        column_width_accumulator = ColumnWidthAccumulator()
+    if style_registry is None:
+        style_registry = StyleRegistry()
+    # Local style id of each source style id, and cached style of each local style id
+    local_style_ids = {0: 0}
+    style_ids = {}
+    local_style_ids_by_cache = {}
+    style_cache_misses = 0
+    max_column = source_sheet.max_column or 0
+
+    def get_local_style_id(source_style_id):
+        nonlocal style_cache_misses
+        local_style_id = local_style_ids.get(source_style_id)
+        if local_style_id is None:
+            nb_cached_styles = len(style_registry)
+            cache = get_workbook_style_cached(workbook, source_style_id, style_registry)
+            style_cache_misses += len(style_registry) - nb_cached_styles
+            local_style_id = local_style_ids_by_cache.get(cache)
+            if local_style_id is None:
+                local_style_id = len(style_ids) + 1
+                style_ids[local_style_id] = cache
+                local_style_ids_by_cache[cache] = local_style_id
+            local_style_ids[source_style_id] = local_style_id
+        return local_style_id
+
+    def transcode_cell(cell, reference, with_value):
+        data_type = cell.get("t", "n")
+        source_style_id = int(cell.get("s", 0))
+        style_id = get_local_style_id(source_style_id)
+        style = f' s="{style_id}"' if style_id else ""
+        if data_type == "inlineStr":
+            inline_string = cell.find(INLINE_STRING_TAG)
+            if inline_string is None:
+                return None, f'<c r="{reference}"{style}/>' if style_id else ""
+            value = Text.from_tree(inline_string).content
+            return value, format_string_cell(reference, value, style_id)
+        value_element = cell.find(VALUE_TAG)
+        text = None if value_element is None else value_element.text
+        if text is None:
+            return None, f'<c r="{reference}"{style}/>' if style_id else ""
+        if data_type == "s":
+            value = source_sheet._shared_strings[int(text)]
+            return value, format_string_cell(reference, value, style_id)
+        if data_type == "str":
+            return text, format_string_cell(reference, text, style_id)
+        if data_type == "n":
+            value = None
+            if with_value:
+                value = _cast_number(text)
+                if source_style_id in workbook._date_formats:
+                    try:
+                        value = get_date_cell_value(workbook, source_style_id, value)
+                    except (OverflowError, ValueError):
+                        value = "#VALUE!"
+            return value, f'<c r="{reference}"{style}><v>{text}</v></c>'
+        if not with_value:
+            value = None
+        elif data_type == "b":
+            value = bool(int(text))
+        elif data_type == "d":
+            value = from_ISO8601(text)
+        else:
+            value = text
+        return value, f'<c r="{reference}"{style} t="{data_type}"><v>{escape(text)}</v></c>'
+
+    sheet_start = f'<worksheet xmlns="{SHEET_MAIN_NS}"><sheetData>'.encode()
+    sheet_end = b'</sheetData></worksheet>'
+    header_row = None
+    nb_sheets = 1
+    index_row = 0
+    index_source_row = 0
+    with open_zip_file(temporary_workbook, 0) as archive:
+        sheet_writer = open_sheet_writer(archive, TEMPORARY_SHEET_ENTRY_NAME)
+
+        def next_row():
+            """
+            Move to the next row of the sheet, starting a continuation sheet once the current one reaches the excel limit
+            """
+            nonlocal sheet_writer, nb_sheets, index_row
+            if index_row == EXCEL_MAX_ROWS:
+                sheet_writer.write(sheet_end)
+                sheet_writer.close()
+                nb_sheets += 1
+                logger.warning(f"Sheet '{source_sheet.title}' exceeds {EXCEL_MAX_ROWS} rows, continuing in sheet {nb_sheets}")
+                sheet_writer = open_sheet_writer(archive, get_temporary_sheet_entry_name(nb_sheets))
+                sheet_writer.write(sheet_start)
+                # No header row when the first row of the source sheet is over the limit
+                sheet_writer.write(header_row or b"")
+                index_row = 1
+            index_row += 1
+
+        try:
+            sheet_writer.write(sheet_start)
+            with source_sheet._get_source() as source:
+                sheet_data = None
+                for event, element in iterparse(source, events=("start", "end")):
+                    if event == "start":
+                        if element.tag == SHEET_DATA_TAG:
+                            sheet_data = element
+                        continue
+                    if element.tag != ROW_TAG:
+                        continue
+
+                    source_row = int(element.get("r", index_source_row + 1))
+                    # Missing rows are kept as empty rows, possibly in the continuation sheets
+                    while index_source_row + 1 < source_row:
+                        index_source_row += 1
+                        next_row()
+                        column_width_accumulator.add_empty_row(max_column)
+                    index_source_row += 1
+                    next_row()
+
+                    # Values are only read from the xml for the rows measured by the column widths
+                    with_values = column_width_accumulator.measures_next_row()
+                    values = []
+                    cells = [f'<row r="{index_row}">']
+                    for cell in element:
+                        coordinate = cell.get("r")
+                        index_column = coordinate_to_tuple(coordinate)[1] if coordinate else len(values) + 1
+                        # Missing cells are empty cells
+                        values.extend([None] * (index_column - len(values) - 1))
+                        value, cell_xml = transcode_cell(cell, f"{get_column_letter(index_column)}{index_row}", with_values)
+                        values.append(value)
+                        cells.append(cell_xml)
+                    values.extend([None] * (max_column - len(values)))
+                    cells.append('</row>')
+                    row_xml = "".join(cells).encode()
+                    if header_row is None:
+                        header_row = row_xml
+                    sheet_writer.write(row_xml)
+                    if with_values:
+                        column_width_accumulator.add_values(values)
+                    else:
+                        column_width_accumulator.add_row_size(len(values))
+
+                    # Free the parsed rows
+                    element.clear()
+                    if sheet_data is not None:
+                        sheet_data.clear()
+                    check_memory_budget(memory_budget, index_source_row, source_sheet.title)
+            sheet_writer.write(sheet_end)
+        finally:
+            sheet_writer.close()
+
+    # Trailing empty rows of the sheet dimensions
+    for _ in range(index_source_row, source_sheet.max_row or 0):
+        column_width_accumulator.add_empty_row(max_column)
+
+    if column_width_accumulator.nb_rows == 0:
+        logger.warning(f"No header row for worksheet '{source_sheet.title}'. Column auto-size skipped.")
+
+    if measures is not None:
+        add_measure(measures, "rows", column_width_accumulator.nb_rows)
+        add_measure(measures, "cells", column_width_accumulator.nb_cells)
+        add_measure(measures, "style_cache_hits", len(local_style_ids) - 1 - style_cache_misses)
+        add_measure(measures, "style_cache_misses", style_cache_misses)
+
+    return column_width_accumulator.get_column_widths(), style_ids, nb_sheets
+
+
+def get_sheet_cell_text(cell) -> Union[str, None]:
+    """
+    :param cell: a cell of a temporary sheet, parsed from its xml
+    :return: the value of the cell as written in the xml, the text of the inline strings, None for an empty cell
+    """
+    if cell.get("t") == "inlineStr":
+        inline_string = cell.find(INLINE_STRING_TAG)
+        return None if inline_string is None else Text.from_tree(inline_string).content
+    value_element = cell.find(VALUE_TAG)
+    return None if value_element is None else value_element.text
+
+
+def format_sheet_cell(cell, reference: str) -> str:
+    """
+    Format again a cell of a temporary sheet, parsed from its xml, at another reference
+    """
+    style_id = int(cell.get("s", 0))
+    data_type = cell.get("t", "n")
+    text = get_sheet_cell_text(cell)
+    if text is not None and data_type == "inlineStr":
+        return format_string_cell(reference, text, style_id)
+    style = f' s="{style_id}"' if style_id else ""
+    if text is None:
+        return f'<c r="{reference}"{style}/>' if style_id else ""
+    data_type = "" if data_type == "n" else f' t="{data_type}"'
+    return f'<c r="{reference}"{style}{data_type}><v>{escape(text)}</v></c>'
+
+
+def format_sheet_row(row, index_row: int) -> bytes:
+    """
+    Format again a row of a temporary sheet, parsed from its xml, at another row index
+    """
+    cells = [f'<row r="{index_row}">']
+    for cell in row:
+        column_letter = cell.get("r", "").rstrip("0123456789")
+        cells.append(format_sheet_cell(cell, f"{column_letter}{index_row}"))
+    cells.append('</row>')
+    return "".join(cells).encode()
+
+
+def get_split_sheet_title(title: str, value: str) -> str:
+    """
+    Title the sheet of the rows with a value: the title followed by the value, the title being truncated to keep the whole value
+    """
+    suffix = INVALID_SHEET_NAME_CHARACTERS_RE.sub("_", f"_{value or EMPTY_SPLIT_VALUE}")
+    return title[0:max(EXCEL_MAX_LEN_SHEET_NAME - len(suffix), 1)] + suffix
+
+
+def split_converted_dataset(name: str, converted_dataset: ConvertedDataset, column_name: str,
+                            temporary_storage: TemporaryStorage) -> Dict[str, ConvertedDataset]:
+    """
+    Split the rows of a converted dataset by the values of one of its columns, in a single pass over its sheets:
+        - each row is renumbered and appended to the rows of its value, spilled on disk
+        - the rows of each value are written into a sheet (and its continuation sheets) starting with the header row
+    The values are the values written in the sheet xml: the text of the strings, the serial numbers of the dates
+    All the sheets are stored into a single temporary workbook, the column widths and the styles of the dataset being kept.
+    A column with more than MAX_SPLIT_SHEETS values fails, rather than writing a sheet per row of a column of identifiers
+    :param name: the name of the dataset
+    :param converted_dataset: the converted dataset to split
+    :param column_name: the header of the column splitting the rows
+    :param temporary_storage: the storage of the spilled rows and of the temporary workbook of the sheets
+    :return: the converted dataset of each value, in the order of their first row
+    """
+    logger.info(f"Splitting the rows of dataset '{name}' by the values of column '{column_name}'...")
+    header_row = None
+    split_column_letter = None
+    split_sheets = {}
+    with temporary_storage.create_file() as spill_file:
+        with zipfile.ZipFile(converted_dataset.workbook_file, mode="r") as archive:
+            for entry_name in converted_dataset.entry_names:
+                # Continuation sheets start with a copy of the header row
+                is_header_row = True
+                with archive.open(entry_name) as source:
+                    sheet_data = None
+                    for event, element in iterparse(source, events=("start", "end")):
+                        if event == "start":
+                            if element.tag == SHEET_DATA_TAG:
+                                sheet_data = element
+                            continue
+                        if element.tag != ROW_TAG:
+                            continue
+
+                        if is_header_row:
+                            is_header_row = False
+                            if header_row is None:
+                                for cell in element:
+                                    if get_sheet_cell_text(cell) == column_name:
+                                        split_column_letter = cell.get("r", "").rstrip("0123456789")
+                                        break
+                                if split_column_letter is None:
+                                    raise ValueError(f"Dataset '{name}' has no column '{column_name}' to split its rows")
+                                header_row = format_sheet_row(element, 1)
+                        else:
+                            value = ""
+                            for cell in element:
+                                if cell.get("r", "").rstrip("0123456789") == split_column_letter:
+                                    value = get_sheet_cell_text(cell) or ""
+                                    break
+                            split_sheet = split_sheets.get(value)
+                            if split_sheet is None:
+                                if len(split_sheets) == MAX_SPLIT_SHEETS:
+                                    raise ValueError(f"Column '{column_name}' of dataset '{name}' has more than {MAX_SPLIT_SHEETS} values, "
+                                                     f"too many sheets to split its rows")
+                                split_sheet = split_sheets[value] = SplitSheet(spill_file)
+                            split_sheet.add_row(format_sheet_row(element, split_sheet.get_next_row_index()))
+
+                        # Free the parsed rows
+                        element.clear()
+                        if sheet_data is not None:
+                            sheet_data.clear()
+
+        if not split_sheets:
+            logger.warning(f"Dataset '{name}' has no rows to split by column '{column_name}'")
+
+        sheet_start = f'<worksheet xmlns="{SHEET_MAIN_NS}"><sheetData>'.encode()
+        sheet_end = b'</sheetData></worksheet>'
+        split_workbook_file = temporary_storage.create_file()
+        split_datasets = {}
+        nb_sheets = 0
+        try:
+            with open_zip_file(split_workbook_file, 0) as split_archive:
+                for value, split_sheet in split_sheets.items():
+                    split_sheet.spill()
+                    entry_names = []
+                    for index_sheet in range(len(split_sheet.sheet_chunks)):
+                        nb_sheets += 1
+                        entry_names.append(get_temporary_sheet_entry_name(nb_sheets))
+                        with open_sheet_writer(split_archive, entry_names[-1]) as sheet_writer:
+                            sheet_writer.write(sheet_start)
+                            sheet_writer.write(header_row)
+                            split_sheet.write_rows(index_sheet, sheet_writer)
+                            sheet_writer.write(sheet_end)
+                    split_datasets[value] = ConvertedDataset(split_workbook_file, converted_dataset.column_widths,
+                                                             converted_dataset.local_style_ids, entry_names)
+        except Exception:
+            split_workbook_file.close()
+            raise
+
+    logger.info(f"Split the rows of dataset '{name}' into {len(split_datasets)} sheets")
+    return split_datasets
 
 
 def rename_too_long_dataset_names(input_dataset_names: List[str], dataset_to_sheet_mapping={}) -> Dict[str, str]:
@@ -202,168 +1265,880 @@ def rename_too_long_dataset_names(input_dataset_names: List[str], dataset_to_she
     return return_map
 
 
-def datasets_to_xlsx(input_dataset_names, xlsx_abs_path, worksheet_provider, dataset_to_sheet_mapping={}):
+class Exporter:
     """
-    Write each input dataset into one temporary excel file and merge all these excel files into the final excel file
-    :param input_dataset_names: the list of dataset, using one temporary workbook per dataset
-    :param xlsx_abs_path: the temporary path where to write the final excel file
-    :param worksheet_provider: a lambda used to get the dataset worksheet
+    Export session: the settings of the exports, their temporary storage and the styles their sheets start with.
+    An exporter runs any number of exports, one after the other or concurrently from several threads:
+    each export registers its styles into its own registry, copied from the registry of the exporter
     """
 
-    logger.info(f"Building output excel file '{xlsx_abs_path}'...")
+    def __init__(self, max_workers=1, compression_level=DEFAULT_COMPRESSION_LEVEL, sheet_cache: SheetCache = None,
+                 engine=ENGINE_OPENPYXL, width_strategy=WIDTH_STRATEGY_EXACT, width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE,
+                 temporary_storage: TemporaryStorage = None, style_registry: StyleRegistry = None, deflate_workers=1,
+                 memory_budget: MemoryBudget = None):
+        """
+        :param max_workers: number of worker processes converting the datasets in parallel, 1 to convert them sequentially
+        :param compression_level: compression level of the excel files,
+            0 to store their entries without compression, 1 (fastest) to 9 (smallest) to deflate them
+        :param sheet_cache: the cache of the converted sheets, to reuse the sheets of the unchanged datasets, None to convert all datasets
+        :param engine: ENGINE_OPENPYXL to copy the cells of the dataset worksheets,
+            ENGINE_XML to transcode the xml of the dataset worksheets loaded in read-only mode (faster, constant memory)
+        :param width_strategy: rows measured to compute the column widths: WIDTH_STRATEGY_EXACT for all rows,
+            WIDTH_STRATEGY_FIRST_ROWS for the first rows, WIDTH_STRATEGY_SAMPLE for a uniform sample of the rows
+        :param width_sample_size: number of rows measured, besides the header row, by the first rows and sample strategies
+        :param temporary_storage: the storage of the temporary workbooks, kept in memory when small enough,
+            None to write them on disk in the default temporary directory
+        :param style_registry: the styles each export starts with, for instance the registry of a previous related export
+            so that the excel files share their first style ids, None to start each export without style
+        :param deflate_workers: number of threads deflating the sheets of the excel files, 1 to deflate them in the exporting thread
+        :param memory_budget: the memory budget checked after the conversion of each dataset, None for no budget
+        """
+        assert_valid_compression_level(compression_level)
+        assert_valid_deflate_workers(deflate_workers)
+        assert_valid_engine(engine)
+        assert_valid_width_strategy(width_strategy, width_sample_size)
+        self.max_workers = max_workers
+        self.compression_level = compression_level
+        self.sheet_cache = sheet_cache
+        self.engine = engine
+        self.width_strategy = width_strategy
+        self.width_sample_size = width_sample_size
+        self.temporary_storage = temporary_storage or TemporaryStorage()
+        self.style_registry = style_registry or StyleRegistry()
+        self.deflate_workers = deflate_workers
+        self.memory_budget = memory_budget
+
+    def get_settings(self) -> Dict:
+        return {"max_workers": self.max_workers, "compression_level": self.compression_level, "engine": self.engine,
+                "width_strategy": self.width_strategy, "width_sample_size": self.width_sample_size,
+                "deflate_workers": self.deflate_workers}
+
+    def export(self, input_dataset_names, xlsx_abs_path, worksheet_provider, dataset_to_sheet_mapping={},
+               report: ExportReport = None) -> StyleRegistry:
+        """
+        Write each input dataset into one temporary excel file and merge all these excel files into the final excel file
+        :param input_dataset_names: the list of dataset, using one temporary workbook per dataset
+        :param xlsx_abs_path: the temporary path where to write the final excel file,
+            or a writable binary stream (not necessarily seekable, for instance a StreamUpload) to stream it without writing it on disk
+        :param worksheet_provider: a lambda used to get the dataset worksheet,
+            or the dataset rows (DatasetRows) to write the sheet directly without DSS styling
+        :param dataset_to_sheet_mapping: the sheet name of some datasets
+        :param report: the report to fill with the measures of the run, None if not needed
+        :return: the styles of the export, to warm-start the registry of a related export
+        """
+        logger.info(f"Building output excel file {xlsx_abs_path!r}...")
+        if report is None:
+            report = ExportReport()
+        report.settings.update(self.get_settings())
+        style_registry = self.style_registry.copy()
+
+        with measure_duration(report.phases, "conversion"):
+            template_workbook, temporary_sheets = get_temporary_workbooks(input_dataset_names, worksheet_provider, style_registry,
+                                                                          dataset_to_sheet_mapping=dataset_to_sheet_mapping,
+                                                                          max_workers=self.max_workers, report=report,
+                                                                          sheet_cache=self.sheet_cache, engine=self.engine,
+                                                                          width_strategy=self.width_strategy,
+                                                                          width_sample_size=self.width_sample_size,
+                                                                          temporary_storage=self.temporary_storage,
+                                                                          memory_budget=self.memory_budget)
+
+        with self.temporary_storage.create_file() as template_workbook_file:
+            # Save template workbook with styles
+            with measure_duration(report.phases, "template_save"):
+                style_ids = save_template_workbook(template_workbook, template_workbook_file, style_registry,
+                                                   self.compression_level)
+            report.phases["template_file_bytes"] = template_workbook_file.get_size()
+            report.phases["styles"] = len(style_registry)
+
+            # Build the final excel file from the template workbook and the temporary sheets
+            logger.info("Creating the final excel file...")
+            with measure_duration(report.phases, "assembly"):
+                assemble_workbook(template_workbook_file, temporary_sheets, style_ids, xlsx_abs_path, self.compression_level,
+                                  deflate_workers=self.deflate_workers)
+        report.output_bytes = get_output_size(xlsx_abs_path)
+        report.temporary_storage = self.temporary_storage.to_dict()
+        if self.memory_budget is not None:
+            report.memory_budget = self.memory_budget.to_dict()
+
+        print_cache(style_registry)
+
+        logger.info("Done writing output xlsx file.")
+        return style_registry
+
+    def export_workbooks(self, workbook_sheets: Dict[str, List[WorkbookSheet]], outputs: Dict, worksheet_provider,
+                         report: ExportReport = None, on_workbook_written=None) -> StyleRegistry:
+        """
+        Write several excel files from the same datasets: each dataset is converted once into a temporary workbook,
+        whose sheets are then written into every excel file referencing it.
+        A dataset split by a column is split once per column, whatever the number of excel files holding its sheets
+        :param workbook_sheets: the sheets of each excel file, by name of excel file
+        :param outputs: the path where to write each excel file, or a writable binary stream (see export), by name of excel file
+        :param worksheet_provider: a lambda used to get the dataset worksheet, or the dataset rows
+        :param report: the report to fill with the measures of the run, None if not needed
+        :param on_workbook_written: a lambda called with the name of each excel file once it is written,
+            for instance to complete its upload before the next excel files are written, None if not needed
+        :return: the styles of the export, shared by its excel files
+        """
+        missing_outputs = [workbook_name for workbook_name in workbook_sheets if workbook_name not in outputs]
+        if missing_outputs:
+            raise ValueError(f"No output for the workbooks {missing_outputs}")
+        if report is None:
+            report = ExportReport()
+        report.settings.update(self.get_settings(), workbooks=len(workbook_sheets))
+        style_registry = self.style_registry.copy()
+
+        # Each dataset is converted once, in the order of its first sheet
+        dataset_names = list(dict.fromkeys(sheet.dataset_name for sheets in workbook_sheets.values() for sheet in sheets))
+        logger.info(f"Converting {len(dataset_names)} datasets for {len(workbook_sheets)} excel files...")
+        with measure_duration(report.phases, "conversion"):
+            converted_datasets = convert_datasets(dataset_names, get_sheet_titles(dataset_names), worksheet_provider,
+                                                  style_registry, max_workers=self.max_workers, report=report,
+                                                  sheet_cache=self.sheet_cache, engine=self.engine,
+                                                  width_strategy=self.width_strategy, width_sample_size=self.width_sample_size,
+                                                  temporary_storage=self.temporary_storage, memory_budget=self.memory_budget)
+        split_datasets = {}
+        output_bytes = {}
+        try:
+            for workbook_name, sheets in workbook_sheets.items():
+                logger.info(f"Building output excel file '{workbook_name}'...")
+                template_workbook, temporary_sheets = get_workbook_template(workbook_name, sheets, converted_datasets,
+                                                                            split_datasets, report, self.temporary_storage)
+                with self.temporary_storage.create_file() as template_workbook_file:
+                    with measure_duration(report.phases, "template_save"):
+                        style_ids = save_template_workbook(template_workbook, template_workbook_file, style_registry,
+                                                           self.compression_level)
+                    # The temporary workbooks are shared by the excel files, they are closed once all are written
+                    with measure_duration(report.phases, "assembly"):
+                        assemble_workbook(template_workbook_file, temporary_sheets, style_ids, outputs[workbook_name],
+                                          self.compression_level, close_workbook_files=False,
+                                          deflate_workers=self.deflate_workers)
+                output_bytes[workbook_name] = get_output_size(outputs[workbook_name])
+                if on_workbook_written is not None:
+                    on_workbook_written(workbook_name)
+        finally:
+            workbook_files = [converted_dataset.workbook_file for converted_dataset in converted_datasets.values()]
+            workbook_files += [split_dataset.workbook_file for values in split_datasets.values() for split_dataset in values.values()]
+            for workbook_file in workbook_files:
+                workbook_file.close()
+        report.phases["styles"] = len(style_registry)
+        report.phases["output_bytes_by_workbook"] = output_bytes
+        if None not in output_bytes.values():
+            report.output_bytes = sum(output_bytes.values())
+        report.temporary_storage = self.temporary_storage.to_dict()
+        if self.memory_budget is not None:
+            report.memory_budget = self.memory_budget.to_dict()
+
+        print_cache(style_registry)
+
+        logger.info(f"Done writing {len(workbook_sheets)} output xlsx files.")
+        return style_registry
+
+
+def datasets_to_xlsx(input_dataset_names, xlsx_abs_path, worksheet_provider, dataset_to_sheet_mapping={}, max_workers=1,
+                     compression_level=DEFAULT_COMPRESSION_LEVEL, report: ExportReport = None, sheet_cache: SheetCache = None,
+                     engine=ENGINE_OPENPYXL, width_strategy=WIDTH_STRATEGY_EXACT, width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE,
+                     temporary_storage: TemporaryStorage = None, deflate_workers=1,
+                     memory_budget: MemoryBudget = None):
+    """
+    Write each input dataset into one temporary excel file and merge all these excel files into the final excel file
+    Run a single export with its own styles, see Exporter for the parameters
+    """
+    exporter = Exporter(max_workers=max_workers, compression_level=compression_level, sheet_cache=sheet_cache, engine=engine,
+                        width_strategy=width_strategy, width_sample_size=width_sample_size, temporary_storage=temporary_storage,
+                        deflate_workers=deflate_workers, memory_budget=memory_budget)
+    exporter.export(input_dataset_names, xlsx_abs_path, worksheet_provider, dataset_to_sheet_mapping=dataset_to_sheet_mapping,
+                    report=report)
+
+
+def datasets_to_xlsx_files(workbook_sheets: Dict[str, List[WorkbookSheet]], outputs: Dict, worksheet_provider, max_workers=1,
+                           compression_level=DEFAULT_COMPRESSION_LEVEL, report: ExportReport = None, sheet_cache: SheetCache = None,
+                           engine=ENGINE_OPENPYXL, width_strategy=WIDTH_STRATEGY_EXACT, width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE,
+                           temporary_storage: TemporaryStorage = None, deflate_workers=1,
+                           memory_budget: MemoryBudget = None, on_workbook_written=None):
+    """
+    Write several excel files from the same datasets, each dataset being converted once
+    Run a single export with its own styles, see Exporter and Exporter.export_workbooks for the parameters
+    """
+    exporter = Exporter(max_workers=max_workers, compression_level=compression_level, sheet_cache=sheet_cache, engine=engine,
+                        width_strategy=width_strategy, width_sample_size=width_sample_size, temporary_storage=temporary_storage,
+                        deflate_workers=deflate_workers, memory_budget=memory_budget)
+    exporter.export_workbooks(workbook_sheets, outputs, worksheet_provider, report=report, on_workbook_written=on_workbook_written)
 
-    template_workbook, workbook_tmp_files = get_temporary_workbooks(input_dataset_names, worksheet_provider, dataset_to_sheet_mapping=dataset_to_sheet_mapping)
 
-    # Save template workbook with styles and unzip it
-    template_workbook_extract_dir = get_template_workbook_directory(template_workbook)
+def get_workbook_template(workbook_name, workbook_sheets: List[WorkbookSheet], converted_datasets: Dict[str, ConvertedDataset],
+                          split_datasets: Dict, report: ExportReport, temporary_storage: TemporaryStorage):
+    """
+    Create the template workbook of one of the excel files written by datasets_to_xlsx_files
+    :param workbook_name: the name of the excel file
+    :param workbook_sheets: the sheets of the excel file
+    :param converted_datasets: the converted datasets by name
+    :param split_datasets: the split datasets by dataset name and split column, the missing ones being split and added
+    :param report: the report to fill with the duration of the splits
+    :param temporary_storage: the storage of the temporary workbooks of the splits
+    :return a template workbook containing styles and empty worksheets
+    :return a list of temporary sheets, shared with the other excel files
+    """
+    # Title of each sheet, whether it is named explicitly, and its converted dataset
+    titled_sheets = []
+    for sheet in workbook_sheets:
+        converted_dataset = converted_datasets.get(sheet.dataset_name)
+        if converted_dataset is None:
+            continue
+        title = sheet.sheet_name or sheet.dataset_name
+        if sheet.split_by is None:
+            titled_sheets.append((title, sheet.sheet_name is not None, sheet.dataset_name, converted_dataset))
+            continue
+        split_key = (sheet.dataset_name, sheet.split_by)
+        if split_key not in split_datasets:
+            with measure_duration(report.phases, "split"):
+                split_datasets[split_key] = split_converted_dataset(sheet.dataset_name, converted_dataset, sheet.split_by,
+                                                                    temporary_storage)
+        for value, split_dataset in split_datasets[split_key].items():
+            titled_sheets.append((get_split_sheet_title(title, value), False, sheet.dataset_name, split_dataset))
+
+    titles = [title for title, _, _, _ in titled_sheets]
+    duplicated_titles = sorted({title for title in titles if titles.count(title) > 1})
+    if duplicated_titles:
+        raise ValueError(f"Several sheets of workbook '{workbook_name}' are named {duplicated_titles}")
+    renaming_map = rename_too_long_dataset_names(titles, {title: title for title, explicit, _, _ in titled_sheets if explicit})
 
-    # Move sheets into template workbook directory
-    extract_and_move_temporary_worksheets_into_workbook_directory(workbook_tmp_files, template_workbook_extract_dir)
+    template_workbook = Workbook()
+    template_workbook.remove(template_workbook.active)
+    temporary_sheets = []
+    used_titles = set(renaming_map.values())
+    for title, _, dataset_name, converted_dataset in titled_sheets:
+        for temporary_sheet in converted_dataset.get_temporary_sheets(dataset_name, renaming_map[title], used_titles):
+            template_workbook.create_sheet(temporary_sheet.title)
+            temporary_sheets.append(temporary_sheet)
+    return template_workbook, temporary_sheets
 
-    # Build the final excel file
-    logger.info("Creating the final excel file...")
-    zip_directory(template_workbook_extract_dir.name, xlsx_abs_path)
 
-    print_cache()
+def get_sheet_titles(input_dataset_names, dataset_to_sheet_mapping={}) -> List[str]:
+    """
+    :param input_dataset_names: the list of datasets
+    :param dataset_to_sheet_mapping: the sheet name of some datasets
+    :return: the title of the sheet of each dataset, valid for excel, in the same order
+    """
+    renaming_map = rename_too_long_dataset_names(input_dataset_names, dataset_to_sheet_mapping=dataset_to_sheet_mapping)
 
-    logger.info("Done writing output xlsx file.")
+    sheet_titles = []
+    for name in input_dataset_names:
+        if name in renaming_map:
+            sheet_titles.append(renaming_map[name])
+        else:
+            # should never happen
+            logger.warning(f"Failed to find a name for the worksheet '{name}'")
+            sheet_titles.append(name)
+    return sheet_titles
 
 
-def get_temporary_workbooks(input_dataset_names, worksheet_provider, dataset_to_sheet_mapping={}):
+def get_temporary_workbooks(input_dataset_names, worksheet_provider, style_registry: StyleRegistry, dataset_to_sheet_mapping={}, max_workers=1,
+                            report: ExportReport = None, sheet_cache: SheetCache = None, engine=ENGINE_OPENPYXL,
+                            width_strategy=WIDTH_STRATEGY_EXACT, width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE,
+                            temporary_storage: TemporaryStorage = None, memory_budget: MemoryBudget = None):
     """
     Create a template workbook and one temporary workbook per dataset stored on disk
     :param input_dataset_names: the list of dataset, using one temporary workbook per dataset
     :param worksheet_provider: a lambda used to get the dataset worksheet
+    :param style_registry: the registry of the styles of the export, the styles of the sheets being added into it
+    :param max_workers: number of worker processes converting the datasets in parallel, 1 to convert them sequentially
+    :param report: the report to fill with the measures of each dataset, None if not needed
+    :param sheet_cache: the cache of the converted sheets: cached sheets are reused, converted sheets are stored into it
+    :param engine: ENGINE_OPENPYXL to copy the cells of the dataset worksheets, ENGINE_XML to transcode their xml
+    :param width_strategy: rows measured to compute the column widths (see Exporter)
+    :param width_sample_size: number of rows measured by the first rows and sample strategies
+    :param temporary_storage: the storage of the temporary workbooks, None to write them on disk in the default temporary directory
+    :param memory_budget: the memory budget checked after the conversion of each dataset, None for no budget
     :return a template workbook containing styles and empty workhsheets
-    :return a list of temporary workbook file names (one file per dataset)
+    :return a list of temporary sheets (one temporary workbook file per dataset)
     """
+    sheet_titles = get_sheet_titles(input_dataset_names, dataset_to_sheet_mapping)
+
+    converted_datasets = convert_datasets(input_dataset_names, sheet_titles, worksheet_provider, style_registry, max_workers=max_workers,
+                                          report=report, sheet_cache=sheet_cache, engine=engine,
+                                          width_strategy=width_strategy, width_sample_size=width_sample_size,
+                                          temporary_storage=temporary_storage, memory_budget=memory_budget)
+
     # A template workbook to store styles thanks to the cache
     template_workbook = Workbook()
     # remove the default sheet created
     template_workbook.remove(template_workbook.active)
 
-    # List containing all temporary workbooks generated from dataset
-    workbook_tmp_files = []
+    # List containing all temporary sheets generated from dataset
+    temporary_sheets = []
+    used_titles = set(sheet_titles)
+    for name, title in zip(input_dataset_names, sheet_titles):
+        converted_dataset = converted_datasets.get(name)
+        if converted_dataset is None:
+            continue
+        for temporary_sheet in converted_dataset.get_temporary_sheets(name, title, used_titles):
+            # Add an empty sheet in the template just to have the name of the dataset
+            # This sheet will be replaced while assembling the final excel file
+            template_workbook.create_sheet(temporary_sheet.title)
+            temporary_sheets.append(temporary_sheet)
 
-    renaming_map = rename_too_long_dataset_names(input_dataset_names, dataset_to_sheet_mapping=dataset_to_sheet_mapping)
+    return template_workbook, temporary_sheets
 
-    for name in input_dataset_names:
+
+def convert_datasets(input_dataset_names, sheet_titles, worksheet_provider, style_registry: StyleRegistry, max_workers=1,
+                     report: ExportReport = None,
+                     sheet_cache: SheetCache = None, engine=ENGINE_OPENPYXL, width_strategy=WIDTH_STRATEGY_EXACT,
+                     width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE, temporary_storage: TemporaryStorage = None,
+                     memory_budget: MemoryBudget = None) -> Dict[str, ConvertedDataset]:
+    """
+    Convert each dataset into a temporary workbook stored on disk, or reuse its sheet from the sheet cache
+    :param input_dataset_names: the list of dataset, using one temporary workbook per dataset
+    :param sheet_titles: the title of the sheet of each dataset
+    :param worksheet_provider: a lambda used to get the dataset worksheet
+    :param style_registry: the registry of the styles of the export, the styles of the sheets being added into it
+    :param max_workers: number of worker processes converting the datasets in parallel, 1 to convert them sequentially
+    :param report: the report to fill with the measures of each dataset, None if not needed
+    :param sheet_cache: the cache of the converted sheets: cached sheets are reused, converted sheets are stored into it
+    :param engine: ENGINE_OPENPYXL to copy the cells of the dataset worksheets, ENGINE_XML to transcode their xml
+    :param width_strategy: rows measured to compute the column widths (see Exporter)
+    :param width_sample_size: number of rows measured by the first rows and sample strategies
+    :param temporary_storage: the storage of the temporary workbooks, None to write them on disk in the default temporary directory.
+        The worker processes write their temporary workbooks on disk, by their paths
+    :param memory_budget: the memory budget checked after the conversion of each dataset, None for no budget
+    :return the converted datasets by name, in the order of the input datasets, without the datasets with no worksheet
+    """
+    if report is None:
+        report = ExportReport()
+    if temporary_storage is None:
+        temporary_storage = TemporaryStorage()
+
+    # Sheets of the unchanged datasets found in the cache, and keys of the sheets to store into it once converted
+    cached_sheets = {}
+    sheet_keys = {}
+    if sheet_cache is not None:
+        for name, title in zip(input_dataset_names, sheet_titles):
+            key = sheet_cache.get_key(name, title)
+            cached_sheet = None if key is None else sheet_cache.load(key)
+            if cached_sheet is None:
+                sheet_keys[name] = key
+            else:
+                logger.info(f"Dataset '{name}' is unchanged, reusing its cached sheet")
+                cached_sheets[name] = cached_sheet
+
+    names_to_convert = [name for name in input_dataset_names if name not in cached_sheets]
+    titles_to_convert = [title for name, title in zip(input_dataset_names, sheet_titles) if name not in cached_sheets]
+    parallel = max_workers > 1 and len(names_to_convert) > 1
+    temporary_workbook_files = [temporary_storage.create_file(on_disk=parallel) for _ in names_to_convert]
+    if parallel:
+        conversions = convert_datasets_in_worker_processes(names_to_convert, titles_to_convert, worksheet_provider,
+                                                           temporary_workbook_files, max_workers, report, engine,
+                                                           width_strategy, width_sample_size, memory_budget)
+    else:
+        conversions = (convert_dataset_to_temporary_workbook(name, title, worksheet_provider, temporary_workbook_file,
+                                                             report.get_dataset_measures(name), engine,
+                                                             width_strategy, width_sample_size, memory_budget)
+                       for name, title, temporary_workbook_file in zip(names_to_convert, titles_to_convert, temporary_workbook_files))
+    conversions = zip(temporary_workbook_files, conversions)
+
+    converted_datasets = {}
+    for name, title in zip(input_dataset_names, sheet_titles):
+        cached_sheet = cached_sheets.get(name)
+        if cached_sheet is not None:
+            # Closing the cached workbook after the assembly does not delete it
+            temporary_workbook_file = open(cached_sheet.workbook_path, "rb")
+            column_widths, nb_sheets = cached_sheet.column_widths, cached_sheet.nb_sheets
+            local_style_ids = {style_id: StyleCached.from_dict(style) for style_id, style in cached_sheet.local_style_ids.items()}
+            report.get_dataset_measures(name).update(sheet=title, sheets=nb_sheets, sheet_cache="hit")
+        else:
+            temporary_workbook_file, conversion = next(conversions)
+            if memory_budget is not None:
+                memory_budget.check(f"converting dataset '{name}'")
+            if conversion is None:
+                temporary_workbook_file.close()
+                continue
+            column_widths, local_style_ids, nb_sheets = conversion
+            if sheet_keys.get(name) is not None:
+                # Stored as soon as converted, so that a failing export resumes from the sheets already converted
+                sheet_cache.store(sheet_keys[name], temporary_workbook_file, column_widths,
+                                  {style_id: cache.to_dict() for style_id, cache in local_style_ids.items()}, nb_sheets)
+                report.get_dataset_measures(name)["sheet_cache"] = "stored"
+
+        # The styles of the sheet become styles of the export (they may come from a worker process or the sheet cache),
+        # their ids are remapped while assembling the final excel file
+        local_style_ids = {style_id: style_registry.add(cache) for style_id, cache in local_style_ids.items()}
+        entry_names = [get_temporary_sheet_entry_name(index_sheet) for index_sheet in range(1, nb_sheets + 1)]
+        converted_datasets[name] = ConvertedDataset(temporary_workbook_file, column_widths, local_style_ids, entry_names)
+
+    return converted_datasets
+
+
+def convert_dataset_to_temporary_workbook(name, title, worksheet_provider, temporary_workbook, measures: Dict = None,
+                                          engine=ENGINE_OPENPYXL, width_strategy=WIDTH_STRATEGY_EXACT,
+                                          width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE, memory_budget: MemoryBudget = None):
+    """
+    Copy a dataset worksheet into a temporary workbook saved on disk in order to avoid out of memory
+    :param name: the name of the dataset
+    :param title: the title of the sheet
+    :param worksheet_provider: a lambda used to get the dataset worksheet, or the dataset rows
+    :param temporary_workbook: the path or the binary file where to save the temporary workbook
+    :param measures: the measures of the dataset to update, None to skip them
+    :param engine: ENGINE_OPENPYXL to copy the cells of the dataset worksheet,
+        ENGINE_XML to transcode its xml when it is loaded in read-only mode
+    :param width_strategy: rows measured to compute the column widths (see Exporter)
+    :param width_sample_size: number of rows measured by the first rows and sample strategies
+    :param memory_budget: the memory budget checked while the rows are converted, None for no budget
+    :return the column widths of the temporary sheet
+    :return the cached style of each style id of the temporary sheet, these ids being local to the temporary workbook
+    :return the number of sheets of the dataset, more than 1 when its rows exceed the excel limit
+    :return None if no worksheet is provided
+    """
+    with measure_duration(measures, "provider"):
         dataset_worksheet = worksheet_provider(name)
-        if dataset_worksheet is None:
+    if dataset_worksheet is None:
+        return None
+
+    if isinstance(dataset_worksheet, DatasetRows):
+        logger.info(f"Writing dataset '{name}' rows into temporary sheet '{title}'...")
+        with measure_duration(measures, "copy"):
+            column_widths, style_ids, nb_sheets = write_dataset_rows(dataset_worksheet, temporary_workbook, measures,
+                                                                     ColumnWidthAccumulator(width_strategy, width_sample_size),
+                                                                     memory_budget, title)
+        add_temporary_workbook_measures(measures, title, temporary_workbook, nb_sheets)
+        logger.info(f"Finished writing dataset '{name}' temporary sheet.")
+        return column_widths, style_ids, nb_sheets
+
+    dataset_worksheet.title = title
+
+    if engine == ENGINE_XML and isinstance(dataset_worksheet, ReadOnlyWorksheet):
+        with measure_duration(measures, "copy"):
+            column_widths, style_ids, nb_sheets = transcode_sheet_xml(dataset_worksheet, temporary_workbook, measures,
+                                                                      ColumnWidthAccumulator(width_strategy, width_sample_size),
+                                                                      memory_budget=memory_budget)
+        add_temporary_workbook_measures(measures, title, temporary_workbook, nb_sheets)
+        dataset_worksheet.parent.close()
+        logger.info(f"Finished transcoding dataset '{name}' temporary sheet.")
+        return column_widths, style_ids, nb_sheets
+
+    logger.info(f"Creating dataset '{name}' temporary workbook...")
+    temp_workbook = Workbook(write_only=True)
+    try:
+        with measure_duration(measures, "copy"):
+            temp_sheets, column_widths, style_ids = copy_sheet_to_workbook(dataset_worksheet, temp_workbook, measures,
+                                                                           ColumnWidthAccumulator(width_strategy, width_sample_size),
+                                                                           memory_budget=memory_budget)
+    except BaseException:
+        # The copy was aborted (memory budget exceeded, invalid value...): leave no half-open sheet writer
+        discard_write_only_workbook(temp_workbook)
+        raise
+    logger.info(f"Styling excel sheet '{title}' in temporary worksheet...")
+
+    # The sheet is rewritten when moved into the final excel file, store it uncompressed so that it is compressed only once
+    with measure_duration(measures, "temporary_save"):
+        save_workbook(temp_workbook, temporary_workbook, compression_level=0)
+    nb_sheets = len(temp_sheets)
+    add_temporary_workbook_measures(measures, title, temporary_workbook, nb_sheets)
+    # Free memory
+    del temp_sheets
+    temp_workbook.close()
+    # Close the dataset workbook: read-only workbooks keep their archive open
+    dataset_worksheet.parent.close()
+    del dataset_worksheet
+
+    logger.info(f"Finished writing dataset '{name}' temporary workbook.")
+
+    return column_widths, style_ids, nb_sheets
+
+
+def discard_write_only_workbook(workbook: Workbook):
+    """
+    Close the sheets of a write-only workbook that will not be saved, and delete the temporary files of their writers
+    """
+    for worksheet in workbook.worksheets:
+        if worksheet.closed:
             continue
+        try:
+            worksheet.close()
+            if worksheet._writer is not None:
+                worksheet._writer.cleanup()
+        except Exception as error:
+            logger.warning(f"Failed to discard the temporary sheet '{worksheet.title}': {error}")
+
+
+def add_temporary_workbook_measures(measures: Dict, title: str, temporary_workbook: Union[str, io.RawIOBase], nb_sheets: int):
+    if measures is not None:
+        measures["sheet"] = title
+        measures["sheets"] = nb_sheets
+        measures["temporary_file_bytes"] = get_output_size(temporary_workbook)
+        # Peak memory of the process converting the dataset, so far
+        measures["peak_rss_bytes"] = get_peak_rss_bytes()
+
+
+# Worksheet provider, report and memory budget of the worker processes, set by init_worker_process
+worker_worksheet_provider = None
+worker_report = None
+worker_memory_budget = None
 
-        if name in renaming_map:
-            dataset_worksheet.title = renaming_map[name]
-        else:
-            # should never happen
-            logger.warning(f"Failed to find a name for the worksheet '{name}'")
-            dataset_worksheet.title = name
 
-        # Add an empty sheet in the template just to have the name of the dataset
-        # This sheet will be replaced during the moving step
-        template_workbook.create_sheet(dataset_worksheet.title)
+def init_worker_process(worksheet_provider, report: ExportReport, memory_budget: MemoryBudget = None):
+    # Set in the worker process only: exports running concurrently in threads of the parent process each have their own workers
+    global worker_worksheet_provider, worker_report, worker_memory_budget
+    worker_worksheet_provider = worksheet_provider
+    worker_report = report
+    worker_memory_budget = memory_budget
 
-        # Create a temporary workbook to save it on disk in order to avoid out of memory
-        logger.info(f"Creating dataset '{name}' temporary workbook...")
-        temp_workbook = Workbook(write_only=True)
-        # Add previous styles in the default sheet (sheet1.xml) to keep indexes for the final excel file
-        style_sheet = temp_workbook.create_sheet("styles")
-        add_styles_to_worksheet_write_only(style_sheet)
-        temp_sheet = copy_sheet_to_workbook(dataset_worksheet, temp_workbook)
-        logger.info(f"Styling excel sheet '{temp_sheet.title}' in temporary worksheet...")
 
-        workbook_tmp_files.append(tempfile.NamedTemporaryFile())
-        temp_workbook.save(workbook_tmp_files[-1].name)
-        # Free memory
-        del temp_sheet
-        temp_workbook.close()
-        del dataset_worksheet
+def convert_dataset_in_worker_process(name, title, temporary_workbook_path, engine, width_strategy, width_sample_size):
+    # The report is a copy of the report of the parent process: the measures of the dataset are sent back with the conversion
+    measures = worker_report.get_dataset_measures(name)
+    return convert_dataset_to_temporary_workbook(name, title, worker_worksheet_provider, temporary_workbook_path, measures,
+                                                 engine, width_strategy, width_sample_size, worker_memory_budget), measures
 
-        logger.info(f"Finished writing dataset '{name}' temporary workbook.")
 
-    return template_workbook, workbook_tmp_files
+def convert_datasets_in_worker_processes(input_dataset_names, sheet_titles, worksheet_provider, temporary_workbook_files, max_workers,
+                                         report: ExportReport, engine=ENGINE_OPENPYXL, width_strategy=WIDTH_STRATEGY_EXACT,
+                                         width_sample_size=DEFAULT_WIDTH_SAMPLE_SIZE, memory_budget: MemoryBudget = None):
+    """
+    Convert the datasets into temporary workbooks in a pool of worker processes
+    Worker processes are forked, so that they inherit the worksheet provider (usually a lambda, that cannot be pickled)
+    :param report: the report to fill with the measures of each dataset taken in the worker processes
+    :param memory_budget: the memory budget checked by the worker processes while they convert the rows, None for no budget
+    :return the conversion of each dataset, yielded in the order of the input datasets as soon as it is available
+    """
+    max_workers = min(max_workers, len(input_dataset_names))
+    logger.info(f"Converting {len(input_dataset_names)} datasets with {max_workers} worker processes...")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"),
+                             initializer=init_worker_process, initargs=(worksheet_provider, report, memory_budget)) as executor:
+        futures = [executor.submit(convert_dataset_in_worker_process, name, title, temporary_workbook_file.name, engine,
+                                   width_strategy, width_sample_size)
+                   for name, title, temporary_workbook_file in zip(input_dataset_names, sheet_titles, temporary_workbook_files)]
+        for name, future in zip(input_dataset_names, futures):
+            conversion, measures = future.result()
+            report.add_dataset_measures(name, measures)
+            yield conversion
+
+
+def open_zip_file(path: Union[str, io.RawIOBase], compression_level: int) -> zipfile.ZipFile:
+    """
+    Open an archive for writing with the given compression level
+    :param path: the path of the archive, or a writable binary stream
+        (entries are then followed by data descriptors if the stream cannot seek)
+    :param compression_level: 0 to store the entries without compression, 1 (fastest) to 9 (smallest) to deflate them
+    """
+    assert_valid_compression_level(compression_level)
+    if compression_level == 0:
+        return zipfile.ZipFile(path, 'w', ZIP_STORED, allowZip64=True)
+    return zipfile.ZipFile(path, 'w', ZIP_DEFLATED, allowZip64=True, compresslevel=compression_level)
 
 
-def get_template_workbook_directory(template_workbook):
+def save_workbook(workbook: Workbook, path: Union[str, io.RawIOBase], compression_level: int = DEFAULT_COMPRESSION_LEVEL):
     """
-    Save the template workbook with styles and unzip it into a temporary directory
-    :param template_workbook: the template workbook to save and extract into a temporary directory
-    :return a temporary directory
+    Save a workbook like Workbook.save, choosing the compression level of its archive
+    :param workbook: the workbook to save
+    :param path: the path or the binary file where to save the workbook
+    :param compression_level: 0 to store the entries without compression, 1 (fastest) to 9 (smallest) to deflate them
     """
-    template_workbook_extract_dir = tempfile.TemporaryDirectory()
-    with tempfile.NamedTemporaryFile() as template_workbook_file:
-        # Add styles to template workbook before saving it
-        if template_workbook.worksheets:
-            add_styles_to_worksheet(template_workbook.worksheets[0])
+    ExcelWriter(workbook, open_zip_file(path, compression_level)).save()
 
-        template_workbook.save(template_workbook_file.name)
-        template_workbook.close()
 
-        logger.info("Extracting template workbook...")
-        with zipfile.ZipFile(template_workbook_file.name, mode="r") as zipFile:
-            zipFile.extractall(path=template_workbook_extract_dir.name)
+def save_template_workbook(template_workbook, template_workbook_file, style_registry: StyleRegistry,
+                           compression_level=DEFAULT_COMPRESSION_LEVEL):
+    """
+    Save the template workbook with the styles of a registry, its sheets being empty
+    Its entries are copied as is into the final excel file, so they are compressed with the final compression level
+    :param template_workbook: the template workbook to save
+    :param template_workbook_file: the path or the binary file where to save the template workbook
+    :param style_registry: the styles of the sheets
+    :param compression_level: 0 to store the entries without compression, 1 (fastest) to 9 (smallest) to deflate them
+    :return the style id of each cached style in the template workbook
+    """
+    style_ids = {}
+    # Add styles to template workbook before saving it
+    if template_workbook.worksheets:
+        style_ids = add_styles_to_workbook(template_workbook, style_registry)
 
-    return template_workbook_extract_dir
+    save_workbook(template_workbook, template_workbook_file, compression_level)
+    template_workbook.close()
+    return style_ids
 
 
-def extract_and_move_temporary_worksheets_into_workbook_directory(workbook_tmp_files, template_workbook_extract_dir):
+def get_output_size(output) -> Union[int, None]:
     """
-    Extract and move temporary worksheets into a workbook directory
-    :param workbook_tmp_files: list of temporary files to extract and move
-    :param template_workbook_extract_dir: the workbook directory
+    :param output: the path of a written file, or a written stream
+    :return: the size of the file, or the position of the stream, None if the stream cannot tell it
     """
-    logger.info("Extracting and moving temporary sheets...")
+    if isinstance(output, (str, os.PathLike)):
+        return os.path.getsize(output)
+    try:
+        return output.tell()
+    except (AttributeError, OSError):
+        return None
 
-    # Extract the sheet2.xml only because sheet1.xml is just for keeping style indexes
-    sheet_name_to_extract_and_move = "xl/worksheets/sheet2.xml"
-    for idx, file in enumerate(workbook_tmp_files, 1):
-        extract_sheet_dir = tempfile.TemporaryDirectory()
-        with zipfile.ZipFile(file.name, mode="r") as zipFile:
-            zipFile.extract(sheet_name_to_extract_and_move, path=extract_sheet_dir.name)
-        file.close()  # Close file to free space disk now
 
-        # Move file
-        file_source = os.path.join(extract_sheet_dir.name, sheet_name_to_extract_and_move)
-        file_dest = os.path.join(template_workbook_extract_dir.name, "xl/worksheets/sheet{id}.xml".format(id=idx))
-        os.replace(file_source, file_dest)
+def deflate_block(block: bytes, dictionary: bytes, compression_level: int, last: bool) -> bytes:
+    """
+    Deflate a block of an entry, zlib releasing the GIL while it compresses
+    :param block: the uncompressed block
+    :param dictionary: the end of the previous block, empty for the first block
+    :param compression_level: 1 (fastest) to 9 (smallest)
+    :param last: whether the block is the last one of the entry, ending the deflate stream
+    :return: raw deflate data, ending on a byte boundary when more blocks follow so that blocks can be concatenated
+    """
+    if dictionary:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
 
 
-def zip_directory(dir_name, output_path_file_name):
+class ParallelDeflater:
+    """
+    Compressor of an archive entry deflating its blocks in a thread pool, used in place of the zlib compressor
+    of a ZipFile entry open for writing: ZipFile still computes the CRC and the sizes of the entry and writes its headers.
+    The compressed blocks are returned in order, at most 2 blocks per thread being buffered
+    The compressor is a private attribute of the entry, see PARALLEL_DEFLATE_SUPPORTED
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, compression_level: int, deflate_workers: int):
+        self.executor = executor
+        self.compression_level = compression_level
+        self.max_pending_blocks = 2 * deflate_workers
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.pending_blocks = deque()
+
+    def submit_block(self, block: bytes, last: bool):
+        self.pending_blocks.append(self.executor.submit(deflate_block, block, self.dictionary, self.compression_level, last))
+        self.dictionary = block[-DEFLATE_WINDOW_SIZE:]
+
+    def compress(self, data: bytes) -> bytes:
+        self.buffer += data
+        while len(self.buffer) >= DEFLATE_BLOCK_SIZE:
+            block = bytes(self.buffer[:DEFLATE_BLOCK_SIZE])
+            del self.buffer[:DEFLATE_BLOCK_SIZE]
+            self.submit_block(block, False)
+        compressed = []
+        # Wait for the oldest blocks while too many are pending, return the ones already deflated
+        while self.pending_blocks and (len(self.pending_blocks) > self.max_pending_blocks or self.pending_blocks[0].done()):
+            compressed.append(self.pending_blocks.popleft().result())
+        return b"".join(compressed)
+
+    def flush(self) -> bytes:
+        self.submit_block(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        compressed = [block.result() for block in self.pending_blocks]
+        self.pending_blocks.clear()
+        return b"".join(compressed)
+
+
+class CompressorProbe:
     """
-    Zip a directory into an archive
-    :param dir_name: the directory to zip
-    :param output_path_file_name: the path file name of the archive
+    Compressor recording its calls, to check that a ZipFile entry writes its data through a replaced compressor
     """
-    with zipfile.ZipFile(output_path_file_name, 'w', ZIP_DEFLATED, allowZip64=True) as archive:
-        for root, dirs, files in os.walk(dir_name):
-            for file in files:
-                archive.write(os.path.join(root, file),
-                              os.path.relpath(os.path.join(root, file), os.path.join(dir_name, '.')))
 
+    def __init__(self):
+        self.calls = []
 
-def print_cache():
+    def compress(self, data: bytes) -> bytes:
+        self.calls.append("compress")
+        return data
+
+    def flush(self) -> bytes:
+        self.calls.append("flush")
+        return b""
+
+
+def is_entry_compressor_replaceable() -> bool:
     """
-    Print the counts of each style of the cache
+    :return: whether the entries of ZipFile open for writing compress their data with their private _compressor attribute,
+        which the parallel deflate replaces
     """
-    fonts = []
-    borders = []
-    fills = []
-    number_formats = []
-    alignments = []
+    probe = CompressorProbe()
+    try:
+        with zipfile.ZipFile(io.BytesIO(), "w", ZIP_DEFLATED) as archive, archive.open("probe", "w") as entry:
+            if not hasattr(entry, "_compressor"):
+                return False
+            entry._compressor = probe
+            entry.write(b"probe")
+    except (AttributeError, TypeError, zipfile.BadZipFile):
+        return False
+    return probe.calls == ["compress", "flush"]
+
+
+# Checked once: without it the sheets are deflated serially by the compressor of the archive
+PARALLEL_DEFLATE_SUPPORTED = is_entry_compressor_replaceable()
+
 
-    def add_style_if_not_exist(style, list):
-        if list:
-            for s in list:
-                if s == style:
-                    return
-        list.append(style)
+def open_entry_for_writing(archive, entry_name: str, deflater: ParallelDeflater = None):
+    """
+    Open an archive entry for writing, its size not being known in advance so that it can exceed the ZIP64 limit
+    :param archive: the archive to write, open for writing
+    :param entry_name: the name of the entry
+    :param deflater: the compressor deflating the entry in a thread pool, None to deflate it with the compressor of the archive,
+        ignored when the compressor of the entry cannot be replaced
+    :return: the entry, a writable binary file to close
+    """
+    target = archive.open(entry_name, 'w', force_zip64=True)
+    if deflater is not None and PARALLEL_DEFLATE_SUPPORTED:
+        # Nothing is written before the first write, the compressor of the entry can still be replaced
+        target._compressor = deflater
+    return target
 
-    for cache in style_cache:
-        add_style_if_not_exist(cache.font, fonts)
-        add_style_if_not_exist(cache.border, borders)
-        add_style_if_not_exist(cache.fill, fills)
-        add_style_if_not_exist(cache.alignment, alignments)
-        add_style_if_not_exist(cache.number_format, number_formats)
+
+def assemble_workbook(template_workbook_file, temporary_sheets, style_ids, output_path_file_name, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                      close_workbook_files=True, deflate_workers=1):
+    """
+    Build the final excel file by streaming the entries of the template workbook into it,
+    its empty sheets being replaced by the temporary sheets
+    :param template_workbook_file: the path or the binary file of the template workbook
+    :param temporary_sheets: list of temporary sheets, in the order of the sheets of the template workbook
+    :param style_ids: the style id of each cached style in the template workbook
+    :param output_path_file_name: the path file name of the final excel file, or a writable binary stream
+    :param compression_level: 0 to store the sheets without compression, 1 (fastest) to 9 (smallest) to deflate them
+    :param close_workbook_files: whether each temporary workbook is closed once its sheets are written,
+        False when they are also written into other excel files
+    :param deflate_workers: number of threads deflating the blocks of each sheet, 1 to deflate the sheets in the current thread
+    """
+    assert_valid_deflate_workers(deflate_workers)
+    temporary_sheets_by_entry_name = {
+        "xl/worksheets/sheet{id}.xml".format(id=idx): temporary_sheet for idx, temporary_sheet in enumerate(temporary_sheets, 1)
+    }
+    # Continuation sheets share the temporary workbook of their dataset, closed once its last sheet is written
+    last_sheet_by_workbook_file = {id(temporary_sheet.workbook_file): temporary_sheet for temporary_sheet in temporary_sheets}
+    # Only the sheets are deflated by the threads, the other entries are copied as is from the template workbook
+    deflate_executor = None
+    if deflate_workers > 1 and compression_level > 0 and not PARALLEL_DEFLATE_SUPPORTED:
+        logger.warning(f"Parallel deflate not supported by the zipfile module of this python version, "
+                       f"deflating the sheets in the current thread instead of {deflate_workers} threads")
+    elif deflate_workers > 1 and compression_level > 0:
+        deflate_executor = ThreadPoolExecutor(max_workers=deflate_workers, thread_name_prefix="deflate")
+    try:
+        with zipfile.ZipFile(template_workbook_file, mode="r") as template_archive, \
+                open_zip_file(output_path_file_name, compression_level) as archive:
+            for entry in template_archive.infolist():
+                temporary_sheet = temporary_sheets_by_entry_name.get(entry.filename)
+                if temporary_sheet is None:
+                    copy_zip_entry(template_archive, entry, archive)
+                else:
+                    deflater = None
+                    if deflate_executor is not None:
+                        deflater = ParallelDeflater(deflate_executor, compression_level, deflate_workers)
+                    write_temporary_sheet(temporary_sheet, entry, archive, style_ids, deflater)
+                    if close_workbook_files and last_sheet_by_workbook_file[id(temporary_sheet.workbook_file)] is temporary_sheet:
+                        temporary_sheet.workbook_file.close()  # Close file to free space disk now
+    finally:
+        if deflate_executor is not None:
+            deflate_executor.shutdown(wait=True)
+
+
+def write_temporary_sheet(temporary_sheet, entry, archive, style_ids, deflater: ParallelDeflater = None):
+    """
+    Write a temporary sheet into an archive, in place of the given entry of the template workbook
+    :param temporary_sheet: the temporary sheet to write
+    :param entry: the template workbook entry replaced by the temporary sheet
+    :param archive: the archive of the final excel file
+    :param style_ids: the style id of each cached style in the template workbook
+    :param deflater: the compressor deflating the sheet in a thread pool, None to deflate it with the compressor of the archive
+    """
+    style_ids_mapping = {style_id: style_ids[cache] for style_id, cache in temporary_sheet.local_style_ids.items()}
+
+    with zipfile.ZipFile(temporary_sheet.workbook_file, mode="r") as temporary_archive:
+        with temporary_archive.open(temporary_sheet.entry_name) as source, \
+                open_entry_for_writing(archive, entry.filename, deflater) as target:
+            copy_sheet_xml(source, target, temporary_sheet.column_widths, style_ids_mapping)
+
+
+def copy_zip_entry(source_archive, entry, target_archive):
+    """
+    Copy an archive entry into another archive as is, without decompressing and compressing again its data,
+    or by reading and writing it again where the zipfile module does not allow the raw copy (see RAW_ENTRY_COPY_SUPPORTED)
+    :param source_archive: the archive containing the entry, open for reading
+    :param entry: the ZipInfo of the entry to copy
+    :param target_archive: the archive to write, open for writing
+    """
+    if RAW_ENTRY_COPY_SUPPORTED:
+        copy_raw_zip_entry(source_archive, entry, target_archive)
+        return
+    target_entry = zipfile.ZipInfo(entry.filename, date_time=entry.date_time)
+    target_entry.compress_type = entry.compress_type
+    target_entry.external_attr = entry.external_attr
+    target_archive.writestr(target_entry, source_archive.read(entry))
+
+
+def copy_raw_zip_entry(source_archive, entry, target_archive):
+    """
+    Copy the raw data of an archive entry into another archive, using the private internals of the zipfile module
+    """
+    if target_archive._writing:
+        raise ValueError(f"Can't copy the entry '{entry.filename}' while an entry of the target archive is open for writing")
+    # The data of the entry follows its local file header, made of fixed fields then the file name and the extra field
+    source_archive.fp.seek(entry.header_offset)
+    local_file_header = struct.unpack(zipfile.structFileHeader, source_archive.fp.read(zipfile.sizeFileHeader))
+    source_archive.fp.seek(local_file_header[zipfile._FH_FILENAME_LENGTH] + local_file_header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    target_entry = zipfile.ZipInfo(entry.filename, date_time=entry.date_time)
+    target_entry.compress_type = entry.compress_type
+    target_entry.external_attr = entry.external_attr
+    target_entry.CRC = entry.CRC
+    target_entry.compress_size = entry.compress_size
+    target_entry.file_size = entry.file_size
+    target_entry.header_offset = target_archive.fp.tell()
+
+    target_archive.fp.write(target_entry.FileHeader())
+    remaining_size = entry.compress_size
+    while remaining_size > 0:
+        chunk = source_archive.fp.read(min(COPY_CHUNK_SIZE, remaining_size))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for the entry '{entry.filename}'")
+        target_archive.fp.write(chunk)
+        remaining_size -= len(chunk)
+
+    # Register the entry as ZipFile.write does, so that it is part of the central directory
+    target_archive.filelist.append(target_entry)
+    target_archive.NameToInfo[target_entry.filename] = target_entry
+    target_archive.start_dir = target_archive.fp.tell()
+    target_archive._didModify = True
+
+
+def is_raw_entry_copy_supported() -> bool:
+    """
+    :return: whether the private internals of the zipfile module used by copy_raw_zip_entry exist and behave as expected,
+        checked by copying the entries of a probe archive
+    """
+    if not all(hasattr(zipfile, name) for name in ["structFileHeader", "sizeFileHeader", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH"]):
+        return False
+    entries = {"deflated.xml": b"<probe>" + b"deflated " * 100 + b"</probe>", "stored.txt": b"stored"}
+    source = io.BytesIO()
+    target = io.BytesIO()
+    try:
+        with zipfile.ZipFile(source, "w") as source_archive:
+            source_archive.writestr("deflated.xml", entries["deflated.xml"], compress_type=ZIP_DEFLATED)
+            source_archive.writestr("stored.txt", entries["stored.txt"], compress_type=ZIP_STORED)
+        with zipfile.ZipFile(source) as source_archive, zipfile.ZipFile(target, "w") as target_archive:
+            if not all(hasattr(target_archive, name) for name in ["fp", "start_dir", "_didModify", "_writing"]):
+                return False
+            for entry in source_archive.infolist():
+                copy_raw_zip_entry(source_archive, entry, target_archive)
+        with zipfile.ZipFile(target) as target_archive:
+            return target_archive.testzip() is None and {name: target_archive.read(name) for name in target_archive.namelist()} == entries
+    except (AttributeError, TypeError, IndexError, struct.error, zipfile.BadZipFile):
+        return False
+
+
+# Checked once: without it the entries of the template workbook are decompressed and compressed again
+RAW_ENTRY_COPY_SUPPORTED = is_raw_entry_copy_supported()
+
+
+def print_cache(style_registry: StyleRegistry):
+    """
+    Print the counts of each style of a registry
+    """
+    fonts = set()
+    borders = set()
+    fills = set()
+    number_formats = set()
+    alignments = set()
+
+    for cache in style_registry:
+        fonts.add(cache.font)
+        borders.add(cache.border)
+        fills.add(cache.fill)
+        alignments.add(cache.alignment)
+        number_formats.add(cache.number_format)
 
     logger.info("Style counts (fonts: {}; borders: {}; fills: {}; alignments: {}; number_formats: {})".format(len(fonts),
                                                                                                               len(borders),
@@ -372,6 +2147,29 @@ def print_cache():
                                                                                                               len(number_formats)))
 
 
+def assert_valid_compression_level(compression_level):
+    if compression_level not in range(0, 10):
+        raise ValueError("Invalid compression level {}, expecting 0 (no compression) to 9".format(compression_level))
+
+
+def assert_valid_deflate_workers(deflate_workers):
+    if deflate_workers < 1:
+        raise ValueError("Invalid number of deflate workers {}, expecting 1 (no thread) or more".format(deflate_workers))
+
+
+def assert_valid_engine(engine):
+    if engine not in (ENGINE_OPENPYXL, ENGINE_XML):
+        raise ValueError("Invalid engine {}, expecting '{}' or '{}'".format(engine, ENGINE_OPENPYXL, ENGINE_XML))
+
+
+def assert_valid_width_strategy(width_strategy, width_sample_size):
+    if width_strategy not in (WIDTH_STRATEGY_EXACT, WIDTH_STRATEGY_FIRST_ROWS, WIDTH_STRATEGY_SAMPLE):
+        raise ValueError("Invalid column width strategy {}, expecting '{}', '{}' or '{}'".format(
+            width_strategy, WIDTH_STRATEGY_EXACT, WIDTH_STRATEGY_FIRST_ROWS, WIDTH_STRATEGY_SAMPLE))
+    if width_strategy != WIDTH_STRATEGY_EXACT and width_sample_size < 1:
+        raise ValueError("Invalid column width sample size {}, expecting at least 1 row".format(width_sample_size))
+
+
 def assert_valid_sheet_name(sheet_name):
     if sheet_name is not None and len(sheet_name) > EXCEL_MAX_LEN_SHEET_NAME:
         raise Exception("The sheet name '{}' is too long. Maximum is {} characters".format(sheet_name, EXCEL_MAX_LEN_SHEET_NAME))
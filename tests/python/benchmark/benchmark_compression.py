@@ -0,0 +1,65 @@
+"""
+Benchmark of the compression levels of the final excel file: export time and file size on sample data
+
+Run from the plugin root directory:
+PYTHONPATH=$PYTHONPATH:python-lib python tests/python/benchmark/benchmark_compression.py --rows 100000
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from openpyxl import Workbook
+from xlsx_writer import datasets_to_xlsx
+
+COMPRESSION_LEVELS = [0, 1, 3, 6, 9]
+
+
+def build_sample_worksheet(nb_rows, seed):
+    rnd = random.Random(seed)
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.append(["id", "category", "label", "amount", "ratio"])
+    categories = [f"category_{index}" for index in range(20)]
+    for index in range(nb_rows):
+        worksheet.append([index, rnd.choice(categories), f"label {rnd.randint(0, 10 ** 6)}",
+                          rnd.randint(0, 10 ** 5), rnd.random()])
+    return worksheet
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000, help="number of rows of each sample dataset")
+    parser.add_argument("--datasets", type=int, default=2, help="number of sample datasets")
+    parser.add_argument("--output", help="JSON file to write the results to (printed otherwise)")
+    args = parser.parse_args()
+
+    logging.getLogger("xlsx_writer").setLevel(logging.WARNING)
+    tables = {f"dataset_{index}": build_sample_worksheet(args.rows, index) for index in range(args.datasets)}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for compression_level in COMPRESSION_LEVELS:
+            output_file = os.path.join(tmp_dir, f"benchmark_{compression_level}.xlsx")
+            start = time.perf_counter()
+            datasets_to_xlsx(list(tables), output_file, lambda name: tables[name], compression_level=compression_level)
+            results.append({
+                "compression_level": compression_level,
+                "duration_seconds": round(time.perf_counter() - start, 3),
+                "size_bytes": os.path.getsize(output_file)
+            })
+
+    report = {"rows": args.rows, "datasets": args.datasets, "results": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
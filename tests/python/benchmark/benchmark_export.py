@@ -0,0 +1,245 @@
+"""
+Benchmark of the export pipeline (datasets_to_xlsx) on synthetic workloads
+
+Each workload is a combination of the dimensions given on the command line (rows x columns x sheets x content x styles),
+run in its own process so that its peak memory is measured alone. The input sheets are generated as xlsx files beforehand
+and loaded in read-only mode by the worksheet provider, as the recipe does with the DSS excel streams.
+
+For each workload and phase, the wall time is recorded, each phase time excluding the nested phases:
+    - provider_load: loading of the dataset worksheets by the worksheet provider
+    - copy_and_width: copy (or transcoding) and styling of the cells, with the computation of the column widths (same pass)
+    - temporary_save: creation and saving of the temporary workbooks
+    - template_save: saving of the template workbook with the styles
+    - assembly: extraction of the sheets and compression of the final excel file (same pass)
+along with the cells per second, the peak RSS of the process and the peak disk usage of the temporary files.
+Each workload is run once per number of deflate workers: with 1, the sheets are deflated by ZipFile in the exporting thread,
+the assembly times of the other runs give the speedup of the multi-threaded deflate.
+
+Run from the plugin root directory:
+PYTHONPATH=$PYTHONPATH:python-lib python tests/python/benchmark/benchmark_export.py --rows 1000 100000 --styles 2 200 --output results.json
+PYTHONPATH=$PYTHONPATH:python-lib python tests/python/benchmark/benchmark_export.py --rows 500000 --sheets 4 --deflate-workers 1 2 4
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import string
+import tempfile
+import time
+
+import openpyxl
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill
+
+import xlsx_writer
+from temporary_storage import TemporaryStorage
+
+LONG_SHEET_NAME_PREFIX = "synthetic_dataset_with_a_very_long_name_"
+
+logger = logging.getLogger(__name__)
+
+
+def get_dataset_names(workload):
+    prefix = LONG_SHEET_NAME_PREFIX if workload["long_names"] else "dataset_"
+    return [f"{prefix}{index}" for index in range(workload["sheets"])]
+
+
+def generate_input_file(path, workload, seed):
+    """
+    Write a synthetic dataset as an xlsx file, with a styled header like the DSS excel streams
+    """
+    rnd = random.Random(seed)
+    fills = [PatternFill(fill_type="solid", fgColor=f"FF{rnd.randint(0, 0xFFFFFF):06X}") for _ in range(workload["styles"])]
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Sheet1")
+    header = []
+    for index in range(workload["columns"]):
+        cell = WriteOnlyCell(worksheet, value=f"column_{index}")
+        cell.fill = fills[0]
+        header.append(cell)
+    worksheet.append(header)
+    for _ in range(workload["rows"]):
+        row = []
+        for index in range(workload["columns"]):
+            if workload["content"] == "string":
+                value = "".join(rnd.choices(string.ascii_letters + " ", k=rnd.randint(5, 60)))
+            else:
+                value = rnd.random() * 10 ** 6 if index % 2 else rnd.randint(0, 10 ** 9)
+            cell = WriteOnlyCell(worksheet, value=value)
+            if workload["styles"] > 1:
+                # Many distinct styles mimic the conditional formatting
+                cell.fill = fills[rnd.randrange(1, workload["styles"])]
+            row.append(cell)
+        worksheet.append(row)
+    workbook.save(path)
+
+
+def generate_input_files(input_dir, workload):
+    paths = {}
+    for seed, name in enumerate(get_dataset_names(workload)):
+        paths[name] = os.path.join(input_dir, f"{name}.xlsx")
+        generate_input_file(paths[name], workload, seed)
+    return paths
+
+
+def get_directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass  # Deleted meanwhile
+    return size
+
+
+class PhaseRecorder:
+    """
+    Record the wall time of the phases, each one excluding its nested phases, and the peak disk usage of a directory
+    """
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.phases = {}
+        self.peak_temp_disk_bytes = 0
+        # Time spent in the nested phases, for each running phase
+        self.nested_seconds = []
+
+    def wrap(self, phase, function):
+        def wrapper(*args, **kwargs):
+            self.nested_seconds.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = self.nested_seconds.pop()
+                if self.nested_seconds:
+                    self.nested_seconds[-1] += elapsed
+                record = self.phases.setdefault(phase, {"seconds": 0.0, "calls": 0})
+                record["seconds"] += elapsed - nested
+                record["calls"] += 1
+                self.peak_temp_disk_bytes = max(self.peak_temp_disk_bytes, get_directory_size(self.temp_dir))
+        return wrapper
+
+
+def run_workload(workload, input_paths, max_workers, compression_level, engine, width_strategy, spool_max_bytes, deflate_workers):
+    temp_dir = tempfile.mkdtemp(prefix="benchmark-")
+    tempfile.tempdir = temp_dir
+    recorder = PhaseRecorder(temp_dir)
+
+    for phase, function_name in [("copy_and_width", "copy_sheet_to_workbook"),
+                                 ("copy_and_width", "write_dataset_rows"),
+                                 ("copy_and_width", "transcode_sheet_xml"),
+                                 ("temporary_save", "convert_dataset_to_temporary_workbook"),
+                                 ("template_save", "save_template_workbook"),
+                                 ("assembly", "assemble_workbook")]:
+        setattr(xlsx_writer, function_name, recorder.wrap(phase, getattr(xlsx_writer, function_name)))
+    worksheet_provider = recorder.wrap("provider_load", lambda name: load_workbook(input_paths[name], read_only=True).active)
+
+    output_file = os.path.join(temp_dir, "output.xlsx")
+    temporary_storage = TemporaryStorage(temp_dir, spool_max_bytes)
+    start = time.perf_counter()
+    xlsx_writer.datasets_to_xlsx(list(input_paths), output_file, worksheet_provider,
+                                 max_workers=max_workers, compression_level=compression_level, engine=engine,
+                                 width_strategy=width_strategy, temporary_storage=temporary_storage,
+                                 deflate_workers=deflate_workers)
+    total_seconds = time.perf_counter() - start
+
+    nb_cells = (workload["rows"] + 1) * workload["columns"] * workload["sheets"]
+    for record in recorder.phases.values():
+        record["seconds"] = round(record["seconds"], 4)
+    result = {
+        "workload": workload,
+        "deflate_workers": deflate_workers,
+        "cells": nb_cells,
+        "total_seconds": round(total_seconds, 4),
+        "cells_per_second": round(nb_cells / total_seconds),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_temp_disk_bytes": recorder.peak_temp_disk_bytes,
+        "output_bytes": os.path.getsize(output_file),
+        "temporary_storage": temporary_storage.to_dict(),
+        "phases": recorder.phases
+    }
+    shutil.rmtree(temp_dir)
+    return result
+
+
+def run_in_new_process(function, *args):
+    # A new process per call: generated data and peak memory of a workload do not leak into the next one
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="numbers of rows of each sheet")
+    parser.add_argument("--columns", type=int, nargs="+", default=[10], help="numbers of columns of each sheet")
+    parser.add_argument("--sheets", type=int, nargs="+", default=[1, 4], help="numbers of sheets")
+    parser.add_argument("--content", nargs="+", default=["numeric", "string"], choices=["numeric", "string"],
+                        help="content of the cells")
+    parser.add_argument("--styles", type=int, nargs="+", default=[1, 200],
+                        help="numbers of distinct cell styles (many styles mimic the conditional formatting)")
+    parser.add_argument("--long-names", action="store_true", help="use dataset names longer than the excel limit")
+    parser.add_argument("--max-workers", type=int, default=1, help="worker processes of the export (phases are not recorded above 1)")
+    parser.add_argument("--compression-level", type=int, default=xlsx_writer.DEFAULT_COMPRESSION_LEVEL)
+    parser.add_argument("--engine", default=xlsx_writer.ENGINE_OPENPYXL, choices=[xlsx_writer.ENGINE_OPENPYXL, xlsx_writer.ENGINE_XML],
+                        help="engine converting the input sheets")
+    parser.add_argument("--width-strategy", default=xlsx_writer.WIDTH_STRATEGY_EXACT,
+                        choices=[xlsx_writer.WIDTH_STRATEGY_EXACT, xlsx_writer.WIDTH_STRATEGY_FIRST_ROWS, xlsx_writer.WIDTH_STRATEGY_SAMPLE],
+                        help="rows measured to compute the column widths")
+    parser.add_argument("--spool-max-mb", type=int, default=0,
+                        help="temporary files smaller than this size are kept in memory (0 to write all of them on disk)")
+    parser.add_argument("--deflate-workers", type=int, nargs="+", default=[1],
+                        help="numbers of threads deflating the sheets of the final excel file (1 for ZipFile in the exporting thread)")
+    parser.add_argument("--output", help="JSON file to write the results to (printed otherwise)")
+    args = parser.parse_args()
+
+    # The progress of the benchmark is logged at INFO level through the handler configured by xlsx_writer,
+    # whose own progress messages are silenced
+    logging.getLogger("xlsx_writer").setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    results = []
+    for rows, columns, sheets, content, styles in itertools.product(args.rows, args.columns, args.sheets, args.content, args.styles):
+        workload = {"rows": rows, "columns": columns, "sheets": sheets, "content": content, "styles": styles,
+                    "long_names": args.long_names}
+        with tempfile.TemporaryDirectory(prefix="benchmark-input-") as input_dir:
+            input_paths = run_in_new_process(generate_input_files, input_dir, workload)
+            for deflate_workers in args.deflate_workers:
+                result = run_in_new_process(run_workload, workload, input_paths, args.max_workers, args.compression_level,
+                                            args.engine, args.width_strategy, args.spool_max_mb * 1024 * 1024, deflate_workers)
+                logger.info(f"{workload}, {deflate_workers} deflate workers: {result['total_seconds']}s, "
+                            f"{result['cells_per_second']} cells/s, assembly {result['phases']['assembly']['seconds']}s")
+                results.append(result)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "openpyxl": openpyxl.__version__,
+            "cpu_count": os.cpu_count(),
+            "max_workers": args.max_workers,
+            "compression_level": args.compression_level,
+            "engine": args.engine,
+            "width_strategy": args.width_strategy,
+            "spool_max_mb": args.spool_max_mb
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from dataset_sheets import get_dataset_sheets, DatasetSelection, PARTITIONS_NONE, PARTITIONS_ALL, PARTITIONS_SELECTED
+from xlsx_writer import rename_too_long_dataset_names
+
+import pytest
+
+PARTITIONS = {
+    "sales": ["2024-01-01", "2024-01-02", "2024-01-03"],
+    "customers": None,
+    "events_with_a_long_dataset_name": ["FR|2024/01", "US|2024/01"]
+}
+
+
+def test_get_dataset_sheets_without_partitions():
+    dataset_sheets = get_dataset_sheets(list(PARTITIONS), PARTITIONS.get, PARTITIONS_NONE)
+    assert list(dataset_sheets) == list(PARTITIONS)
+    assert all(sheet.partition is None for sheet in dataset_sheets.values())
+
+
+def test_get_dataset_sheets_all_partitions():
+    dataset_sheets = get_dataset_sheets(list(PARTITIONS), PARTITIONS.get, PARTITIONS_ALL)
+    assert list(dataset_sheets) == ["sales_2024-01-01", "sales_2024-01-02", "sales_2024-01-03", "customers",
+                                    "events_with_a_long_dataset_name_FR|2024_01", "events_with_a_long_dataset_name_US|2024_01"]
+    sheet = dataset_sheets["events_with_a_long_dataset_name_US|2024_01"]
+    assert (sheet.dataset_name, sheet.partition) == ("events_with_a_long_dataset_name", "US|2024/01")
+
+    # Too long sheet names are renamed as the dataset names
+    sheet_names = rename_too_long_dataset_names(list(dataset_sheets))
+    assert sheet_names["events_with_a_long_dataset_name_FR|2024_01"] == "events_with_a_long_dataset_na00"
+    assert sheet_names["events_with_a_long_dataset_name_US|2024_01"] == "events_with_a_long_dataset_na01"
+
+
+def test_get_dataset_sheets_selected_partitions():
+    dataset_sheets = get_dataset_sheets(list(PARTITIONS), PARTITIONS.get, PARTITIONS_SELECTED, ["2024-01-03", "2024-01-01", "US|2024/01"])
+    assert list(dataset_sheets) == ["sales_2024-01-01", "sales_2024-01-03", "customers", "events_with_a_long_dataset_name_US|2024_01"]
+
+    # A partitioned dataset without selected partition is not exported
+    dataset_sheets = get_dataset_sheets(list(PARTITIONS), PARTITIONS.get, PARTITIONS_SELECTED, ["2024-01-02"])
+    assert list(dataset_sheets) == ["sales_2024-01-02", "customers"]
+
+
+def test_get_dataset_sheets_errors():
+    with pytest.raises(ValueError):
+        get_dataset_sheets(list(PARTITIONS), PARTITIONS.get, "SOME")
+    with pytest.raises(ValueError):
+        # Both sheets would be named 'a_b_c'
+        get_dataset_sheets(["a_b", "a"], {"a_b": ["c"], "a": ["b_c"]}.get, PARTITIONS_ALL)
+
+
+def test_dataset_selection():
+    assert DatasetSelection().to_dict() == {}
+    assert DatasetSelection().get_read_arguments() == {}
+    assert DatasetSelection().get_rows_arguments() == {}
+
+    selection = DatasetSelection(columns=["id", "label"], row_limit=100, sampling="random")
+    assert selection.to_dict() == {"columns": ["id", "label"], "row_limit": 100, "sampling": "random"}
+    assert selection.get_read_arguments() == {"columns": ["id", "label"],
+                                              "sampling": {"samplingMethod": "RANDOM_FIXED_NB", "maxRecords": 100}}
+    assert selection.get_rows_arguments() == {"columns": ["id", "label"], "sampling": "random", "limit": 100}
+
+    selection = DatasetSelection(filter_expression="amount > 10")
+    assert selection.get_read_arguments() == {"sampling": {"samplingMethod": "FULL",
+                                                           "filter": {"enabled": True, "expression": "amount > 10"}}}
+    with pytest.raises(ValueError):
+        # Filters are applied by DSS to the excel streams only
+        selection.get_rows_arguments()
+
+    with pytest.raises(ValueError):
+        DatasetSelection(row_limit=0)
+    with pytest.raises(ValueError):
+        DatasetSelection(row_limit=10, sampling="tail")
+
+    dataset_sheets = get_dataset_sheets(list(PARTITIONS), PARTITIONS.get, PARTITIONS_ALL, dataset_selections={"sales": selection})
+    assert all(dataset_sheets[name].selection is selection for name in ["sales_2024-01-01", "sales_2024-01-02", "sales_2024-01-03"])
+    assert dataset_sheets["customers"].selection.to_dict() == {}
@@ -0,0 +1,138 @@
+from excel_stream_prefetcher import ExcelStreamPrefetcher
+from temporary_storage import TemporaryStorage
+
+import io
+import threading
+import time
+from contextlib import contextmanager
+
+
+class FakeDataset:
+    """
+    Stand-in for dataiku.Dataset, serving fake excel streams and recording the concurrent downloads
+    """
+    lock = threading.Lock()
+    nb_running = 0
+    max_running = 0
+    downloaded = []
+    read_arguments = {}
+
+    def __init__(self, name):
+        self.name = name
+
+    @contextmanager
+    def raw_formatted_data(self, format=None, format_params=None, **read_arguments):
+        assert format == "excel"
+        with FakeDataset.lock:
+            FakeDataset.read_arguments[self.name] = read_arguments
+            FakeDataset.nb_running += 1
+            FakeDataset.max_running = max(FakeDataset.max_running, FakeDataset.nb_running)
+            FakeDataset.downloaded.append(self.name)
+        time.sleep(0.05)
+        try:
+            yield io.BytesIO(f"{self.name} {format_params['applyColoring']}".encode() * 100)
+        finally:
+            with FakeDataset.lock:
+                FakeDataset.nb_running -= 1
+
+    @staticmethod
+    def reset():
+        FakeDataset.nb_running = 0
+        FakeDataset.max_running = 0
+        FakeDataset.downloaded = []
+        FakeDataset.read_arguments = {}
+
+
+def read_all(prefetcher, names):
+    contents = []
+    for name in names:
+        with prefetcher.get_excel_file(name) as file:
+            contents.append(file.read())
+    return contents
+
+
+def test_prefetch_returns_datasets_in_order():
+    FakeDataset.reset()
+    names = [f"dataset_{index}" for index in range(6)]
+    with ExcelStreamPrefetcher(names, FakeDataset, True, max_prefetched_datasets=3) as prefetcher:
+        contents = read_all(prefetcher, names)
+
+    assert contents == [f"{name} True".encode() * 100 for name in names]
+    assert FakeDataset.downloaded == names
+    assert 1 < FakeDataset.max_running <= 3
+
+
+def test_prefetch_disabled():
+    FakeDataset.reset()
+    names = ["a", "b", "c"]
+    with ExcelStreamPrefetcher(names, FakeDataset, False, max_prefetched_datasets=0) as prefetcher:
+        assert FakeDataset.downloaded == []
+        contents = read_all(prefetcher, names)
+
+    assert contents == [f"{name} False".encode() * 100 for name in names]
+    assert FakeDataset.max_running == 1
+
+
+def test_prefetch_disk_budget():
+    FakeDataset.reset()
+    names = ["a", "b", "c", "d"]
+    # Budget smaller than one file: no prefetch starts while a prefetched file is waiting
+    with ExcelStreamPrefetcher(names, FakeDataset, False, max_prefetched_datasets=3, max_disk_bytes=10) as prefetcher:
+        time.sleep(0.2)
+        assert FakeDataset.downloaded == ["a", "b", "c"]
+        read_all(prefetcher, ["a", "b"])
+        time.sleep(0.1)
+        assert FakeDataset.downloaded == ["a", "b", "c"]
+        read_all(prefetcher, ["c", "d"])
+
+    assert FakeDataset.downloaded == names
+
+
+def test_prefetch_counts_downloaded_bytes():
+    FakeDataset.reset()
+    # Files larger than the spool size roll over to disk while they are downloaded
+    storage = TemporaryStorage(spool_max_bytes=100)
+    with ExcelStreamPrefetcher(["a", "b"], FakeDataset, False, max_prefetched_datasets=2, temporary_storage=storage) as prefetcher:
+        for _, download in list(prefetcher.prefetched.values()):
+            download.result()
+        assert prefetcher.get_prefetched_bytes() == 2 * len(b"a False" * 100)
+        read_all(prefetcher, ["a"])
+        assert prefetcher.get_prefetched_bytes() == len(b"b False" * 100)
+        read_all(prefetcher, ["b"])
+        assert prefetcher.get_prefetched_bytes() == 0
+
+
+def test_prefetch_out_of_order():
+    FakeDataset.reset()
+    names = ["a", "b", "c", "d", "e"]
+    with ExcelStreamPrefetcher(names, FakeDataset, False, max_prefetched_datasets=2, max_disk_bytes=10 ** 6) as prefetcher:
+        skipped_files = [file for file, _ in prefetcher.prefetched.values()]
+        # Requesting 'c' skips 'a' and 'b': their files are deleted and the next datasets are prefetched
+        assert read_all(prefetcher, ["c"]) == [b"c False" * 100]
+        assert sorted(prefetcher.prefetched) == ["d", "e"]
+        for _, download in list(prefetcher.prefetched.values()):
+            download.result()
+        assert all(file.closed for file in skipped_files)
+        assert prefetcher.get_prefetched_bytes() == 2 * len(b"d False" * 100)
+        assert sorted(prefetcher.downloaded_bytes) == ["d", "e"]
+        assert read_all(prefetcher, ["e", "d"]) == [b"e False" * 100, b"d False" * 100]
+
+    # 'c' was not prefetched, 'd' skipped by 'e' is downloaded again when requested
+    assert FakeDataset.downloaded[:2] == ["a", "b"] and sorted(FakeDataset.downloaded[2:]) == ["c", "d", "d", "e"]
+
+
+def test_prefetch_deletes_files_not_requested():
+    FakeDataset.reset()
+    prefetcher = ExcelStreamPrefetcher(["a", "b"], FakeDataset, False, max_prefetched_datasets=2)
+    files = [file for file, _ in prefetcher.prefetched.values()]
+    prefetcher.close()
+    assert all(file.closed for file in files)
+
+
+def test_prefetch_read_arguments():
+    FakeDataset.reset()
+    read_arguments = {"a": {"columns": ["id"], "sampling": {"samplingMethod": "HEAD_SEQUENTIAL", "maxRecords": 10}}, "b": {}}
+    with ExcelStreamPrefetcher(["a", "b"], FakeDataset, False, read_arguments_provider=read_arguments.get) as prefetcher:
+        read_all(prefetcher, ["a", "b"])
+
+    assert FakeDataset.read_arguments == read_arguments
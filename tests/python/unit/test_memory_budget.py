@@ -0,0 +1,122 @@
+from memory_budget import MemoryBudget, MemoryBudgetExceeded, get_rss_bytes
+from temporary_storage import TemporaryStorage
+from excel_stream_prefetcher import ExcelStreamPrefetcher
+from export_report import ExportReport
+from xlsx_writer import datasets_to_xlsx, DatasetRows, ENGINE_OPENPYXL, ENGINE_XML
+import memory_budget
+import xlsx_writer
+
+import os
+import tempfile
+import pytest
+from openpyxl import Workbook, load_workbook
+from openpyxl.worksheet._writer import ALL_TEMP_FILES
+
+MB = 1024 * 1024
+
+
+def test_limit_settings(monkeypatch):
+    assert get_rss_bytes() > 0
+    monkeypatch.setattr(memory_budget, 'get_rss_bytes', lambda: 100 * MB)
+
+    budget = MemoryBudget(400 * MB)
+    assert budget.limit_settings(8, 2, 100 * MB) == (3, 2, int(300 * MB * memory_budget.SPOOL_BUDGET_RATIO) // 4)
+    assert len(budget.to_dict()["degradations"]) == 2
+    # Settings within the budget are kept
+    assert MemoryBudget(4000 * MB).limit_settings(2, 1, MB) == (2, 1, MB)
+
+    # Little memory left: no more prefetch, sequential conversion
+    budget = MemoryBudget(120 * MB)
+    assert budget.limit_settings(4, 2, 0) == (1, 0, 0)
+    assert budget.is_under_pressure()
+
+    with pytest.raises(MemoryBudgetExceeded, match="Memory budget of 50 MB exceeded while starting the export"):
+        MemoryBudget(50 * MB).limit_settings(1, 1, 0)
+    with pytest.raises(ValueError):
+        MemoryBudget(0)
+
+
+def test_degraded_modes_under_pressure(monkeypatch):
+    rss_bytes = [10 * MB]
+    monkeypatch.setattr(memory_budget, 'get_rss_bytes', lambda: rss_bytes[0])
+    budget = MemoryBudget(100 * MB)
+    storage = TemporaryStorage(spool_max_bytes=MB, memory_budget=budget)
+
+    with storage.create_file() as file:
+        assert file.in_memory
+    rss_bytes[0] = 80 * MB
+    with storage.create_file() as file:
+        assert not file.in_memory
+
+    class FakeDataset:
+        def __init__(self, name):
+            raise AssertionError("No prefetch expected")
+
+    # The prefetch is postponed, the datasets being downloaded when requested only
+    with ExcelStreamPrefetcher(["df1", "df2"], FakeDataset, False, max_prefetched_datasets=2, memory_budget=budget) as prefetcher:
+        assert not prefetcher.prefetched
+    assert budget.to_dict()["degradations"] == ["temporary files written on disk instead of memory",
+                                                "prefetch of the next datasets postponed while the memory is under pressure"]
+
+
+def test_datasets_to_xlsx_memory_budget(monkeypatch):
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    rss_bytes = [10 * MB]
+    monkeypatch.setattr(memory_budget, 'get_rss_bytes', lambda: rss_bytes[0])
+
+    def worksheet_provider(name):
+        workbook = Workbook()
+        workbook.active.append(['id', 'label'])
+        workbook.active.append([1, name])
+        # The first dataset takes the memory over the budget
+        rss_bytes[0] = 200 * MB
+        return workbook.active
+
+    report = ExportReport()
+    with pytest.raises(MemoryBudgetExceeded, match="exceeded while converting dataset 'df1' \\(200 MB used\\)"):
+        datasets_to_xlsx(['df1', 'df2'], os.path.join(tmp_dir.name, 'output.xlsx'), worksheet_provider, report=report,
+                         memory_budget=MemoryBudget(100 * MB))
+    assert 'df2' not in report.datasets
+
+    rss_bytes[0] = 10 * MB
+    budget = MemoryBudget(1000 * MB)
+    datasets_to_xlsx(['df1', 'df2'], os.path.join(tmp_dir.name, 'output.xlsx'), worksheet_provider, report=report,
+                     memory_budget=budget)
+    assert report.to_dict()["memory_budget"] == {"max_bytes": 1000 * MB, "degradations": []}
+
+
+@pytest.mark.filterwarnings("error::pytest.PytestUnraisableExceptionWarning")
+def test_memory_budget_exceeded_within_a_sheet(monkeypatch):
+    monkeypatch.setattr(xlsx_writer, 'MEMORY_CHECK_ROWS', 5)
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    rss_bytes = [10 * MB]
+    monkeypatch.setattr(memory_budget, 'get_rss_bytes', lambda: rss_bytes[0])
+    rows = [[index, f"label {index}"] for index in range(20)]
+    workbook = Workbook()
+    workbook.active.append(['id', 'label'])
+    for row in rows:
+        workbook.active.append(row)
+    saved_file = os.path.join(tmp_dir.name, 'large.xlsx')
+    workbook.save(saved_file)
+
+    def provide(source):
+        if source == 'rows':
+            return DatasetRows([{"name": "id", "type": "bigint"}, {"name": "label", "type": "string"}], iter(rows))
+        if source == 'read_only':
+            return load_workbook(saved_file, read_only=True).active
+        return workbook.active
+
+    for source, engine, max_workers in [('worksheet', ENGINE_OPENPYXL, 1), ('read_only', ENGINE_XML, 1), ('rows', ENGINE_OPENPYXL, 1),
+                                        ('worksheet', ENGINE_OPENPYXL, 2)]:
+        def worksheet_provider(name):
+            worksheet = provide(source)
+            # The single large sheet takes the memory over the budget while its rows are converted
+            rss_bytes[0] = 200 * MB
+            return worksheet
+
+        rss_bytes[0] = 10 * MB
+        with pytest.raises(MemoryBudgetExceeded, match="exceeded while converting row 5 of sheet 'df1'"):
+            datasets_to_xlsx(['df1'], os.path.join(tmp_dir.name, 'output.xlsx'), worksheet_provider, engine=engine,
+                             max_workers=max_workers, memory_budget=MemoryBudget(100 * MB))
+        # The aborted conversion leaves no half-open sheet writer nor temporary file
+        assert not ALL_TEMP_FILES
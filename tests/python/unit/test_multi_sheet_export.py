@@ -1,8 +1,19 @@
-from xlsx_writer import datasets_to_xlsx, rename_too_long_dataset_names
+from xlsx_writer import datasets_to_xlsx, rename_too_long_dataset_names, StyleRegistry, Exporter, copy_zip_entry, DatasetRows
+from xlsx_writer import ColumnWidthAccumulator, get_value_length, datasets_to_xlsx_files, WorkbookSheet, ParallelDeflater, \
+    open_entry_for_writing, get_sheet_titles
+import xlsx_writer
+from export_report import ExportReport
+from sheet_cache import SheetCache
 
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import io
 import os
-from openpyxl import Workbook
+import zipfile
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, PatternFill
 import pandas as pd
+import pytest
 import tempfile
 
 
@@ -87,3 +98,530 @@ def test_datasets_to_xlsx():
     assert tables['df1'].max_row-1 == len(df1_out)
     assert tables['df2'].max_row-1 == len(df2_out)
     assert tables['df3'].max_row-1 == len(df3_out)
+
+
+def test_datasets_to_xlsx_read_only():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    output_file = os.path.join(tmp_dir.name, 'sample_test_read_only.xlsx')
+
+    tables = {
+        'df1': build_worksheet(['dfId', 'gender', 'birthdate'], [[1, 'M', '1953/10/5'], [2, None, '1053/12/6']]),
+        'df2': build_worksheet(['dfId'], [[3], [4, 'extra column'], [5]])
+    }
+    for name, worksheet in tables.items():
+        worksheet.parent.save(os.path.join(tmp_dir.name, f"{name}.xlsx"))
+
+    def worksheet_provider(name):
+        return load_workbook(os.path.join(tmp_dir.name, f"{name}.xlsx"), read_only=True).active
+
+    datasets_to_xlsx(['df1', 'df2'], output_file, worksheet_provider)
+
+    for name, worksheet in tables.items():
+        output_worksheet = load_workbook(output_file)[name]
+        assert [[cell.value for cell in row] for row in output_worksheet.iter_rows()] == \
+               [[cell.value for cell in row] for row in worksheet.iter_rows()]
+        assert len(output_worksheet.column_dimensions) == worksheet.max_column
+
+
+def build_styled_worksheet(nb_rows, nb_colors):
+    worksheet = build_worksheet(['id', 'label', 'value'], [[index, f"label {index}", index / 3] for index in range(nb_rows)])
+    for cell in worksheet[1]:
+        cell.font = Font(bold=True)
+    for index, cell in enumerate(worksheet['C'][1:]):
+        cell.fill = PatternFill(fill_type='solid', fgColor=f"FF0000{index % nb_colors:02X}")
+    return worksheet
+
+
+def test_datasets_to_xlsx_parallel():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {'df1': build_styled_worksheet(50, 7), 'df2': build_styled_worksheet(20, 11), 'df3': build_styled_worksheet(5, 3)}
+
+    def worksheet_provider(name):
+        return tables[name]
+
+    sequential_file = os.path.join(tmp_dir.name, 'sequential.xlsx')
+    parallel_file = os.path.join(tmp_dir.name, 'parallel.xlsx')
+    datasets_to_xlsx(['df1', 'df2', 'df3'], sequential_file, worksheet_provider)
+    datasets_to_xlsx(['df1', 'df2', 'df3'], parallel_file, worksheet_provider, max_workers=2)
+
+    with zipfile.ZipFile(sequential_file) as sequential_zip, zipfile.ZipFile(parallel_file) as parallel_zip:
+        assert sequential_zip.namelist() == parallel_zip.namelist()
+        for name in sequential_zip.namelist():
+            if name != 'docProps/core.xml':  # contains the creation date
+                assert sequential_zip.read(name) == parallel_zip.read(name), name
+
+
+def test_datasets_to_xlsx_xml_engine(monkeypatch):
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {
+        'styled': build_styled_worksheet(10, 4),
+        'typed': build_worksheet(['label', 'flag', 'timestamp', 'day', 'amount'],
+                                 [['first', True, datetime.datetime(2021, 3, 4, 5, 6, 7), datetime.date(2021, 3, 4), 1.5],
+                                  [None, False, None, datetime.date(2022, 1, 2), None],
+                                  ['third & <last>', None, datetime.datetime(2023, 1, 1), None, 10 ** 12]])
+    }
+    tables['typed']['E5'] = 'gap'
+    for name, worksheet in tables.items():
+        worksheet.parent.save(os.path.join(tmp_dir.name, f"{name}.xlsx"))
+
+    def worksheet_provider(name):
+        return load_workbook(os.path.join(tmp_dir.name, f"{name}.xlsx"), read_only=True).active
+
+    def export(output_file_name, engine):
+        output_file = os.path.join(tmp_dir.name, output_file_name)
+        datasets_to_xlsx(['styled', 'typed'], output_file, worksheet_provider, engine=engine)
+        return load_workbook(output_file)
+
+    def get_cells(worksheet):
+        return [[(cell.value, cell.font.b, cell.fill.fgColor.rgb, cell.number_format) for cell in row] for row in worksheet.iter_rows()]
+
+    openpyxl_workbook = export('openpyxl.xlsx', 'openpyxl')
+    xml_workbook = export('xml.xlsx', 'xml')
+    assert xml_workbook.sheetnames == openpyxl_workbook.sheetnames
+    for name in tables:
+        assert get_cells(xml_workbook[name]) == get_cells(openpyxl_workbook[name])
+        assert {key: dimension.width for key, dimension in xml_workbook[name].column_dimensions.items()} == \
+               {key: dimension.width for key, dimension in openpyxl_workbook[name].column_dimensions.items()}
+
+    # Rows over the excel limit go into continuation sheets starting with the header row
+    monkeypatch.setattr(xlsx_writer, 'EXCEL_MAX_ROWS', 4)
+    split_workbook = export('split.xlsx', 'xml')
+    assert split_workbook.sheetnames == ['styled', 'styled_02', 'styled_03', 'styled_04', 'typed', 'typed_02']
+    split_rows = [row for name in ['styled', 'styled_02', 'styled_03', 'styled_04']
+                  for row in get_cells(split_workbook[name])[1:]]
+    assert split_rows == get_cells(openpyxl_workbook['styled'])[1:]
+    assert get_cells(split_workbook['typed_02'])[0] == get_cells(openpyxl_workbook['typed'])[0]
+
+    with pytest.raises(ValueError):
+        export('invalid.xlsx', 'lxml')
+
+
+def test_datasets_to_xlsx_report():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {'df1': build_styled_worksheet(50, 7), 'df2': build_styled_worksheet(20, 11)}
+
+    reports = []
+    for max_workers in [1, 2]:
+        report = ExportReport()
+        output_file = os.path.join(tmp_dir.name, f'report_{max_workers}.xlsx')
+        datasets_to_xlsx(['df1', 'df2'], output_file, lambda name: tables[name], max_workers=max_workers, report=report)
+        reports.append(report.to_dict())
+
+        assert report.output_bytes == os.path.getsize(output_file)
+        assert set(report.phases) >= {"conversion_seconds", "template_save_seconds", "assembly_seconds", "template_file_bytes"}
+        assert report.settings["max_workers"] == max_workers
+        df1_measures = report.datasets['df1']
+        assert (df1_measures["sheet"], df1_measures["rows"], df1_measures["cells"]) == ('df1', 51, 153)
+        # The cache is looked up once per distinct source style: the header font and the 7 fills
+        assert df1_measures["style_cache_hits"] + df1_measures["style_cache_misses"] == 8
+        assert df1_measures["temporary_file_bytes"] > 0
+        assert {"provider_seconds", "copy_seconds", "temporary_save_seconds", "peak_rss_bytes"} <= set(df1_measures)
+
+    sequential_report, parallel_report = reports
+    assert [dataset["dataset"] for dataset in parallel_report["datasets"]] == ['df1', 'df2']
+    assert [dataset["cells"] for dataset in sequential_report["datasets"]] == \
+           [dataset["cells"] for dataset in parallel_report["datasets"]]
+
+
+def test_datasets_to_xlsx_sheet_cache():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {'df1': build_styled_worksheet(50, 7), 'df2': build_styled_worksheet(20, 11), 'df3': build_styled_worksheet(5, 3)}
+    signatures = {'df1': 'v1', 'df2': 'v1', 'df3': None}
+    provided = []
+
+    def worksheet_provider(name):
+        provided.append(name)
+        if name == 'df2' and signatures['df2'] == 'failing':
+            raise ValueError("Export interrupted")
+        return tables[name]
+
+    def export(output_file_name, max_workers=1):
+        output_file = os.path.join(tmp_dir.name, output_file_name)
+        sheet_cache = SheetCache(os.path.join(tmp_dir.name, 'cache'), signatures.get)
+        datasets_to_xlsx(['df1', 'df2', 'df3'], output_file, worksheet_provider, max_workers=max_workers, sheet_cache=sheet_cache)
+        return output_file
+
+    reference_file = os.path.join(tmp_dir.name, 'reference.xlsx')
+    datasets_to_xlsx(['df1', 'df2', 'df3'], reference_file, lambda name: tables[name])
+
+    signatures['df2'] = 'failing'
+    with pytest.raises(ValueError):
+        export('failing.xlsx')
+    assert provided == ['df1', 'df2']
+
+    # The sheet of df1 converted before the failure is reused, df3 has no signature so it is always converted
+    provided.clear()
+    signatures['df2'] = 'v2'
+    export('resumed.xlsx')
+    assert provided == ['df2', 'df3']
+
+    provided.clear()
+    for output_file in [export('cached.xlsx'), export('cached_parallel.xlsx', max_workers=2)]:
+        with zipfile.ZipFile(reference_file) as reference_zip, zipfile.ZipFile(output_file) as output_zip:
+            for name in reference_zip.namelist():
+                if name != 'docProps/core.xml':  # contains the creation date
+                    assert reference_zip.read(name) == output_zip.read(name), name
+    assert provided == ['df3', 'df3']
+
+    # The cached sheets are known before the export, so that their datasets are not downloaded
+    sheet_cache = SheetCache(os.path.join(tmp_dir.name, 'cache'), signatures.get)
+    names = ['df1', 'df2', 'df3']
+    assert [sheet_cache.contains(sheet_cache.get_key(name, title)) for name, title in zip(names, get_sheet_titles(names))] == \
+           [True, True, False]
+
+
+def test_datasets_to_xlsx_split_over_max_rows(monkeypatch):
+    monkeypatch.setattr(xlsx_writer, "EXCEL_MAX_ROWS", 4)
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    long_name = 'dataset_with_a_name_longer_than_the_excel_limit'
+    tables = {long_name: build_styled_worksheet(7, 3), 'small': build_styled_worksheet(2, 2)}
+    schema = [{"name": "id", "type": "bigint"}, {"name": "label", "type": "string"}]
+    rows = [(index, f"label {index}") for index in range(6)]
+
+    def worksheet_provider(name):
+        if name == 'rows':
+            return DatasetRows(schema, iter(rows))
+        return tables[name]
+
+    for max_workers in [1, 2]:
+        output_file = os.path.join(tmp_dir.name, f'split_{max_workers}.xlsx')
+        datasets_to_xlsx([long_name, 'small', 'rows'], output_file, worksheet_provider, max_workers=max_workers)
+
+        output_workbook = load_workbook(output_file)
+        assert output_workbook.sheetnames == ['dataset_with_a_name_longer_th00', 'dataset_with_a_name_longer_t_02',
+                                              'dataset_with_a_name_longer_t_03', 'small', 'rows', 'rows_02']
+        long_rows = [[cell.value for cell in row[:2]] for row in tables[long_name].iter_rows()]
+        assert [[[cell.value for cell in row[:2]] for row in output_workbook.worksheets[index].iter_rows()] for index in range(3)] == \
+               [long_rows[0:4], long_rows[0:1] + long_rows[4:7], long_rows[0:1] + long_rows[7:]]
+        assert output_workbook.worksheets[1]['A1'].font.b and output_workbook.worksheets[2]['C2'].fill.fill_type == 'solid'
+        assert all(len(worksheet.column_dimensions) == 3 for worksheet in output_workbook.worksheets[:3])
+        assert [[cell.value for cell in row] for row in output_workbook['rows_02'].iter_rows()] == \
+               [['id', 'label'], [3, 'label 3'], [4, 'label 4'], [5, 'label 5']]
+
+
+def test_datasets_to_xlsx_split_unstyled_header(monkeypatch):
+    monkeypatch.setattr(xlsx_writer, "EXCEL_MAX_ROWS", 3)
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    worksheet = build_worksheet(['id', 'label', 'value'], [[index, f"label {index}", index / 4] for index in range(5)])
+
+    # The header of the continuation sheets keeps the string values of the unstyled header cells
+    output_file = os.path.join(tmp_dir.name, 'split.xlsx')
+    datasets_to_xlsx(['df'], output_file, lambda name: worksheet)
+    output_workbook = load_workbook(output_file)
+    assert [[cell.value for cell in row] for sheet in output_workbook.worksheets for row in sheet.iter_rows()] == [
+        ['id', 'label', 'value'], [0, 'label 0', 0], [1, 'label 1', 0.25],
+        ['id', 'label', 'value'], [2, 'label 2', 0.5], [3, 'label 3', 0.75],
+        ['id', 'label', 'value'], [4, 'label 4', 1]]
+
+
+def test_datasets_to_xlsx_split_sparse_rows(monkeypatch):
+    monkeypatch.setattr(xlsx_writer, "EXCEL_MAX_ROWS", 4)
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    workbook = Workbook()
+    for row, values in [(1, ['id', 'label']), (2, [1, 'a']), (7, [7, 'g']), (8, [8, 'h'])]:
+        for column, value in enumerate(values, 1):
+            workbook.active.cell(row=row, column=column, value=value)
+    workbook.save(os.path.join(tmp_dir.name, 'sparse.xlsx'))
+
+    # The missing rows 3 to 6 cross the limit, they continue in the next sheet
+    output_file = os.path.join(tmp_dir.name, 'split.xlsx')
+    datasets_to_xlsx(['sparse'], output_file, lambda name: load_workbook(os.path.join(tmp_dir.name, 'sparse.xlsx'), read_only=True).active,
+                     engine=xlsx_writer.ENGINE_XML)
+    output_workbook = load_workbook(output_file)
+    assert [[(cell.coordinate, cell.value) for row in sheet.iter_rows() for cell in row if cell.value is not None]
+            for sheet in output_workbook.worksheets] == [
+        [('A1', 'id'), ('B1', 'label'), ('A2', 1), ('B2', 'a')],
+        [('A1', 'id'), ('B1', 'label'), ('A4', 7), ('B4', 'g')],
+        [('A1', 'id'), ('B1', 'label'), ('A2', 8), ('B2', 'h')]]
+
+
+def test_datasets_to_xlsx_files(monkeypatch):
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {
+        'shared': build_styled_worksheet(5, 2),
+        'sales': build_worksheet(['region', 'amount'], [['North', 1], ['South', 2], [None, 3], ['North', 4], ['a/b', 5], ['North', 6]]),
+        'other': build_worksheet(['id'], [[1]])
+    }
+    tables['sales']['A1'].font = Font(bold=True)
+    provided_names = []
+
+    def worksheet_provider(name):
+        provided_names.append(name)
+        return tables[name]
+
+    def get_rows(worksheet):
+        # Only the first 2 columns: floats are rounded when written
+        return [[cell.value for cell in row[:2]] for row in worksheet.iter_rows()]
+
+    outputs = {name: os.path.join(tmp_dir.name, f'{name}.xlsx') for name in ['unit_a', 'unit_b']}
+    workbook_sheets = {
+        'unit_a': [WorkbookSheet('shared'), WorkbookSheet('sales', 'by region', split_by='region')],
+        'unit_b': [WorkbookSheet('other'), WorkbookSheet('shared', 'Shared data'), WorkbookSheet('sales', split_by='region')]
+    }
+    report = ExportReport()
+    datasets_to_xlsx_files(workbook_sheets, outputs, worksheet_provider, report=report)
+
+    # Each dataset is converted once, and split once by column
+    assert provided_names == ['shared', 'sales', 'other']
+    assert report.settings['workbooks'] == 2
+    assert report.output_bytes == sum(os.path.getsize(path) for path in outputs.values())
+
+    unit_a = load_workbook(outputs['unit_a'])
+    assert unit_a.sheetnames == ['shared', 'by region_North', 'by region_South', 'by region_(empty)', 'by region_a_b']
+    assert get_rows(unit_a['shared']) == get_rows(tables['shared'])
+    assert get_rows(unit_a['by region_North']) == [['region', 'amount'], ['North', 1], ['North', 4], ['North', 6]]
+    assert get_rows(unit_a['by region_(empty)']) == [['region', 'amount'], [None, 3]]
+    assert unit_a['by region_South']['A1'].font.b
+    assert len(unit_a['by region_a_b'].column_dimensions) == 2
+
+    unit_b = load_workbook(outputs['unit_b'])
+    assert unit_b.sheetnames == ['other', 'Shared data', 'sales_North', 'sales_South', 'sales_(empty)', 'sales_a_b']
+    assert get_rows(unit_b['Shared data']) == get_rows(tables['shared'])
+    assert unit_b['Shared data']['C2'].fill.fill_type == 'solid'
+
+    # The rows of a value over the excel limit go into continuation sheets
+    monkeypatch.setattr(xlsx_writer, 'EXCEL_MAX_ROWS', 3)
+    datasets_to_xlsx_files({'unit_a': [WorkbookSheet('sales', split_by='region')]}, outputs, worksheet_provider)
+    unit_a = load_workbook(outputs['unit_a'])
+    assert unit_a.sheetnames == ['sales_North', 'sales_North_02', 'sales_South', 'sales_(empty)', 'sales_a_b']
+    assert get_rows(unit_a['sales_North_02']) == [['region', 'amount'], ['North', 6]]
+
+    with pytest.raises(ValueError):
+        datasets_to_xlsx_files({'unit_a': [WorkbookSheet('sales', split_by='country')]}, outputs, worksheet_provider)
+    monkeypatch.setattr(xlsx_writer, 'MAX_SPLIT_SHEETS', 4)
+    with pytest.raises(ValueError):
+        # Too many values to split by
+        datasets_to_xlsx_files({'unit_a': [WorkbookSheet('sales', split_by='amount')]}, outputs, worksheet_provider)
+    with pytest.raises(ValueError):
+        datasets_to_xlsx_files({'unit_a': [WorkbookSheet('shared', 'other'), WorkbookSheet('other')]}, outputs, worksheet_provider)
+
+
+def test_datasets_to_xlsx_from_rows():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    output_file = os.path.join(tmp_dir.name, 'sample_test_rows.xlsx')
+    schema = [{"name": "id", "type": "bigint"}, {"name": "label", "type": "string"}, {"name": "value", "type": "double"},
+              {"name": "flag", "type": "boolean"}, {"name": "date", "type": "date"}]
+    rows = [(1, " spaced <label> ", 1.5, True, datetime.datetime(2024, 5, 17, 12, 30, tzinfo=datetime.timezone.utc)),
+            (2, None, "2.5", "false", "2024-05-18T00:00:00.000Z"),
+            (3, "extra column", "not a number", None, None, "extra")]
+    dataframe = pd.DataFrame({"id": [4, 5], "label": ["d", None], "value": [float("nan"), 3.0]})
+
+    def worksheet_provider(name):
+        if name == "rows":
+            return DatasetRows(schema, iter(rows))
+        return DatasetRows.from_dataframes(schema[:3], [dataframe.iloc[:1], dataframe.iloc[1:]])
+
+    datasets_to_xlsx(["rows", "dataframes"], output_file, worksheet_provider)
+
+    output_workbook = load_workbook(output_file)
+    rows_worksheet = output_workbook["rows"]
+    assert [cell.value for cell in rows_worksheet[1]][:5] == ["id", "label", "value", "flag", "date"]
+    assert rows_worksheet["A1"].font.b
+    assert [cell.value for cell in rows_worksheet[2]][:5] == [1, " spaced <label> ", 1.5, True, datetime.datetime(2024, 5, 17, 12, 30)]
+    assert [cell.value for cell in rows_worksheet[3]][:5] == [2, None, 2.5, False, datetime.datetime(2024, 5, 18)]
+    assert [cell.value for cell in rows_worksheet[4]] == [3, "extra column", "not a number", None, None, "extra"]
+    assert rows_worksheet["E2"].number_format == "yyyy-mm-dd hh:mm:ss"
+    assert len(rows_worksheet.column_dimensions) == 6
+
+    dataframes_worksheet = output_workbook["dataframes"]
+    assert [[cell.value for cell in row] for row in dataframes_worksheet.iter_rows(min_row=2)] == [[4, "d", None], [5, None, 3]]
+
+
+def test_datasets_to_xlsx_compression_level():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {'df1': build_worksheet(['dfId', 'label'], [[index, f"label {index}"] for index in range(500)])}
+    sizes = {}
+    for compression_level in [0, 1, 9]:
+        output_file = os.path.join(tmp_dir.name, f"sample_test_{compression_level}.xlsx")
+        datasets_to_xlsx(['df1'], output_file, lambda name: tables[name], compression_level=compression_level)
+        assert len(pd.read_excel(output_file, sheet_name="df1")) == 500
+        with zipfile.ZipFile(output_file) as output_zip:
+            compress_types = {entry.compress_type for entry in output_zip.infolist()}
+        assert compress_types == {zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED}
+        sizes[compression_level] = os.path.getsize(output_file)
+    assert sizes[0] > sizes[1] >= sizes[9]
+
+    with pytest.raises(ValueError):
+        datasets_to_xlsx(['df1'], os.path.join(tmp_dir.name, "invalid.xlsx"), lambda name: tables[name], compression_level=10)
+
+
+class NonSeekableStream(io.RawIOBase):
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def test_parallel_deflate(monkeypatch):
+    monkeypatch.setattr(xlsx_writer, 'DEFLATE_BLOCK_SIZE', 1000)
+    data = b''.join(f'<row r="{index}"><c><v>{index * 7}</v></c></row>'.encode() for index in range(5000))
+
+    # Blocks deflated by threads form a single deflate stream, with the CRC and sizes of the whole entry
+    for output in [io.BytesIO(), NonSeekableStream()]:
+        with ThreadPoolExecutor(max_workers=3) as executor, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            with open_entry_for_writing(archive, 'sheet.xml', ParallelDeflater(executor, 6, 3)) as target:
+                for index in range(0, len(data), 777):
+                    target.write(data[index:index + 777])
+        archive_bytes = output.getvalue() if isinstance(output, io.BytesIO) else output.buffer.getvalue()
+        with zipfile.ZipFile(io.BytesIO(archive_bytes)) as archive:
+            assert archive.testzip() is None
+            assert archive.read('sheet.xml') == data
+            assert archive.getinfo('sheet.xml').compress_size < len(data) / 4
+
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    tables = {'df1': build_styled_worksheet(2000, 5), 'df2': build_styled_worksheet(500, 3)}
+    contents = {}
+    assert xlsx_writer.PARALLEL_DEFLATE_SUPPORTED
+    # Without a replaceable compressor of the entries, the sheets are deflated serially
+    for deflate_workers, supported in [(1, True), (4, True), (4, False)]:
+        monkeypatch.setattr(xlsx_writer, 'PARALLEL_DEFLATE_SUPPORTED', supported)
+        output_file = os.path.join(tmp_dir.name, f'deflate_{deflate_workers}.xlsx')
+        datasets_to_xlsx(['df1', 'df2'], output_file, lambda name: tables[name], deflate_workers=deflate_workers)
+        with zipfile.ZipFile(output_file) as output_zip:
+            assert output_zip.testzip() is None
+            contents[deflate_workers, supported] = {name: output_zip.read(name) for name in output_zip.namelist()
+                                                    if name != 'docProps/core.xml'}
+    assert contents[1, True] == contents[4, True] == contents[4, False]
+
+    with pytest.raises(ValueError):
+        datasets_to_xlsx(['df1'], os.path.join(tmp_dir.name, 'invalid.xlsx'), lambda name: tables[name], deflate_workers=0)
+
+
+def test_get_style_cached():
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.append(['bold', 'bold too', 'filled'])
+    worksheet['A1'].font = Font(name='Courier New', bold=True)
+    worksheet['B1'].font = Font(name='Courier New', bold=True)
+    worksheet['C1'].fill = PatternFill(fill_type='solid', fgColor='FF123456')
+
+    style_registry = StyleRegistry()
+    bold_style = style_registry.get_style_cached(worksheet['A1'])
+    assert style_registry.get_style_cached(worksheet['B1']) is bold_style
+    filled_style = style_registry.get_style_cached(worksheet['C1'])
+    assert filled_style is not bold_style
+    assert style_registry.get_style_cached(worksheet['A1']) is bold_style
+    assert len(style_registry) == 2
+
+    # A copy starts with the same styles, the styles added afterwards are not shared
+    warm_registry = style_registry.copy()
+    assert warm_registry.get_style_cached(worksheet['C1']) is filled_style
+    warm_registry.get_style_cached(worksheet.cell(row=2, column=1, value='plain'))
+    assert (len(warm_registry), len(style_registry)) == (3, 2)
+
+
+def test_exporter():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    exporter = Exporter(compression_level=1)
+
+    def worksheet_provider(name):
+        return build_styled_worksheet(20, 2 if name == 'df1' else 3)
+
+    # Reused for several exports, each one with its own styles
+    nb_styles = []
+    for index in range(2):
+        report = ExportReport()
+        exporter.export(['df1'], os.path.join(tmp_dir.name, f'reused_{index}.xlsx'), worksheet_provider, report=report)
+        nb_styles.append(report.phases["styles"])
+    assert nb_styles[0] == nb_styles[1] > 0
+    assert len(exporter.style_registry) == 0
+
+    # Concurrent exports write the same files as sequential ones
+    names = [['df1'], ['df2'], ['df1', 'df2'], ['df2', 'df1']]
+    for index, dataset_names in enumerate(names):
+        exporter.export(dataset_names, os.path.join(tmp_dir.name, f'sequential_{index}.xlsx'), worksheet_provider)
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = [executor.submit(exporter.export, dataset_names, os.path.join(tmp_dir.name, f'concurrent_{index}.xlsx'),
+                                   worksheet_provider)
+                   for index, dataset_names in enumerate(names)]
+        for future in futures:
+            future.result()
+    for index in range(len(names)):
+        with zipfile.ZipFile(os.path.join(tmp_dir.name, f'sequential_{index}.xlsx')) as sequential_zip, \
+                zipfile.ZipFile(os.path.join(tmp_dir.name, f'concurrent_{index}.xlsx')) as concurrent_zip:
+            for name in sequential_zip.namelist():
+                if name != 'docProps/core.xml':  # contains the creation date
+                    assert sequential_zip.read(name) == concurrent_zip.read(name), name
+
+    # Warm-started with the styles of a related export, whose styles keep their ids
+    style_registry = exporter.export(['df1'], os.path.join(tmp_dir.name, 'first.xlsx'), worksheet_provider)
+    warm_exporter = Exporter(style_registry=style_registry)
+    warm_registry = warm_exporter.export(['df2'], os.path.join(tmp_dir.name, 'second.xlsx'), worksheet_provider)
+    assert list(warm_registry)[:len(style_registry)] == list(style_registry)
+    assert len(warm_registry) == len(style_registry) + 1
+    fill = load_workbook(os.path.join(tmp_dir.name, 'second.xlsx'))['df2']['C4'].fill
+    assert fill.fgColor.rgb == 'FF000002'
+
+
+def test_get_value_length():
+    values = [None, True, False, '', 'text', 0, 7, -7, 10, 99, 100, -1000, 10 ** 15, 10 ** 16, -10 ** 20,
+              0.0, -0.0, 1.0, -12.0, 1e15, 1e16, 1.5, 1 / 3, -2.5e-10, float('inf'), float('nan'),
+              datetime.date(2021, 3, 4), datetime.date(1, 1, 1), datetime.datetime(2021, 3, 4, 5, 6, 7),
+              datetime.datetime(2021, 3, 4, 5, 6, 7, 8), datetime.datetime(2021, 3, 4, tzinfo=datetime.timezone.utc),
+              datetime.time(5, 6, 7), datetime.time(5, 6, 7, 8), datetime.timedelta(days=2, seconds=3)]
+    for value in values:
+        assert get_value_length(value) == len(str(value)), value
+
+
+def test_column_width_strategies():
+    rows = [['id', 'label', 'extra']] + [[index, 'x' * (index % 50), None] for index in range(1000)] + [[1000, 'last', 'wide column']]
+
+    def get_column_widths(strategy, sample_size=10000):
+        accumulator = ColumnWidthAccumulator(strategy, sample_size)
+        for row in rows:
+            if accumulator.measures_next_row():
+                accumulator.add_values(row)
+            else:
+                accumulator.add_row_size(len(row))
+        assert (accumulator.nb_rows, accumulator.nb_cells) == (1002, 3006)
+        return accumulator.get_column_widths()
+
+    exact_widths = get_column_widths('exact')
+    # Same widths as the exact strategy while the sample holds all rows
+    assert get_column_widths('first_rows') == exact_widths
+    assert get_column_widths('sample') == exact_widths
+
+    first_rows_widths = get_column_widths('first_rows', 10)
+    assert len(first_rows_widths) == 3
+    assert first_rows_widths[1] < exact_widths[1]
+    # Samples are drawn uniformly and reproducibly
+    sample_widths = get_column_widths('sample', 200)
+    assert sample_widths == get_column_widths('sample', 200)
+    assert abs(sample_widths[1] - exact_widths[1]) <= 2 * xlsx_writer.LETTER_WIDTH
+
+    with pytest.raises(ValueError):
+        ColumnWidthAccumulator('median')
+    with pytest.raises(ValueError):
+        ColumnWidthAccumulator('sample', 0)
+
+
+def test_copy_zip_entry(monkeypatch):
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    source_file = os.path.join(tmp_dir.name, 'source.zip')
+    target_file = os.path.join(tmp_dir.name, 'target.zip')
+    entries = {'deflated.xml': b'<a>' + b'deflated ' * 1000 + b'</a>', 'stored.txt': b'stored'}
+
+    with zipfile.ZipFile(source_file, 'w') as source_zip:
+        source_zip.writestr('deflated.xml', entries['deflated.xml'], compress_type=zipfile.ZIP_DEFLATED)
+        source_zip.writestr('stored.txt', entries['stored.txt'], compress_type=zipfile.ZIP_STORED)
+
+    # Without the zipfile internals of the raw copy, the entries are read and written again
+    assert xlsx_writer.RAW_ENTRY_COPY_SUPPORTED
+    for raw_entry_copy_supported in [True, False]:
+        monkeypatch.setattr(xlsx_writer, 'RAW_ENTRY_COPY_SUPPORTED', raw_entry_copy_supported)
+        with zipfile.ZipFile(source_file) as source_zip, zipfile.ZipFile(target_file, 'w') as target_zip:
+            target_zip.writestr('written.txt', b'written')
+            for entry in source_zip.infolist():
+                copy_zip_entry(source_zip, entry, target_zip)
+
+        with zipfile.ZipFile(target_file) as target_zip:
+            assert target_zip.testzip() is None
+            assert target_zip.namelist() == ['written.txt', 'deflated.xml', 'stored.txt']
+            assert target_zip.getinfo('deflated.xml').compress_type == zipfile.ZIP_DEFLATED
+            assert target_zip.getinfo('stored.txt').compress_type == zipfile.ZIP_STORED
+            for name, data in entries.items():
+                assert target_zip.read(name) == data
@@ -0,0 +1,89 @@
+from sheet_cache import SheetCache
+import sheet_cache
+
+import json
+import os
+import tempfile
+
+
+def write_file(path, size):
+    with open(path, "wb") as file:
+        file.write(b"x" * size)
+
+
+def test_sheet_cache_keys():
+    signatures = {"a": "v1", "b": None}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = SheetCache(cache_dir, signatures.get, settings={"conditional_formatting": True})
+        key = cache.get_key("a", "sheet a")
+        assert key == cache.get_key("a", "sheet a")
+        assert key != cache.get_key("a", "renamed sheet")
+        assert key != SheetCache(cache_dir, signatures.get, settings={"conditional_formatting": False}).get_key("a", "sheet a")
+        assert cache.get_key("b", "sheet b") is None
+        signatures["a"] = "v2"
+        assert key != cache.get_key("a", "sheet a")
+
+
+def test_sheet_cache_store_and_load():
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.NamedTemporaryFile() as workbook_file:
+        write_file(workbook_file.name, 10)
+        cache = SheetCache(cache_dir, lambda name: "v1")
+        key = cache.get_key("a", "a")
+        assert cache.load(key) is None
+        assert not cache.contains(key) and not cache.contains(None)
+        cache.store(key, workbook_file.name, [12.0, 3.6], {1: "style"}, 2)
+        # Looked up without marking the sheet as used, for instance to skip the download of its dataset
+        other_cache = SheetCache(cache_dir, lambda name: "v1")
+        assert other_cache.contains(key) and not other_cache.used_keys
+
+        with open(os.path.join(cache_dir, key + ".json")) as metadata_file:
+            assert json.load(metadata_file) == {"column_widths": [12.0, 3.6], "local_style_ids": {"1": "style"}, "nb_sheets": 2}
+        assert sorted(os.listdir(cache_dir)) == [key + ".json", key + ".xlsx"]
+        cached_sheet = SheetCache(cache_dir, lambda name: "v1").load(key)
+        assert (cached_sheet.column_widths, cached_sheet.local_style_ids, cached_sheet.nb_sheets) == ([12.0, 3.6], {1: "style"}, 2)
+        with open(cached_sheet.workbook_path, "rb") as file:
+            assert file.read() == b"x" * 10
+
+
+def test_sheet_cache_eviction():
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.NamedTemporaryFile() as workbook_file:
+        write_file(workbook_file.name, 1000)
+        previous_cache = SheetCache(cache_dir, lambda name: name)
+        for name in ["a", "b"]:
+            previous_cache.store(previous_cache.get_key(name, name), workbook_file.name, [], {})
+        # 'a' is the least recently used sheet
+        os.utime(os.path.join(cache_dir, previous_cache.get_key("a", "a") + ".json"), (0, 0))
+
+        cache = SheetCache(cache_dir, lambda name: name, max_bytes=2500)
+        assert cache.load(cache.get_key("b", "b")) is not None
+        cache.store(cache.get_key("c", "c"), workbook_file.name, [], {})
+        assert cache.load(cache.get_key("a", "a")) is None
+        assert cache.load(cache.get_key("b", "b")) is not None
+
+        # Sheets used by the current export are never evicted, even over the maximum size
+        cache.max_bytes = 0
+        cache.evict()
+        assert cache.load(cache.get_key("c", "c")) is not None
+
+
+def test_sheet_cache_sweeps_orphans(monkeypatch):
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.NamedTemporaryFile() as workbook_file:
+        write_file(workbook_file.name, 10)
+        cache = SheetCache(cache_dir, lambda name: name)
+        cache.store(cache.get_key("a", "a"), workbook_file.name, [], {})
+        # Files left by interrupted exports, and a sheet of a previous cache format
+        orphans = ["b.xlsx", "a.1x2y3z.tmp", "c.pickle", "c.xlsx"]
+        for file_name in orphans + ["recent.tmp"]:
+            write_file(os.path.join(cache_dir, file_name), 10)
+        for file_name in orphans:
+            os.utime(os.path.join(cache_dir, file_name), (0, 0))
+        os.utime(os.path.join(cache_dir, cache.get_key("a", "a") + ".xlsx"), (0, 0))
+
+        cache = SheetCache(cache_dir, lambda name: name)
+        # Recent files may belong to a running export
+        assert sorted(os.listdir(cache_dir)) == sorted([cache.get_key("a", "a") + ".json", cache.get_key("a", "a") + ".xlsx", "recent.tmp"])
+        assert cache.load(cache.get_key("a", "a")) is not None
+
+        monkeypatch.setattr(sheet_cache, 'ORPHAN_MIN_AGE_SECONDS', 0)
+        SheetCache(cache_dir, lambda name: name)
+        assert "recent.tmp" not in os.listdir(cache_dir)
@@ -0,0 +1,125 @@
+from stream_upload import StreamUpload, UploadAborted, UPLOAD_CHUNK_SIZE
+from xlsx_writer import datasets_to_xlsx, datasets_to_xlsx_files, WorkbookSheet
+from export_report import ExportReport
+
+import os
+import tempfile
+import zipfile
+import pytest
+from openpyxl import Workbook, load_workbook
+
+
+class FakeFolder:
+    """
+    Stand-in for dataiku.Folder, storing the uploaded streams as local files
+    """
+
+    def __init__(self, directory, fail_after_bytes=None):
+        self.directory = directory
+        self.fail_after_bytes = fail_after_bytes
+        self.uploaded = []
+
+    def upload_stream(self, path, stream):
+        size = 0
+        with open(os.path.join(self.directory, path), "wb") as file:
+            while True:
+                chunk = stream.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if self.fail_after_bytes is not None and size > self.fail_after_bytes:
+                    raise IOError("Upload failed")
+                file.write(chunk)
+        self.uploaded.append(path)
+
+
+def test_stream_upload():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folder = FakeFolder(tmp_dir)
+        content = os.urandom(3 * UPLOAD_CHUNK_SIZE + 123)
+        with StreamUpload(lambda stream: folder.upload_stream("data.bin", stream), max_buffered_chunks=2) as upload:
+            for index in range(0, len(content), 1000):
+                upload.write(content[index:index + 1000])
+            assert upload.tell() == len(content)
+        assert folder.uploaded == ["data.bin"]
+        with open(os.path.join(tmp_dir, "data.bin"), "rb") as file:
+            assert file.read() == content
+
+
+def test_stream_upload_failures():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Upload failing: the error is raised to the writer
+        folder = FakeFolder(tmp_dir, fail_after_bytes=UPLOAD_CHUNK_SIZE)
+        with pytest.raises(IOError, match="Upload failed"):
+            with StreamUpload(lambda stream: folder.upload_stream("data.bin", stream), max_buffered_chunks=1) as upload:
+                for _ in range(10):
+                    upload.write(os.urandom(UPLOAD_CHUNK_SIZE))
+
+        # Writer failing: the upload is aborted
+        upload_errors = []
+
+        def upload_function(stream):
+            try:
+                folder.upload_stream("aborted.bin", stream)
+            except UploadAborted as error:
+                upload_errors.append(error)
+
+        folder = FakeFolder(tmp_dir)
+        with pytest.raises(ValueError):
+            with StreamUpload(upload_function) as upload:
+                upload.write(os.urandom(2 * UPLOAD_CHUNK_SIZE))
+                raise ValueError("Conversion failed")
+        assert len(upload_errors) == 1
+        assert folder.uploaded == []
+
+
+def test_datasets_to_xlsx_stream_upload():
+    tables = {}
+    for name, nb_rows in [('df1', 20000), ('df2', 10)]:
+        workbook = Workbook()
+        workbook.active.append(['id', 'label'])
+        for index in range(nb_rows):
+            workbook.active.append([index, f"label {index}"])
+        tables[name] = workbook.active
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folder = FakeFolder(tmp_dir)
+        report = ExportReport()
+        with StreamUpload(lambda stream: folder.upload_stream("streamed.xlsx", stream)) as upload:
+            datasets_to_xlsx(['df1', 'df2'], upload, lambda name: tables[name], report=report)
+        reference_file = os.path.join(tmp_dir, "reference.xlsx")
+        datasets_to_xlsx(['df1', 'df2'], reference_file, lambda name: tables[name])
+
+        streamed_file = os.path.join(tmp_dir, "streamed.xlsx")
+        assert report.output_bytes == os.path.getsize(streamed_file)
+        with zipfile.ZipFile(streamed_file) as streamed_zip, zipfile.ZipFile(reference_file) as reference_zip:
+            assert streamed_zip.testzip() is None
+            assert streamed_zip.namelist() == reference_zip.namelist()
+            for name in streamed_zip.namelist():
+                if name != 'docProps/core.xml':  # contains the creation date
+                    assert streamed_zip.read(name) == reference_zip.read(name), name
+        streamed_workbook = load_workbook(streamed_file, read_only=True)
+        assert [list(row) for row in streamed_workbook['df2'].values][:2] == [['id', 'label'], [0, 'label 0']]
+
+
+def test_datasets_to_xlsx_files_stream_upload():
+    workbook = Workbook()
+    workbook.active.append(['id', 'label'])
+    workbook.active.append([1, 'label 1'])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folder = FakeFolder(tmp_dir)
+        uploads = {name: StreamUpload(lambda stream, name=name: folder.upload_stream(f"{name}.xlsx", stream)) for name in ['a', 'b']}
+        for upload in uploads.values():
+            upload.start()
+        uploaded_when_written = []
+
+        # Each upload is completed as soon as its workbook is written
+        def finish_upload(name):
+            uploads[name].finish()
+            uploaded_when_written.append(list(folder.uploaded))
+
+        datasets_to_xlsx_files({'a': [WorkbookSheet('df')], 'b': [WorkbookSheet('df', 'copy')]}, uploads, lambda name: workbook.active,
+                               on_workbook_written=finish_upload)
+        assert uploaded_when_written == [['a.xlsx'], ['a.xlsx', 'b.xlsx']]
+        assert load_workbook(os.path.join(tmp_dir, 'b.xlsx')).sheetnames == ['copy']
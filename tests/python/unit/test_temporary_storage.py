@@ -0,0 +1,79 @@
+from temporary_storage import TemporaryStorage
+from xlsx_writer import datasets_to_xlsx
+from export_report import ExportReport
+
+import os
+import tempfile
+import zipfile
+import pytest
+from openpyxl import Workbook, load_workbook
+
+
+def test_spooled_files():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    storage = TemporaryStorage(tmp_dir.name, spool_max_bytes=100)
+
+    with storage.create_file() as small_file:
+        small_file.write(b"x" * 100)
+        assert small_file.in_memory and small_file.name is None
+        assert not os.listdir(tmp_dir.name)
+
+    with storage.create_file() as large_file:
+        large_file.write(b"x" * 60)
+        large_file.write(b"y" * 60)
+        # Spilled into a named file of the directory, keeping its content and position
+        assert not large_file.in_memory
+        assert os.path.dirname(large_file.name) == os.path.abspath(tmp_dir.name)
+        assert large_file.tell() == 120
+        large_file.seek(58)
+        assert large_file.read(4) == b"xxyy"
+
+    with storage.create_file(on_disk=True) as named_file:
+        assert os.path.exists(named_file.name)
+    assert not os.listdir(tmp_dir.name)
+
+    assert storage.to_dict() == {"directory": tmp_dir.name, "spool_max_bytes": 100, "spooled_files": 1, "spooled_bytes": 100,
+                                 "spilled_files": 2, "spilled_bytes": 120}
+
+    # Without spool size, all files are on disk
+    with TemporaryStorage().create_file() as disk_file:
+        assert not disk_file.in_memory
+
+    with pytest.raises(ValueError):
+        TemporaryStorage(os.path.join(tmp_dir.name, "missing"))
+    with pytest.raises(ValueError):
+        TemporaryStorage(spool_max_bytes=-1)
+
+
+def test_datasets_to_xlsx_in_memory():
+    tmp_dir = tempfile.TemporaryDirectory(dir='.')
+    workbook = Workbook()
+    for index in range(200):
+        workbook.active.append([index, f"label {index}"])
+    workbook.save(os.path.join(tmp_dir.name, 'input.xlsx'))
+
+    def worksheet_provider(name):
+        return load_workbook(os.path.join(tmp_dir.name, 'input.xlsx'), read_only=True).active
+
+    reference_file = os.path.join(tmp_dir.name, 'reference.xlsx')
+    datasets_to_xlsx(['df1', 'df2'], reference_file, worksheet_provider)
+
+    for spool_max_bytes in [1024 * 1024, 1024]:
+        storage_dir = tempfile.TemporaryDirectory(dir=tmp_dir.name)
+        output_file = os.path.join(tmp_dir.name, f'in_memory_{spool_max_bytes}.xlsx')
+        report = ExportReport()
+        datasets_to_xlsx(['df1', 'df2'], output_file, worksheet_provider, report=report,
+                         temporary_storage=TemporaryStorage(storage_dir.name, spool_max_bytes))
+        with zipfile.ZipFile(reference_file) as reference_zip, zipfile.ZipFile(output_file) as output_zip:
+            for name in reference_zip.namelist():
+                if name != 'docProps/core.xml':  # contains the creation date
+                    assert reference_zip.read(name) == output_zip.read(name), name
+        assert not os.listdir(storage_dir.name)
+
+        # 2 temporary workbooks and the template workbook
+        storage = report.to_dict()["temporary_storage"]
+        assert storage["spooled_files"] + storage["spilled_files"] == 3
+        if spool_max_bytes > 1024:
+            assert storage["spilled_files"] == 0 and storage["spooled_bytes"] > 0
+        else:
+            assert storage["spooled_files"] == 0 and storage["spilled_bytes"] > 0